@@ -0,0 +1,508 @@
+'''
+A local stand-in for the Bambu cloud, so the printer subsystem can be run,
+tested and load-tested offline. It serves the login, token refresh and
+device list HTTP endpoints, and a minimal MQTT 3.1.1 broker (QoS 0, exact
+topic subscriptions) with simulated printers that answer pushall requests
+with a full report and then send deltas as they heat up, print and finish.
+
+Run from MAKE-server (it needs config.py):
+
+    python benchmarks/bambu_mock.py                 # just serve the mock
+    python benchmarks/bambu_mock.py --load 60       # run the telemetry service against it for 60s
+
+To run the server against the mock, set these in config.py:
+
+    BAMBULABS_PASS = "mock"
+    BAMBU_API_URL = "http://localhost:8765"
+    BAMBU_LOGIN_URL = "http://localhost:8765/api/sign-in/form"
+    BAMBU_MQTT_HOST = "localhost"
+    BAMBU_MQTT_PORT = 1884
+    BAMBU_MQTT_USE_TLS = False
+
+Tokens are JWTs that expire after --token-lifetime seconds, and the broker
+drops connections when their token expires, which exercises token refresh
+and reconnects. --load writes mock printers (named mock-printer-N) to the
+configured database, so use a development database. They are deleted
+afterwards. Exits with 1 if the stored state doesn't match the printers.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import struct
+import sys
+import time
+import uuid
+
+import jwt
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from machines import printers
+from machines.bambu import BambuClient, GET_USER_DEVICES, POST_REFRESH_PATH
+
+TOKEN_SECRET = "bambu-mock"
+USER_ID = "1000"
+PRINTER_PREFIX = "mock-printer-"
+
+# MQTT packet types
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+CONNACK_NOT_AUTHORIZED = 5
+
+
+class Stats:
+    def __init__(self):
+        self.logins = 0
+        self.refreshes = 0
+        self.device_requests = 0
+        self.rejected = 0
+        self.mqtt_connections = 0
+        self.reports = 0
+
+
+class MockPrinter:
+    '''
+    A simulated printer that cycles through idle, printing and finished.
+    '''
+
+    def __init__(self, index: int):
+        self.device_id = f"MOCK{index:06d}"
+        self.name = f"{PRINTER_PREFIX}{index}"
+        self.rng = random.Random(index)
+        self.state = {
+            "command": "push_status",
+            "msg": 0,
+            "gcode_state": "IDLE",
+            "subtask_name": "",
+            "mc_percent": 0,
+            "mc_remaining_time": 0,
+            "layer_num": 0,
+            "total_layer_num": 0,
+            "print_error": 0,
+            "nozzle_temper": 25.0,
+            "bed_temper": 25.0,
+            "ams": {"ams": [{"id": "0", "tray": [
+                {"id": str(tray), "tray_type": "PLA", "tray_color": color}
+                for tray, color in enumerate(["FF0000FF", "00FF00FF", "0000FFFF", "FFFFFFFF"])
+            ]}]},
+            # Real reports include these, they must not be stored
+            "net": {"info": [{"ip": 16777343}]},
+            "upgrade_state": {"sn": self.device_id},
+        }
+
+    def full_report(self):
+        return {"print": dict(self.state, msg=0)}
+
+    def step(self):
+        # Advance the simulation, returning the delta that changed
+        state = self.state
+        delta = {}
+
+        if state["gcode_state"] in ("IDLE", "FINISH"):
+            if self.rng.random() < 0.2:
+                delta = {
+                    "gcode_state": "RUNNING",
+                    "subtask_name": f"part_{self.rng.randrange(1000)}",
+                    "mc_percent": 0,
+                    "mc_remaining_time": 30,
+                    "layer_num": 0,
+                    "total_layer_num": 100,
+                }
+            else:
+                delta = {"nozzle_temper": max(25.0, state["nozzle_temper"] - 5), "bed_temper": max(25.0, state["bed_temper"] - 2)}
+        else:
+            percent = min(100, state["mc_percent"] + self.rng.randint(0, 3))
+            delta = {
+                "mc_percent": percent,
+                "mc_remaining_time": 30 * (100 - percent) // 100,
+                "layer_num": percent,
+                "nozzle_temper": 220 + self.rng.uniform(-1, 1),
+                "bed_temper": 60 + self.rng.uniform(-0.5, 0.5),
+            }
+            if percent == 100:
+                delta["gcode_state"] = "FINISH"
+
+        state.update(delta)
+        return {"print": dict(delta, command="push_status", msg=1)}
+
+
+def make_token(lifetime: float):
+    now = time.time()
+    return jwt.encode({"preferred_username": USER_ID, "iat": int(now), "exp": int(now + lifetime), "jti": uuid.uuid4().hex}, TOKEN_SECRET)
+
+
+def token_expiry(token: str):
+    # Returns when a token expires, or None if it's invalid or expired
+    try:
+        return jwt.decode(token, TOKEN_SECRET, algorithms=["HS256"])["exp"]
+    except jwt.PyJWTError:
+        return None
+
+
+class MockBambuCloud:
+    '''
+    The mock HTTP API and MQTT broker, sharing the simulated printers.
+    '''
+
+    def __init__(self, printer_count: int, interval: float, token_lifetime: float):
+        self.printers = {printer.device_id: printer for printer in map(MockPrinter, range(printer_count))}
+        self.interval = interval
+        self.token_lifetime = token_lifetime
+        self.refresh_tokens = set()
+        self.subscriptions = {}
+        self.stats = Stats()
+        self.tasks = []
+
+    # HTTP
+
+    def issue_tokens(self):
+        refresh_token = uuid.uuid4().hex
+        self.refresh_tokens.add(refresh_token)
+        return make_token(self.token_lifetime), refresh_token
+
+    async def sign_in(self, request: web.Request):
+        self.stats.logins += 1
+        token, refresh_token = self.issue_tokens()
+
+        response = web.json_response({"success": True})
+        response.set_cookie("token", token)
+        response.set_cookie("refreshToken", refresh_token)
+        return response
+
+    async def refresh(self, request: web.Request):
+        body = await request.json()
+
+        if body.get("refreshToken") not in self.refresh_tokens:
+            self.stats.rejected += 1
+            return web.json_response({"message": "Invalid refresh token"}, status=401)
+
+        self.stats.refreshes += 1
+        self.refresh_tokens.discard(body["refreshToken"])
+        token, refresh_token = self.issue_tokens()
+        return web.json_response({"accessToken": token, "refreshToken": refresh_token, "expiresIn": self.token_lifetime})
+
+    async def devices(self, request: web.Request):
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+
+        if token_expiry(token) is None:
+            self.stats.rejected += 1
+            return web.json_response({"message": "Unauthorized"}, status=401)
+
+        self.stats.device_requests += 1
+        return web.json_response({"message": "success", "devices": [
+            {"dev_id": printer.device_id, "name": printer.name, "online": True}
+            for printer in self.printers.values()
+        ]})
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post("/api/sign-in/form", self.sign_in)
+        app.router.add_post(f"/{POST_REFRESH_PATH}", self.refresh)
+        app.router.add_get(f"/{GET_USER_DEVICES}", self.devices)
+        return app
+
+    # MQTT
+
+    def publish(self, topic: str, payload: dict):
+        data = json.dumps(payload).encode()
+
+        for writer in list(self.subscriptions.get(topic, ())):
+            if not writer.is_closing():
+                writer.write(encode_publish(topic, data))
+                self.stats.reports += 1
+
+    def handle_request(self, topic: str, payload: bytes):
+        # device/<id>/request, answered with a full report
+        _, device_id, _ = topic.split("/")
+        printer = self.printers.get(device_id)
+
+        if printer is not None and json.loads(payload).get("pushing", {}).get("command") == "pushall":
+            self.publish(f"device/{device_id}/report", printer.full_report())
+
+    async def handle_mqtt(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        topics = set()
+        expiry_handle = None
+
+        try:
+            packet_type, _, body = await read_packet(reader)
+            if packet_type != CONNECT:
+                return
+
+            username, password = parse_connect(body)
+            expires_at = token_expiry(password or "")
+
+            if username != f"u_{USER_ID}" or expires_at is None:
+                self.stats.rejected += 1
+                writer.write(bytes([CONNACK << 4, 2, 0, CONNACK_NOT_AUTHORIZED]))
+                await writer.drain()
+                return
+
+            self.stats.mqtt_connections += 1
+            writer.write(bytes([CONNACK << 4, 2, 0, 0]))
+
+            # Like Bambu's broker, drop the connection when its token expires
+            expiry_handle = asyncio.get_running_loop().call_later(max(0, expires_at - time.time()), writer.close)
+
+            while True:
+                packet_type, flags, body = await read_packet(reader)
+
+                if packet_type == PUBLISH:
+                    topic_length = struct.unpack("!H", body[:2])[0]
+                    topic = body[2:2 + topic_length].decode()
+                    offset = 2 + topic_length
+
+                    if (flags >> 1) & 3:
+                        writer.write(bytes([PUBACK << 4, 2]) + body[offset:offset + 2])
+                        offset += 2
+
+                    if topic.endswith("/request"):
+                        self.handle_request(topic, body[offset:])
+
+                elif packet_type == SUBSCRIBE:
+                    packet_id, requested = body[:2], parse_topics(body[2:], with_qos=True)
+                    for topic in requested:
+                        topics.add(topic)
+                        self.subscriptions.setdefault(topic, set()).add(writer)
+                    writer.write(encode_packet(SUBACK, 0, packet_id + bytes(len(requested))))
+
+                elif packet_type == UNSUBSCRIBE:
+                    for topic in parse_topics(body[2:], with_qos=False):
+                        self.subscriptions.get(topic, set()).discard(writer)
+                    writer.write(encode_packet(UNSUBACK, 0, body[:2]))
+
+                elif packet_type == PINGREQ:
+                    writer.write(bytes([PINGRESP << 4, 0]))
+
+                elif packet_type == DISCONNECT:
+                    return
+
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if expiry_handle is not None:
+                expiry_handle.cancel()
+            for topic in topics:
+                self.subscriptions.get(topic, set()).discard(writer)
+            writer.close()
+
+    async def simulate(self):
+        # Each printer sends a delta every interval, spread over the interval
+        printers = list(self.printers.values())
+        if len(printers) == 0:
+            return
+
+        while True:
+            for printer in printers:
+                self.publish(f"device/{printer.device_id}/report", printer.step())
+                await asyncio.sleep(self.interval / len(printers))
+
+    async def start(self, http_port: int, mqtt_port: int):
+        runner = web.AppRunner(self.make_app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "localhost", http_port).start()
+
+        self.mqtt_server = await asyncio.start_server(self.handle_mqtt, "localhost", mqtt_port)
+        self.runner = runner
+        self.tasks.append(asyncio.create_task(self.simulate()))
+
+    def stop_simulation(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def stop(self):
+        self.stop_simulation()
+
+        self.mqtt_server.close()
+        await self.runner.cleanup()
+
+
+async def read_packet(reader: asyncio.StreamReader):
+    header = (await reader.readexactly(1))[0]
+
+    # The remaining length is a variable length integer
+    length, multiplier = 0, 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 127) * multiplier
+        multiplier *= 128
+        if byte < 128:
+            break
+
+    return header >> 4, header & 15, await reader.readexactly(length)
+
+
+def encode_packet(packet_type: int, flags: int, body: bytes):
+    length = bytearray()
+    remaining = len(body)
+
+    while True:
+        byte, remaining = remaining % 128, remaining // 128
+        length.append(byte | (128 if remaining > 0 else 0))
+        if remaining == 0:
+            break
+
+    return bytes([packet_type << 4 | flags]) + bytes(length) + body
+
+
+def encode_publish(topic: str, payload: bytes):
+    topic = topic.encode()
+    return encode_packet(PUBLISH, 0, struct.pack("!H", len(topic)) + topic + payload)
+
+
+def read_string(body: bytes, offset: int):
+    length = struct.unpack("!H", body[offset:offset + 2])[0]
+    return body[offset + 2:offset + 2 + length], offset + 2 + length
+
+
+def parse_connect(body: bytes):
+    # Get the username and password from a CONNECT packet
+    _, offset = read_string(body, 0)
+    flags = body[offset + 1]
+    offset += 4
+
+    _, offset = read_string(body, offset)  # Client id
+
+    if flags & 0x04:
+        _, offset = read_string(body, offset)  # Will topic
+        _, offset = read_string(body, offset)  # Will message
+
+    username = password = None
+    if flags & 0x80:
+        username, offset = read_string(body, offset)
+        username = username.decode()
+    if flags & 0x40:
+        password, offset = read_string(body, offset)
+        password = password.decode()
+
+    return username, password
+
+
+def parse_topics(body: bytes, with_qos: bool):
+    topics = []
+    offset = 0
+
+    while offset < len(body):
+        topic, offset = read_string(body, offset)
+        topics.append(topic.decode())
+        if with_qos:
+            offset += 1
+
+    return topics
+
+
+async def measure_loop_lag(samples: list):
+    # How late the event loop runs a 100ms sleep, while the service is busy
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(0.1)
+        samples.append(time.perf_counter() - start - 0.1)
+
+
+async def run_load(cloud: MockBambuCloud, args):
+    from db_schema import MongoDB
+
+    client = BambuClient("mock@example.com", "mock", f"http://localhost:{args.http_port}",
+                         f"http://localhost:{args.http_port}/api/sign-in/form", devices_ttl=60)
+    service = printers.PrinterTelemetryService(client, "localhost", args.mqtt_port, False)
+
+    # Count the writes the service makes
+    writes = 0
+    write_printer = service.write_printer
+
+    async def counted_write_printer(db, printer):
+        nonlocal writes
+        writes += 1
+        await write_printer(db, printer)
+
+    service.write_printer = counted_write_printer
+
+    lag = []
+    lag_task = asyncio.create_task(measure_loop_lag(lag))
+
+    service.start()
+    await asyncio.sleep(args.load)
+
+    # Stop the printers, then make sure the service has their final state,
+    # even if it was reconnecting when they stopped
+    cloud.stop_simulation()
+    while service.connected_at is None:
+        await asyncio.sleep(0.1)
+    await service.refresh_devices()
+    await asyncio.sleep(1)
+
+    await service.stop()
+    await client.close()
+    lag_task.cancel()
+
+    # The stored state should match the printers, apart from temperatures
+    # which are only written once they've changed enough
+    db = MongoDB()
+    collection = await db.get_collection("printer_logs")
+    stored = {log["printer_name"]: log for log in await collection.find({"printer_name": {"$regex": f"^{PRINTER_PREFIX}"}}).to_list(None)}
+
+    mismatches = []
+    for printer in cloud.printers.values():
+        log = stored.get(printer.name)
+        printer_json = (log or {}).get("printer_json") or {}
+
+        for field in ("gcode_state", "subtask_name", "mc_percent", "layer_num"):
+            if printer_json.get(field) != printer.state[field]:
+                mismatches.append(f"{printer.name} {field}: stored {printer_json.get(field)}, expected {printer.state[field]}")
+
+        if "net" in printer_json or "upgrade_state" in printer_json:
+            mismatches.append(f"{printer.name} stored private fields")
+
+    long_term_logs = await db.get_collection("printer_long_term_logs")
+    long_term_count = await long_term_logs.count_documents({"printer_name": {"$regex": f"^{PRINTER_PREFIX}"}})
+
+    await collection.delete_many({"printer_name": {"$regex": f"^{PRINTER_PREFIX}"}})
+    await long_term_logs.delete_many({"printer_name": {"$regex": f"^{PRINTER_PREFIX}"}})
+
+    stats = cloud.stats
+    lag.sort()
+    print(f"{len(cloud.printers)} printers for {args.load}s, a delta every {args.interval}s each")
+    print(f"    reports sent      {stats.reports} ({stats.reports / args.load:.1f}/s)")
+    print(f"    printer_logs      {writes} writes ({writes / max(1, stats.reports):.1%} of reports), {long_term_count} long term logs")
+    print(f"    logins            {stats.logins}, refreshes {stats.refreshes}, device list requests {stats.device_requests}, rejected {stats.rejected}")
+    print(f"    mqtt connections  {stats.mqtt_connections}")
+    if lag:
+        print(f"    event loop lag    median {lag[len(lag) // 2] * 1000:.1f} ms, max {lag[-1] * 1000:.1f} ms")
+
+    if mismatches:
+        print("\n".join(mismatches))
+        sys.exit(1)
+
+    print("Stored printer state matches")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Bambu cloud")
+    parser.add_argument("--http-port", type=int, default=8765)
+    parser.add_argument("--mqtt-port", type=int, default=1884)
+    parser.add_argument("--printers", type=int, default=10, help="number of simulated printers")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between each printer's reports")
+    parser.add_argument("--token-lifetime", type=float, default=3600, help="seconds access tokens are valid for")
+    parser.add_argument("--load", type=float, default=None, metavar="SECONDS", help="run the telemetry service against the mock for this long")
+    args = parser.parse_args()
+
+    cloud = MockBambuCloud(args.printers, args.interval, args.token_lifetime)
+    await cloud.start(args.http_port, args.mqtt_port)
+    print(f"Mock Bambu cloud on http://localhost:{args.http_port} and mqtt://localhost:{args.mqtt_port}")
+
+    try:
+        if args.load is not None:
+            await run_load(cloud, args)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await cloud.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
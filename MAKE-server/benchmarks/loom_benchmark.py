@@ -0,0 +1,242 @@
+'''
+Benchmark for machines.loom, timing each stage of a render and checking
+the results against golden hashes, so optimizations can be shown to be
+both equivalent and faster.
+
+Run from MAKE-server (it needs config.py):
+
+    python benchmarks/loom_benchmark.py                 # all synthetic images
+    python benchmarks/loom_benchmark.py --quick         # skip the largest ones
+    python benchmarks/loom_benchmark.py --images a.jpg  # also time real images
+    python benchmarks/loom_benchmark.py --update-golden # after an intended change
+
+Synthetic images are generated deterministically in gradient, noise and
+line art styles for loom widths from 600 to 2640 pixels and heights up to
+10000 rows. Golden hashes are of the rendered pixels rather than the png,
+so they don't depend on the zlib version. Exits with 1 on a mismatch.
+'''
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import PIL.Image
+import PIL.ImageDraw
+import PIL.ImageOps
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from machines import loom
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loom_golden.json")
+
+LOOM_WIDTHS = [600, 1320, 2640]
+HEIGHTS = [500, 2500, 10000]
+QUICK_MAX_HEIGHT = 2500
+STYLES = ["gradient", "noise", "line_art"]
+TABBY_WIDTH = 10
+STAGES = ["decode", "resize", "center", "dither", "invert", "correct_image", "tabby", "png_encode"]
+
+
+def make_image(style: str, width: int, height: int):
+    # Make a deterministic grayscale test image
+    rng = np.random.default_rng(width * 100003 + height)
+
+    if style == "gradient":
+        x = np.linspace(0, 1, width)[np.newaxis, :]
+        y = np.linspace(0, 1, height)[:, np.newaxis]
+        pixels = (255 * (0.5 + 0.5 * np.sin(6 * x + 3 * y) * np.cos(4 * y))).astype(np.uint8)
+        return PIL.Image.fromarray(pixels)
+
+    if style == "noise":
+        return PIL.Image.fromarray(rng.integers(0, 256, (height, width), dtype=np.uint8))
+
+    if style == "line_art":
+        image = PIL.Image.new("L", (width, height), 255)
+        draw = PIL.ImageDraw.Draw(image)
+
+        for _ in range(max(20, width * height // 20000)):
+            x0, x1 = rng.integers(0, width, 2)
+            y0, y1 = rng.integers(0, height, 2)
+            draw.line([(int(x0), int(y0)), (int(x1), int(y1))], fill=0, width=int(rng.integers(1, 8)))
+
+        return image
+
+    raise ValueError(f"Unknown style {style}")
+
+
+def encode_image(image):
+    data = io.BytesIO()
+    image.save(data, format="png")
+    return data.getvalue()
+
+
+def synthetic_cases(quick: bool):
+    # Source images are 1.5 times the render size, so they're resized
+    for style in STYLES:
+        for loom_width in LOOM_WIDTHS:
+            for height in HEIGHTS:
+                if quick and height > QUICK_MAX_HEIGHT:
+                    continue
+
+                yield {
+                    "name": f"{style}-{loom_width}x{height}",
+                    "image": lambda style=style, loom_width=loom_width, height=height: make_image(style, loom_width * 3 // 2, height * 3 // 2),
+                    "loom_width": loom_width,
+                    "desired_height": height,
+                    "invert": style == "line_art",
+                }
+
+
+def file_cases(paths):
+    for path in paths:
+        yield {
+            "name": os.path.basename(path),
+            "image": lambda path=path: PIL.Image.open(path),
+            "loom_width": 1320,
+            "desired_height": 0,
+            "invert": False,
+        }
+
+
+def render_stages(img_data: bytes, loom_width: int, desired_height: int, invert: bool):
+    # Render like machines.loom.render_loom_image, timing every stage
+    timings = {}
+
+    def timed(stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        timings[stage] = time.perf_counter() - start
+        return result
+
+    def decode():
+        image = PIL.Image.open(io.BytesIO(img_data))
+        image.load()
+        return image
+
+    image = timed("decode", decode)
+    image = timed("resize", loom.resize_for_loom, image, loom_width, desired_height)
+    image, min_tabby_width = timed("center", loom.center_on_loom, image, loom_width)
+    image = timed("dither", lambda: image.convert("1", dither=PIL.Image.FLOYDSTEINBERG))
+    image = timed("invert", lambda: PIL.ImageOps.invert(image) if invert else image)
+    image = timed("correct_image", loom.correct_image, image)
+
+    tabby_width = max(min_tabby_width, TABBY_WIDTH)
+    image = timed("tabby", loom.add_tabby, image, tabby_width)
+    png = timed("png_encode", encode_image, image)
+
+    return image, png, timings
+
+
+def pixel_hash(image):
+    return hashlib.sha256(f"{image.mode} {image.width}x{image.height} ".encode() + image.tobytes()).hexdigest()
+
+
+def run_case(case: dict):
+    img_data = encode_image(case["image"]())
+
+    image, png, timings = render_stages(img_data, case["loom_width"], case["desired_height"], case["invert"])
+
+    # The full render path, with its caches emptied so nothing is reused
+    loom.render_cache.clear()
+    loom.stage_cache.clear()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    rendered = loom.render_loom_image(img_data, case["loom_width"], case["desired_height"], case["invert"], TABBY_WIDTH)
+    total = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    loom.render_cache.clear()
+    loom.stage_cache.clear()
+
+    # The staged render has to match the real one
+    rendered_image = PIL.Image.open(io.BytesIO(rendered))
+    if pixel_hash(rendered_image.convert("1")) != pixel_hash(image):
+        raise AssertionError(f"{case['name']}: staged render differs from render_loom_image")
+
+    return {
+        "name": case["name"],
+        "pixels": image.width * image.height,
+        "timings": timings,
+        "total": total,
+        "peak_bytes": peak,
+        "png_bytes": len(png),
+        "hash": pixel_hash(image),
+    }
+
+
+def print_result(result: dict):
+    megapixels = result["pixels"] / 1e6
+    stages = " ".join(f"{stage}={result['timings'][stage] * 1000:.1f}" for stage in STAGES)
+
+    print(
+        f"{result['name']:<24} {megapixels:6.2f} MP  total {result['total'] * 1000:8.1f} ms"
+        f"  {megapixels / result['total']:6.1f} MP/s  peak {result['peak_bytes'] / 2**20:6.1f} MiB"
+    )
+    print(f"    stages (ms): {stages}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark loom renders and check them against golden hashes")
+    parser.add_argument("--quick", action="store_true", help=f"skip images taller than {QUICK_MAX_HEIGHT} rows")
+    parser.add_argument("--images", nargs="*", default=[], help="real images to time as well, they have no golden hashes")
+    parser.add_argument("--update-golden", action="store_true", help="write the synthetic render hashes as the new golden hashes")
+    args = parser.parse_args()
+
+    golden = {}
+    if os.path.exists(GOLDEN_PATH):
+        with open(GOLDEN_PATH) as f:
+            golden = json.load(f)
+
+    mismatches = []
+    totals = {stage: 0.0 for stage in STAGES}
+    total_pixels = 0
+
+    for case in synthetic_cases(args.quick):
+        result = run_case(case)
+        print_result(result)
+
+        total_pixels += result["pixels"]
+        for stage in STAGES:
+            totals[stage] += result["timings"][stage]
+
+        if args.update_golden:
+            golden[result["name"]] = result["hash"]
+        elif golden.get(result["name"]) != result["hash"]:
+            mismatches.append(result["name"])
+            print(f"    MISMATCH: expected {golden.get(result['name'])}, got {result['hash']}")
+
+    for case in file_cases(args.images):
+        print_result(run_case(case))
+
+    total_time = sum(totals.values())
+    print()
+    print(f"Synthetic total: {total_pixels / 1e6:.1f} MP in {total_time:.2f} s ({total_pixels / 1e6 / total_time:.1f} MP/s)")
+    for stage in STAGES:
+        print(f"    {stage:<14} {totals[stage]:8.3f} s  {100 * totals[stage] / total_time:5.1f}%")
+
+    if args.update_golden:
+        with open(GOLDEN_PATH, "w") as f:
+            json.dump(golden, f, indent=4, sort_keys=True)
+            f.write("\n")
+
+        print(f"Wrote {len(golden)} golden hashes to {GOLDEN_PATH}")
+        return
+
+    if len(mismatches) > 0:
+        print(f"{len(mismatches)} renders don't match their golden hashes: {', '.join(mismatches)}")
+        sys.exit(1)
+
+    print("All renders match their golden hashes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+'''
+Checks machines.loom.correct_image and add_tabby against golden hashes of
+a corpus of small 1-bit images, so the loom filter and tabby can be
+verified on their own, without resizing, dithering or png encoding.
+
+Run from MAKE-server (it needs config.py):
+
+    python benchmarks/loom_correction_check.py                  # check against the golden hashes
+    python benchmarks/loom_correction_check.py --update-golden  # after an intended change
+
+The golden hashes are made with the original pixel by pixel filter and
+tabby, kept below as the reference, not with the code being checked.
+Runs of pixels are corrected in chunks of rows, so every image is also
+checked with chunks of a few rows. Exits with 1 on a mismatch.
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+import PIL.Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from machines import loom
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loom_correction_golden.json")
+
+TABBY_WIDTHS = [1, 2, 5, 10]
+# Small enough that most images are corrected in several chunks
+SMALL_CHUNK_PIXELS = 64
+
+
+def make_image(style: str, width: int, height: int, density: float = 0.5):
+    # Make a deterministic 1-bit test image, True is white
+    rng = np.random.default_rng(width * 100003 + height * 101 + int(density * 100))
+
+    if style == "noise":
+        pixels = rng.random((height, width)) < density
+    elif style == "white":
+        pixels = np.ones((height, width), dtype=bool)
+    elif style == "black":
+        pixels = np.zeros((height, width), dtype=bool)
+    elif style == "stripes":
+        # Bands of random widths, across rows and down columns, so runs
+        # of every length meet the edges and each other
+        rows = (rng.random(height) < 0.5)[:, np.newaxis]
+        bands = np.cumsum(rng.integers(1, 15, width)) % 2 == 0
+        pixels = rows ^ bands[np.newaxis, :]
+    else:
+        raise ValueError(f"Unknown style {style}")
+
+    return PIL.Image.fromarray(pixels)
+
+
+def corpus():
+    # Name and image of every case
+    for width, height in [(37, 23), (300, 200), (1320, 60)]:
+        for density in [0.1, 0.5, 0.9]:
+            yield f"noise-{density}-{width}x{height}", make_image("noise", width, height, density)
+
+    for width, height in [(64, 64), (1, 50), (50, 1), (7, 7)]:
+        for style in ["white", "black", "noise"]:
+            yield f"{style}-{width}x{height}", make_image(style, width, height)
+
+    for width, height in [(40, 40), (257, 129)]:
+        yield f"stripes-{width}x{height}", make_image("stripes", width, height)
+
+
+def reference_correct_image(image):
+    # The original loom filter, one pixel at a time
+    image = image.copy()
+    width, height = image.size
+
+    # Correct the rows
+    for y in range(height):
+        consecutive_white_pixels = 0
+        for x in range(width):
+            if image.getpixel((x, y)) == 255:
+                consecutive_white_pixels += 1
+                if consecutive_white_pixels > 5:
+                    if y % 2 == 0:
+                        image.putpixel((x, y), 0)
+                    else:
+                        image.putpixel((x - 1, y), 0)
+                    consecutive_white_pixels = 1
+            else:
+                consecutive_white_pixels = 0
+
+    # Correct the columns
+    for x in range(width):
+        consecutive_black_pixels = 0
+        for y in range(height):
+            if image.getpixel((x, y)) == 0:
+                consecutive_black_pixels += 1
+                if consecutive_black_pixels > 5:
+                    if x % 2 == 0:
+                        image.putpixel((x, y), 255)
+                    else:
+                        image.putpixel((x, y - 1), 255)
+                    consecutive_black_pixels = 1
+            else:
+                consecutive_black_pixels = 0
+
+    return image
+
+
+def reference_add_tabby(image, tabby_width: int):
+    # The original tabby, one pixel at a time
+    image = image.copy()
+
+    for row in range(image.height):
+        base = row % 2 == 0
+
+        for i in range(tabby_width):
+            pixel = i % 2 == 0 if base else i % 2 == 1
+
+            image.putpixel((i, row), 255 if pixel else 0)
+            image.putpixel((image.width - i - 1, row), 255 if pixel else 0)
+
+    return image
+
+
+def pixel_hash(image):
+    return hashlib.sha256(f"{image.mode} {image.width}x{image.height} ".encode() + image.tobytes()).hexdigest()
+
+
+def run_case(image, correct_image, add_tabby):
+    # Hashes of the corrected image, and of it with each tabby width that fits
+    corrected = correct_image(image)
+    hashes = {"correct_image": pixel_hash(corrected)}
+
+    for tabby_width in TABBY_WIDTHS:
+        if tabby_width <= image.width:
+            hashes[f"tabby-{tabby_width}"] = pixel_hash(add_tabby(corrected, tabby_width))
+
+    return hashes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the loom filter and tabby against golden hashes")
+    parser.add_argument("--update-golden", action="store_true", help="write the reference hashes as the new golden hashes")
+    args = parser.parse_args()
+
+    if args.update_golden:
+        golden = {name: run_case(image, reference_correct_image, reference_add_tabby) for name, image in corpus()}
+
+        with open(GOLDEN_PATH, "w") as f:
+            json.dump(golden, f, indent=4, sort_keys=True)
+            f.write("\n")
+
+        print(f"Wrote golden hashes for {len(golden)} images to {GOLDEN_PATH}")
+        return
+
+    with open(GOLDEN_PATH) as f:
+        golden = json.load(f)
+
+    mismatches = []
+    default_chunk_pixels = loom.RUN_CHUNK_PIXELS
+
+    for name, image in corpus():
+        for chunk_pixels in [default_chunk_pixels, SMALL_CHUNK_PIXELS]:
+            loom.RUN_CHUNK_PIXELS = chunk_pixels
+            hashes = run_case(image, loom.correct_image, loom.add_tabby)
+
+            for check, expected in golden.get(name, {"correct_image": None}).items():
+                if hashes.get(check) != expected:
+                    mismatches.append(f"{name} {check} (chunks of {chunk_pixels} pixels)")
+                    print(f"MISMATCH {name} {check} with chunks of {chunk_pixels} pixels: expected {expected}, got {hashes.get(check)}")
+
+    loom.RUN_CHUNK_PIXELS = default_chunk_pixels
+
+    if len(mismatches) > 0:
+        print(f"{len(mismatches)} checks don't match their golden hashes")
+        sys.exit(1)
+
+    print(f"All {len(golden)} images match their golden hashes")
+
+
+if __name__ == "__main__":
+    main()
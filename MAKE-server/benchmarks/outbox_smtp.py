@@ -0,0 +1,142 @@
+'''
+A local SMTP stand-in for the email outbox, built on aiosmtpd
+(pip install aiosmtpd), so email can be tested and load-tested offline.
+It accepts any login, and can reject a fraction of messages with a
+temporary error to exercise retries.
+
+Run from MAKE-server (it needs config.py):
+
+    python benchmarks/outbox_smtp.py                     # just serve the stand-in
+    python benchmarks/outbox_smtp.py --load 500          # send 500 emails through the outbox
+    python benchmarks/outbox_smtp.py --load 500 --fail-rate 0.2
+
+To run the server against the stand-in, set these in config.py:
+
+    SMTP_HOST = "localhost"
+    SMTP_PORT = 8025
+    SMTP_USE_SSL = False
+
+--load queues emails (with subjects starting outbox-load-) in the
+configured database, so use a development database. They are deleted
+afterwards. Exits with 1 unless every email is delivered exactly once.
+'''
+
+import argparse
+import asyncio
+import email
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from misc import outbox as outbox_module
+
+SUBJECT_PREFIX = "outbox-load-"
+
+
+class RecordingHandler:
+    '''
+    Records the subject of every delivered message, rejecting
+    fail_rate of them with a temporary error.
+    '''
+
+    def __init__(self, fail_rate: float):
+        self.fail_rate = fail_rate
+        self.rng = random.Random(0)
+        self.subjects = Counter()
+        self.rejected = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.rng.random() < self.fail_rate:
+            self.rejected += 1
+            return "451 Try again later"
+
+        message = email.message_from_bytes(envelope.content)
+        self.subjects[message["Subject"]] += 1
+        return "250 OK"
+
+
+def accept_any_login(server, session, envelope, mechanism, auth_data):
+    return AuthResult(success=True)
+
+
+async def run_load(handler: RecordingHandler, args):
+    from db_schema import MongoDB
+
+    # Retry quickly, the stand-in's failures are only simulated
+    outbox_module.RETRY_BACKOFF_SECONDS = 0.05
+    outbox_module.POLL_INTERVAL_SECONDS = 0.1
+    outbox_module.MAX_ATTEMPTS = 20
+
+    outbox = outbox_module.Outbox(args.workers, "localhost", args.port, False)
+
+    db = MongoDB()
+    collection = await db.get_collection("outbox")
+
+    start = time.perf_counter()
+    for i in range(args.load):
+        await outbox.enqueue(f"user{i}@example.com", [], f"{SUBJECT_PREFIX}{i}", f"<p>Message {i}</p>")
+    queued = time.perf_counter() - start
+
+    await outbox.start()
+
+    # Wait for the outbox to empty
+    query = {"subject": {"$regex": f"^{SUBJECT_PREFIX}"}, "status": {"$in": ["pending", "sending"]}}
+    while await collection.count_documents(query) > 0:
+        await asyncio.sleep(0.1)
+
+    sent = time.perf_counter() - start - queued
+    await outbox.stop()
+
+    failed = await collection.count_documents({"subject": {"$regex": f"^{SUBJECT_PREFIX}"}, "status": "failed"})
+    await collection.delete_many({"subject": {"$regex": f"^{SUBJECT_PREFIX}"}})
+
+    expected = {f"{SUBJECT_PREFIX}{i}" for i in range(args.load)}
+    missing = expected - set(handler.subjects)
+    duplicates = [subject for subject, count in handler.subjects.items() if count > 1]
+
+    print(f"{args.load} emails with {args.workers} workers")
+    print(f"    queued in         {queued:.2f} s ({args.load / queued:.0f}/s)")
+    print(f"    sent in           {sent:.2f} s ({args.load / sent:.0f}/s)")
+    print(f"    rejected attempts {handler.rejected}, gave up on {failed}")
+
+    if missing or duplicates:
+        print(f"{len(missing)} emails weren't delivered, {len(duplicates)} were delivered more than once")
+        sys.exit(1)
+
+    print("Every email was delivered once")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Serve a local SMTP stand-in for the email outbox")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--no-auth", action="store_true", help="don't offer AUTH, like a bare local relay")
+    parser.add_argument("--fail-rate", type=float, default=0, help="fraction of messages rejected with a temporary error")
+    parser.add_argument("--load", type=int, default=None, metavar="EMAILS", help="send this many emails through the outbox")
+    parser.add_argument("--workers", type=int, default=outbox_module.EMAIL_WORKERS)
+    args = parser.parse_args()
+
+    handler = RecordingHandler(args.fail_rate)
+
+    auth = {} if args.no_auth else {"authenticator": accept_any_login, "auth_require_tls": False}
+    controller = Controller(handler, hostname="localhost", port=args.port, **auth)
+    controller.start()
+    print(f"SMTP stand-in on localhost:{args.port}")
+
+    try:
+        if args.load is not None:
+            await run_load(handler, args)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        controller.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,253 @@
+'''
+A local stand-in for the published Google Sheets of quiz responses, serving
+the fixture CSVs in benchmarks/fixtures/quizzes, so quiz scraping can be
+tested offline. The gid of each sheet is its file name. Sheets are sent with
+an ETag and Last-Modified, and answer matching conditional GETs with 304,
+unless --no-conditional is given (Google doesn't always send them), which
+leaves unchanged sheets to the content hash.
+
+Run from MAKE-server (it needs config.py):
+
+    python benchmarks/quiz_sheets.py                   # just serve the sheets
+    python benchmarks/quiz_sheets.py --check           # scrape them and check the results
+    python benchmarks/quiz_sheets.py --check --rows 200000
+
+To scrape the fixtures from the server, set these in config.py:
+
+    QUIZ_SHEET_URL = "http://localhost:8767/sheet?gid={gid}"
+    QUIZ_IDS = {"General": "fixture-general", "Loom": "fixture-loom"}
+
+--check scrapes every fixture with and without conditional GETs, checks
+what is stored, edits a sheet and checks that only the edit is written.
+--rows adds a generated sheet of that many responses and reports the peak
+memory of scraping it. Results are written to the configured database
+(with gids starting fixture-), so use a development database. They are
+deleted afterwards. Exits with 1 if a check fails.
+'''
+
+import argparse
+import asyncio
+import hashlib
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from email.utils import formatdate
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from users import quizzes
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "quizzes")
+GID_PREFIX = "fixture-"
+LARGE_GID = "fixture-large"
+
+
+def load_fixtures():
+    sheets = {}
+
+    for name in sorted(os.listdir(FIXTURES_DIR)):
+        if name.endswith(".csv"):
+            with open(os.path.join(FIXTURES_DIR, name), "rb") as f:
+                sheets[name.removesuffix(".csv")] = f.read()
+
+    return sheets
+
+
+def make_large_sheet(rows: int):
+    # A sheet of distinct responses, a minute apart
+    start = datetime(2025, 9, 1)
+    lines = [b"Timestamp,Score,Name,CX ID,Email Address"]
+
+    for i in range(rows):
+        timestamp = (start + timedelta(minutes=i)).strftime("%m/%d/%Y %H:%M:%S")
+        lines.append(f"{timestamp},10 / 10,Student {i},{40000000 + i},student{i}@g.hmc.edu".encode())
+
+    return b"\r\n".join(lines) + b"\r\n"
+
+
+class SheetServer:
+    '''
+    Serves CSV sheets by gid, which can be edited while it runs.
+    '''
+
+    def __init__(self, sheets: dict, conditional: bool):
+        self.sheets = sheets
+        self.modified = {gid: time.time() for gid in sheets}
+        self.conditional = conditional
+        self.requests = 0
+        self.not_modified = 0
+
+    def set_sheet(self, gid: str, data: bytes):
+        self.sheets[gid] = data
+        # Last-Modified has a resolution of a second
+        self.modified[gid] = max(time.time(), self.modified.get(gid, 0) + 1)
+
+    async def sheet(self, request: web.Request):
+        self.requests += 1
+        gid = request.query.get("gid")
+
+        if gid not in self.sheets:
+            raise web.HTTPNotFound()
+
+        data = self.sheets[gid]
+        headers = {}
+
+        if self.conditional:
+            etag = f'"{hashlib.sha256(data).hexdigest()[:32]}"'
+            headers = {"ETag": etag, "Last-Modified": formatdate(self.modified[gid], usegmt=True)}
+
+            if request.headers.get("If-None-Match") == etag:
+                self.not_modified += 1
+                return web.Response(status=304, headers=headers)
+
+        return web.Response(body=data, headers=headers, content_type="text/csv")
+
+    async def start(self, port: int):
+        app = web.Application()
+        app.router.add_get("/sheet", self.sheet)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "localhost", port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class Checks:
+    def __init__(self):
+        self.failures = []
+
+    def expect(self, description: str, actual, expected):
+        if actual == expected:
+            print(f"    ok    {description}")
+        else:
+            print(f"    FAIL  {description}: expected {expected}, got {actual}")
+            self.failures.append(description)
+
+
+def count_rows(data: bytes):
+    # Distinct responses in a sheet, duplicates in the fixtures are whole rows
+    lines = data.decode().splitlines()[1:]
+    return len(set(lines))
+
+
+async def scrape(session: aiohttp.ClientSession, gid: str):
+    return await quizzes.scrape_quiz(session, gid, quizzes.get_quizzes_valid_after())
+
+
+async def run_checks(server: SheetServer, checks: Checks, conditional: bool):
+    from db_schema import MongoDB
+
+    collection = await MongoDB().get_collection("quizzes")
+    await collection.delete_many({"gid": {"$regex": f"^{GID_PREFIX}"}})
+    quizzes.quiz_sheet_state.clear()
+
+    # Start from the fixtures, undoing the edit of an earlier run
+    for gid, data in load_fixtures().items():
+        server.set_sheet(gid, data)
+
+    server.conditional = conditional
+    label = "conditional GET" if conditional else "content hash"
+    print(f"Scraping with {label}:")
+
+    gids = [gid for gid in server.sheets if gid != LARGE_GID]
+
+    async with aiohttp.ClientSession() as session:
+        for gid in gids:
+            responses, counts = await scrape(session, gid)
+            stored = await collection.count_documents({"gid": gid})
+            checks.expect(f"{gid} stores each distinct response", stored, count_rows(server.sheets[gid]))
+            checks.expect(f"{gid} inserts all of them", counts["inserted"], stored)
+
+        # Unchanged sheets are skipped, by 304 or by hash
+        not_modified = server.not_modified
+        for gid in gids:
+            checks.expect(f"{gid} is skipped when unchanged", await scrape(session, gid), None)
+
+        if conditional:
+            checks.expect("unchanged sheets are answered with 304", server.not_modified - not_modified, len(gids))
+
+        # Edit a sheet, dropping its last response and changing the first score
+        gid = gids[0]
+        lines = server.sheets[gid].decode().splitlines()
+        header, first, rest = lines[0], lines[1], lines[2:-1]
+        fields = first.split(",")
+        fields[1] = "0 / 10"
+        server.set_sheet(gid, "\n".join([header, ",".join(fields)] + rest).encode() + b"\n")
+
+        responses, counts = await scrape(session, gid)
+        checks.expect(f"{gid} only writes the edit", counts, {"inserted": 0, "updated": 1, "removed": 1})
+        checks.expect(f"{gid} stores the edited sheet", await collection.count_documents({"gid": gid}), count_rows(server.sheets[gid]))
+
+    await collection.delete_many({"gid": {"$regex": f"^{GID_PREFIX}"}})
+
+
+async def run_large(server: SheetServer, checks: Checks, rows: int):
+    from db_schema import MongoDB
+
+    collection = await MongoDB().get_collection("quizzes")
+    await collection.delete_many({"gid": LARGE_GID})
+    quizzes.quiz_sheet_state.clear()
+
+    server.set_sheet(LARGE_GID, make_large_sheet(rows))
+    print(f"Scraping {rows} responses ({len(server.sheets[LARGE_GID]) / 2**20:.1f} MiB):")
+
+    async with aiohttp.ClientSession() as session:
+        tracemalloc.start()
+        start = time.perf_counter()
+        responses, counts = await scrape(session, LARGE_GID)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    print(f"    {elapsed:.2f} s ({responses / elapsed:.0f} responses/s), peak {peak / 2**20:.1f} MiB")
+    checks.expect(f"{LARGE_GID} stores every response", await collection.count_documents({"gid": LARGE_GID}), rows)
+
+    await collection.delete_many({"gid": LARGE_GID})
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Serve the quiz fixture sheets")
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--no-conditional", action="store_true", help="don't send ETag or Last-Modified")
+    parser.add_argument("--rows", type=int, default=0, help="also serve a generated sheet with this many responses")
+    parser.add_argument("--check", action="store_true", help="scrape the sheets and check the results")
+    args = parser.parse_args()
+
+    server = SheetServer(load_fixtures(), not args.no_conditional)
+    if args.rows > 0:
+        server.set_sheet(LARGE_GID, make_large_sheet(args.rows))
+
+    await server.start(args.port)
+    print(f"Quiz sheets on http://localhost:{args.port}/sheet?gid=<gid>: {', '.join(server.sheets)}")
+
+    try:
+        if not args.check:
+            await asyncio.Event().wait()
+
+        quizzes.QUIZ_SHEET_URL = f"http://localhost:{args.port}/sheet?gid={{gid}}"
+        checks = Checks()
+
+        await run_checks(server, checks, conditional=True)
+        await run_checks(server, checks, conditional=False)
+
+        if args.rows > 0:
+            await run_large(server, checks, args.rows)
+
+        if checks.failures:
+            print(f"{len(checks.failures)} checks failed")
+            sys.exit(1)
+
+        print("All checks passed")
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
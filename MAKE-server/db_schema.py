@@ -2,34 +2,114 @@ from typing import Any, Dict, List, Optional
 from bson import ObjectId
 from pydantic import ConfigDict, BaseModel, Field, GetCoreSchemaHandler
 import motor.motor_asyncio
+from pymongo import ASCENDING, IndexModel
 from typing import Union
 
 from pydantic_core import CoreSchema, core_schema
 
-from config import DB_NAME
+from config import DB_NAME, DB_MAX_POOL_SIZE, DB_MIN_POOL_SIZE, DB_MAX_IDLE_TIME_MS
+
+# A single client (and so a single connection pool) is shared by the whole
+# process. It is created lazily so it binds to the event loop that first uses it.
+_client: Union[motor.motor_asyncio.AsyncIOMotorClient, None] = None
+
+# Names of the collections in the database, resolved once at startup by
+# validate_database_schema and kept up to date by create/drop_collection,
+# along with cached handles so get_collection never needs a round-trip
+_collection_names: Union[set, None] = None
+_collection_handles: Dict[str, motor.motor_asyncio.AsyncIOMotorCollection] = {}
+
+
+def get_client() -> motor.motor_asyncio.AsyncIOMotorClient:
+    # Get the process-wide client, creating it if it doesn't exist yet
+    global _client
+
+    if _client is None:
+        _client = motor.motor_asyncio.AsyncIOMotorClient(
+            "mongodb://127.0.0.1:27017",
+            maxPoolSize=DB_MAX_POOL_SIZE,
+            minPoolSize=DB_MIN_POOL_SIZE,
+            maxIdleTimeMS=DB_MAX_IDLE_TIME_MS,
+        )
+
+    return _client
+
+
+def close_client():
+    # Close the process-wide client, a new one is created on next use
+    global _client
+
+    if _client is not None:
+        _client.close()
+        _client = None
+
+    # Cached handles belong to the old client
+    _collection_handles.clear()
+
+
+def set_collection_names(names: List[str]):
+    # Replace the cached set of collection names
+    global _collection_names
+
+    _collection_names = set(names)
+    _collection_handles.clear()
 
 
 class MongoDB:
     def __init__(self):
-        self.client = motor.motor_asyncio.AsyncIOMotorClient(
-            "mongodb://127.0.0.1:27017"
-        )
+        # Cheap to construct, all instances share the pooled client
+        self.client = get_client()
         self.db = self.client[DB_NAME]
 
-    def __del__(self):
-        self.client.close()
-
     async def get_collection(
         self, name: str
     ) -> Union[motor.motor_asyncio.AsyncIOMotorCollection, None]:
         # Get a collection from the database
         # Returns None if the collection does not exist
-        collections = await self.db.list_collection_names()
-        if name in collections:
-            return self.db[name]
-        else:
+        if _collection_names is None:
+            # Only hit if the schema hasn't been validated yet
+            await self.refresh_collections()
+
+        if name not in _collection_names:
             return None
 
+        if name not in _collection_handles:
+            _collection_handles[name] = self.db[name]
+
+        return _collection_handles[name]
+
+    async def refresh_collections(self):
+        # Reload the cached collection names from the server
+        set_collection_names(await self.db.list_collection_names())
+
+    async def create_collection(
+        self, name: str
+    ) -> motor.motor_asyncio.AsyncIOMotorCollection:
+        # Create a collection if it doesn't exist, and return it
+        collection = await self.get_collection(name)
+
+        if collection is None:
+            await self.db.create_collection(name)
+            _collection_names.add(name)
+            collection = await self.get_collection(name)
+
+        return collection
+
+    async def drop_collection(self, name: str):
+        # Drop a collection, removing it from the cache
+        await self.db.drop_collection(name)
+
+        if _collection_names is not None:
+            _collection_names.discard(name)
+
+        _collection_handles.pop(name, None)
+
+
+async def get_db() -> MongoDB:
+    # FastAPI dependency for routes, e.g. db: MongoDB = Depends(get_db)
+    return MongoDB()
+
+
 schema = [
     "status",
     "machines",
@@ -53,6 +133,9 @@ schema = [
     "reservations",
     "redirects",
     "certifications",
+    "outbox",
+    "cx_id_fixes",
+    "blobs",
 ]
 
 
@@ -205,6 +288,12 @@ class InventoryItem(BaseModel):
     })
 
 
+# Indexes for the inventory collection
+INVENTORY_INDEXES = [
+    IndexModel([("uuid", ASCENDING)], unique=True),
+]
+
+
 """
 The users class is used to store information about the users of the system.
 The following fields are stored:
@@ -232,6 +321,8 @@ class User(BaseModel):
     availability: Union[List[List[bool]], None] = None
     new_steward: Union[bool, None] = None
     certifications: Union[Dict[str, float], None] = None
+    # Total size of the user's files in bytes, kept up to date on upload and delete
+    storage_bytes: Union[int, None] = None
     # TODO[pydantic]: The following keys were removed: `json_encoders`.
     # Check https://docs.pydantic.dev/dev-v2/migration/#changes-to-config for more information.
     model_config = ConfigDict(arbitrary_types_allowed=True, json_encoders={ObjectId: str}, json_schema_extra={
@@ -252,23 +343,75 @@ class User(BaseModel):
         }
     })
 
+
+# Indexes for the users collection
+USER_INDEXES = [
+    IndexModel([("uuid", ASCENDING)], unique=True),
+    IndexModel([("cx_id", ASCENDING)]),
+    IndexModel([("email", ASCENDING)]),
+]
+
+
 class Certification(BaseModel):
     uuid: str
     name: str
     description: str
     seconds_valid_for: float
 
+
+# Indexes for the certifications collection
+CERTIFICATION_INDEXES = [
+    IndexModel([("uuid", ASCENDING)], unique=True),
+]
+
+
 class UserFile(BaseModel):
     uuid: str
     name: str
     timestamp: float
     size: int
     user_uuid: str
+    # sha256 of the file's data in the blob store
+    hash: Union[str, None] = None
     # TODO[pydantic]: The following keys were removed: `json_encoders`.
     # Check https://docs.pydantic.dev/dev-v2/migration/#changes-to-config for more information.
     model_config = ConfigDict(arbitrary_types_allowed=True, json_encoders={ObjectId: str})
 
 
+# Indexes for the user_files collection
+USER_FILE_INDEXES = [
+    IndexModel([("uuid", ASCENDING)], unique=True),
+    IndexModel([("user_uuid", ASCENDING)]),
+    IndexModel([("timestamp", ASCENDING)]),
+]
+
+# Indexes for the server_files collection, which holds
+# files like UserFile that aren't owned by a user
+SERVER_FILE_INDEXES = [
+    IndexModel([("uuid", ASCENDING)], unique=True),
+]
+
+
+class Blob(BaseModel):
+    # Data shared by user_files and server_files, stored once
+    # in the blob store under its sha256
+    hash: str
+    size: int
+    # Number of references from user_files and server_files
+    # documents, including the renditions of workshop photos
+    refs: int
+    timestamp: float
+    # uuids of legacy files being migrated into the store whose
+    # reference is counted, but whose document isn't updated yet
+    migrating: List[str] = []
+
+
+# Indexes for the blobs collection
+BLOB_INDEXES = [
+    IndexModel([("hash", ASCENDING)], unique=True),
+]
+
+
 """
 The restock_requests class is used to store information about the restock requests.
 The following fields are stored
@@ -317,6 +460,13 @@ class RestockRequest(BaseModel):
     })
 
 
+# Indexes for the restock_requests collection
+RESTOCK_REQUEST_INDEXES = [
+    IndexModel([("uuid", ASCENDING)], unique=True),
+    IndexModel([("item_uuid", ASCENDING), ("timestamp_completed", ASCENDING)]),
+]
+
+
 """
 The quizzes class is used to store information about the quizzes.
 The following fields are stored:
@@ -327,6 +477,8 @@ The following fields are stored:
 - CX ID: The CX ID of the user who took the quiz
 - Score: The score of the quiz
 - Passed: Whether the user passed the quiz
+- Timestamp Updated: When the response was last written by the quiz scraper
+- Original CX ID: The CX ID from the quiz, if fix_broken_cx_ids corrected it
 """
 
 
@@ -338,6 +490,8 @@ class QuizResponse(BaseModel):
     cx_id: int
     score: str
     passed: bool
+    timestamp_updated: Union[float, None] = None
+    original_cx_id: Union[int, None] = None
     # TODO[pydantic]: The following keys were removed: `json_encoders`.
     # Check https://docs.pydantic.dev/dev-v2/migration/#changes-to-config for more information.
     model_config = ConfigDict(arbitrary_types_allowed=True, json_encoders={ObjectId: str}, json_schema_extra={
@@ -353,6 +507,17 @@ class QuizResponse(BaseModel):
     })
 
 
+# Indexes for the quizzes collection
+QUIZ_RESPONSE_INDEXES = [
+    # Identity of a response, used when merging in a scraped quiz
+    IndexModel([("gid", ASCENDING), ("timestamp", ASCENDING), ("email", ASCENDING)]),
+    IndexModel([("email", ASCENDING)]),
+    IndexModel([("cx_id", ASCENDING)]),
+    # Responses written since create_update_users_from_quizzes last ran
+    IndexModel([("timestamp_updated", ASCENDING)]),
+]
+
+
 """
 The shifts class is used to store information about the shifts.
 The following fields are stored:
@@ -403,6 +568,13 @@ class ShiftChange(BaseModel):
     })
 
 
+# Indexes for the shift_changes collection
+SHIFT_CHANGE_INDEXES = [
+    IndexModel([("uuid", ASCENDING)], unique=True),
+    IndexModel([("date", ASCENDING), ("timestamp_start", ASCENDING), ("timestamp_end", ASCENDING), ("steward", ASCENDING)]),
+]
+
+
 """
 The checkouts class is used to store information about the checkouts.
 The following fields are stored:
@@ -442,6 +614,15 @@ class Checkout(BaseModel):
     })
 
 
+# Indexes for the checkouts collection
+CHECKOUT_INDEXES = [
+    IndexModel([("uuid", ASCENDING)], unique=True),
+    IndexModel([("checked_out_by", ASCENDING)]),
+    # Open checkouts, and the overdue sweep in send_overdue_emails
+    IndexModel([("timestamp_in", ASCENDING), ("timestamp_due", ASCENDING), ("notifications_sent", ASCENDING)]),
+]
+
+
 """
 StudentStorage class is used to store information about the student storage reservations
 The following fields are stored:
@@ -478,6 +659,13 @@ class StudentStorage(BaseModel):
     })
 
 
+# Indexes for the student_storage collection
+STUDENT_STORAGE_INDEXES = [
+    IndexModel([("uuid", ASCENDING)], unique=True),
+    IndexModel([("checked_out_by", ASCENDING)]),
+]
+
+
 """
 Workshop class is used to store information about the workshops.
 The following fields are stored:
@@ -528,6 +716,13 @@ class Workshop(BaseModel):
     })
 
 
+# Indexes for the workshops collection
+WORKSHOP_INDEXES = [
+    IndexModel([("uuid", ASCENDING)], unique=True),
+    IndexModel([("is_live", ASCENDING), ("is_live_timestamp", ASCENDING)]),
+]
+
+
 """
 Printer log class is used to store information about the printer logs.
 This will serve both 3d printer and large format printer logs.
@@ -545,7 +740,13 @@ class PrinterLog(BaseModel):
     printer_name: str
     printer_online: bool
     printer_json: Union[Dict[str, Any], None] = None
-    
+
+
+# Indexes for the printer_logs collection
+PRINTER_LOG_INDEXES = [
+    IndexModel([("printer_name", ASCENDING)]),
+]
+
 
 """
 API Keys class is used to store information about the API keys.
@@ -582,6 +783,13 @@ class APIKey(BaseModel):
     })
 
 
+# Indexes for the api_keys collection
+API_KEY_INDEXES = [
+    IndexModel([("uuid", ASCENDING)], unique=True),
+    IndexModel([("key", ASCENDING)]),
+]
+
+
 """
 IP Logs class is used to store information about the IP logs.
 The following fields are stored:
@@ -606,6 +814,12 @@ class IPLog(BaseModel):
     })
 
 
+# Indexes for the ip_logs collection
+IP_LOG_INDEXES = [
+    IndexModel([("ip", ASCENDING), ("timestamp", ASCENDING)]),
+]
+
+
 class Redirect(BaseModel):
     uuid: str
     path: str
@@ -627,3 +841,72 @@ class Redirect(BaseModel):
             ],
         }
     })
+
+
+# Indexes for the redirects collection
+REDIRECT_INDEXES = [
+    IndexModel([("uuid", ASCENDING)], unique=True),
+    IndexModel([("path", ASCENDING)]),
+]
+
+
+"""
+Outbox class is used to store emails waiting to be sent by the outbox workers.
+The following fields are stored:
+- uuid: The uuid of the message
+- to: The email address of the recipient
+- cc: The email addresses to cc
+- subject: The subject of the email
+- html_body: The html body of the email
+- status: One of "pending", "sending", "sent" or "failed"
+- attempts: The number of times sending has been attempted
+- next_attempt: The timestamp after which the message can be (re)sent
+- timestamp_created: The timestamp of when the message was queued
+- timestamp_sent: The timestamp of when the message was sent
+- last_error: The error from the last failed attempt
+"""
+
+
+class OutboxMessage(BaseModel):
+    uuid: str
+    to: str
+    cc: List[str] = []
+    subject: str
+    html_body: str
+    status: str = "pending"
+    attempts: int = 0
+    next_attempt: float
+    timestamp_created: float
+    timestamp_sent: Union[float, None] = None
+    last_error: Union[str, None] = None
+
+
+# Indexes for the outbox collection
+OUTBOX_INDEXES = [
+    IndexModel([("uuid", ASCENDING)], unique=True),
+    IndexModel([("status", ASCENDING), ("next_attempt", ASCENDING)]),
+    IndexModel([("status", ASCENDING), ("timestamp_sent", ASCENDING)]),
+]
+
+
+# Index specification for each collection, applied (and reported on)
+# at startup by validate_database_schema
+indexes = {
+    "inventory": INVENTORY_INDEXES,
+    "users": USER_INDEXES,
+    "certifications": CERTIFICATION_INDEXES,
+    "user_files": USER_FILE_INDEXES,
+    "server_files": SERVER_FILE_INDEXES,
+    "restock_requests": RESTOCK_REQUEST_INDEXES,
+    "quizzes": QUIZ_RESPONSE_INDEXES,
+    "shift_changes": SHIFT_CHANGE_INDEXES,
+    "checkouts": CHECKOUT_INDEXES,
+    "student_storage": STUDENT_STORAGE_INDEXES,
+    "workshops": WORKSHOP_INDEXES,
+    "printer_logs": PRINTER_LOG_INDEXES,
+    "api_keys": API_KEY_INDEXES,
+    "ip_logs": IP_LOG_INDEXES,
+    "redirects": REDIRECT_INDEXES,
+    "outbox": OUTBOX_INDEXES,
+    "blobs": BLOB_INDEXES,
+}
@@ -1,66 +1,74 @@
+import asyncio
 import datetime
 import logging
-from typing import Dict
-import uuid
 
-from utilities import format_email_template
-from db_schema import MongoDB, InventoryItem, Checkout
+from pymongo import UpdateOne
+from utilities import format_email_templates
+from db_schema import MongoDB
 
 from utilities import email_user
 
-async def send_checkout_email(checkout_uuid: str):
-    logging.getLogger().setLevel(logging.INFO)
-    logging.info("Sending checkout email...")
-    # Get the checkout
-    db = MongoDB()
+# Maximum number of overdue emails being sent at once
+OVERDUE_EMAIL_CONCURRENCY = 10
 
+async def get_overdue_checkouts(db: MongoDB, timestamp_now: float):
+    # Get the checkouts that are due another notification, along with the
+    # email of the user and the names of the items, in a single query
     checkout_collection = await db.get_collection("checkouts")
 
-    checkout = await checkout_collection.find_one({"uuid": checkout_uuid})
-
-    if checkout is None:
-        # The checkout does not exist   
-        # Return error
-        return False
-    
-    # Get the user
-    user_collection = await db.get_collection("users")
-    
-    user = await user_collection.find_one({"uuid": checkout["checked_out_by"]})
-    
-    if user is None:
-        # The user does not exist
-        # Return error
-        return False
-    
-    logging.info("Sending checkout email to " + user["email"] + "...")
-
-    # Get the items
-    inventory_collection = await db.get_collection("inventory")
-
-    items = await inventory_collection.find({"uuid": {"$in": list(checkout["items"].keys())}}).to_list(None)
-    if len(items) != len(checkout["items"]):
-        # Some items do not exist
-        # Show warning
-        logging.getLogger().setLevel(logging.WARNING)
-        logging.warning("Some items do not exist")
-
-    # Send the email
-        # Format the list as bullet points
-    text_list = "".join([f"<li>{text}</li>" for text in [item["name"] for item in items]])
-
-    body = format_email_template("expired_checkout", {"text_list": text_list})
-
-    try :
-        await email_user(user["email"], [], f"MAKE Tool Checkout Notification #{checkout['notifications_sent'] + 1}", body)
-    except Exception as e:
-        # Show warning
-        logging.getLogger().setLevel(logging.WARNING)   
-        logging.warning("Failed to send checkout email: " + str(e))
-        return False
-
-    # Return success
-    return True
+    return await checkout_collection.aggregate([
+        # Only open checkouts that are past due, this part uses the
+        # (timestamp_in, timestamp_due, notifications_sent) index
+        {"$match": {
+            "timestamp_in": None,
+            "timestamp_due": {"$lt": timestamp_now},
+            "timestamp_out": {"$ne": None},
+        }},
+        # One notification is sent for every day overdue, so a checkout is
+        # due another once it's been overdue more days than notifications sent
+        {"$match": {"$expr": {"$lt": [
+            {"$add": ["$timestamp_due", {"$multiply": ["$notifications_sent", 60 * 60 * 24]}]},
+            timestamp_now,
+        ]}}},
+        {"$addFields": {"item_uuids": {"$map": {"input": {"$objectToArray": "$items"}, "in": "$$this.k"}}}},
+        {"$lookup": {"from": "users", "localField": "checked_out_by", "foreignField": "uuid", "as": "user"}},
+        {"$lookup": {"from": "inventory", "localField": "item_uuids", "foreignField": "uuid", "as": "inventory_items"}},
+        {"$project": {
+            "uuid": 1,
+            "items": 1,
+            "notifications_sent": 1,
+            "user.email": 1,
+            "inventory_items.name": 1,
+        }},
+    ]).to_list(None)
+
+
+async def send_checkout_email(checkout: dict, body: str, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        if len(checkout["user"]) == 0:
+            # The user does not exist
+            # Return error
+            return False
+
+        email = checkout["user"][0]["email"]
+        logging.info("Sending checkout email to " + email + "...")
+
+        if len(checkout["inventory_items"]) != len(checkout["items"]):
+            # Some items do not exist
+            # Show warning
+            logging.getLogger().setLevel(logging.WARNING)
+            logging.warning("Some items do not exist")
+
+        try :
+            await email_user(email, [], f"MAKE Tool Checkout Notification #{checkout['notifications_sent'] + 1}", body)
+        except Exception as e:
+            # Show warning
+            logging.getLogger().setLevel(logging.WARNING)
+            logging.warning("Failed to send checkout email: " + str(e))
+            return False
+
+        # Return success
+        return True
 
 
 async def send_overdue_emails():
@@ -69,31 +77,40 @@ async def send_overdue_emails():
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Sending overdue emails...")
 
-    # Get the checkouts
     db = MongoDB()
+    timestamp_now = float(datetime.datetime.now().timestamp())
 
-    checkout_collection = await db.get_collection("checkouts")
+    checkouts = await get_overdue_checkouts(db, timestamp_now)
 
-    # Find checkouts that timestamp_in is not None and timestamp_out is not None
-    checkouts = await checkout_collection.find({"timestamp_in": {"$eq": None}, "timestamp_out": {"$ne": None}}).to_list(None)
+    if len(checkouts) == 0:
+        return
 
-    checkouts = [Checkout(**checkout) for checkout in checkouts]
+    # Format the list of items as bullet points, rendering the template once for every checkout
+    bodies = format_email_templates("expired_checkout", [
+        {"text_list": "".join([f"<li>{item['name']}</li>" for item in checkout["inventory_items"]])}
+        for checkout in checkouts
+    ])
 
-    for checkout in checkouts:
-        # Calculate the number of days overdue
-        timestamp_now = float(datetime.datetime.now().timestamp())
+    semaphore = asyncio.Semaphore(OVERDUE_EMAIL_CONCURRENCY)
+    results = await asyncio.gather(*[
+        send_checkout_email(checkout, body, semaphore)
+        for checkout, body in zip(checkouts, bodies)
+    ])
 
-        days_overdue = (timestamp_now - float(checkout.timestamp_due)) / (60 * 60 * 24)
+    # Update the notifications_sent field of every checkout that was emailed
+    updates = [
+        UpdateOne({"uuid": checkout["uuid"]}, {"$set": {"notifications_sent": checkout["notifications_sent"] + 1}})
+        for checkout, email_success in zip(checkouts, results)
+        if email_success
+    ]
 
-        if days_overdue > checkout.notifications_sent:
-            # Send an email
-            email_success = await send_checkout_email(checkout.uuid)
+    if len(updates) > 0:
+        checkout_collection = await db.get_collection("checkouts")
+        await checkout_collection.bulk_write(updates, ordered=False)
 
-            if email_success:
-                # Update the notifications_sent field
-                logging.info("Successfully sent email")
-                await checkout_collection.update_one({"uuid": checkout.uuid}, {"$set": {"notifications_sent": checkout.notifications_sent + 1}})
-            else:
-                # Show warning
-                logging.getLogger().setLevel(logging.WARNING)
-                logging.warning("Failed to send email")
\ No newline at end of file
+    logging.info(f"Sent {len(updates)} overdue emails")
+
+    if len(updates) != len(checkouts):
+        # Show warning
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.warning(f"Failed to send {len(checkouts) - len(updates)} overdue emails")
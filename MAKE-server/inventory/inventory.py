@@ -4,6 +4,7 @@ import logging
 from typing import List
 from utilities import format_email_template, email_user
 import aiohttp
+from pymongo import UpdateOne
 from db_schema import MongoDB, QuizResponse, RestockRequest
 from config import *
 from uuid import uuid4
@@ -17,44 +18,44 @@ async def update_inventory_from_checkouts():
     # Get the checkouts collection
     db = MongoDB()
     collection = await db.get_collection("checkouts")
-    # Only get the checkouts that have not been returned
-    all_checkouts = await collection.find({"timestamp_in": None}).to_list(None)
+
+    # Count how many of each item are checked out, using the quantity of
+    # each item in the checkout. Only count checkouts that have not been returned
+    checked_out = await collection.aggregate([
+        {"$match": {"timestamp_in": None}},
+        {"$project": {"items": {"$objectToArray": "$items"}}},
+        {"$unwind": "$items"},
+        {"$group": {"_id": "$items.k", "quantity": {"$sum": "$items.v"}}},
+    ]).to_list(None)
+
+    checked_out = {item["_id"]: item["quantity"] for item in checked_out}
 
     # Get the inventory collection
     inventory_collection = await db.get_collection("inventory")
-    all_inventory = await inventory_collection.find().to_list(None)
-
-    # Go through the checkouts and update the inventory
-    # Each item has quantity_total and quantity_available
-    # First, just count uuids and subtract from quantity_total to set quantity_available
-    uuid_dict = {}
-    for checkout in all_checkouts:
-        for item in checkout["items"]:
-            if item in uuid_dict:
-                uuid_dict[item] += 1
-            else:
-                uuid_dict[item] = 1
-
-    # Go through the inventory and update the quantity_available
+    all_inventory = await inventory_collection.find(
+        {}, {"uuid": 1, "quantity_total": 1, "quantity_available": 1}
+    ).to_list(None)
+
+    # Each item has quantity_total and quantity_available.
+    # Only write the items whose quantity_available has changed
+    updates = []
     for item in all_inventory:
         if item["quantity_total"] < 0:
             # If it's negative, just assign it to the quantity_total
-            item["quantity_available"] = item["quantity_total"]
+            quantity_available = item["quantity_total"]
         else:
-            if item["uuid"] in uuid_dict:
-                item["quantity_available"] = (
-                    item["quantity_total"] - uuid_dict[item["uuid"]]
-                )
-            else:
-                item["quantity_available"] = item["quantity_total"]
-
-        # Update the item
-        await inventory_collection.update_one(
-            {"uuid": item["uuid"]},
-            {"$set": {"quantity_available": item["quantity_available"]}},
-        )
+            quantity_available = item["quantity_total"] - checked_out.get(item["uuid"], 0)
+
+        if item.get("quantity_available") != quantity_available:
+            updates.append(UpdateOne(
+                {"uuid": item["uuid"]},
+                {"$set": {"quantity_available": quantity_available}},
+            ))
+
+    if len(updates) > 0:
+        await inventory_collection.bulk_write(updates, ordered=False)
 
-    logging.info("Updated inventory from checkouts")
+    logging.info(f"Updated inventory from checkouts, {len(updates)} items changed")
 
 
 # async def update_from_gsheet():
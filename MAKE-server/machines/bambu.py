@@ -0,0 +1,185 @@
+import asyncio
+import datetime
+import logging
+from typing import List, Union
+
+import aiohttp
+import jwt
+from config import BAMBULABS_EMAIL, BAMBULABS_PASS, BAMBU_API_URL, BAMBU_LOGIN_URL, BAMBU_DEVICES_TTL_SECONDS
+
+POST_REFRESH_PATH = "v1/user-service/user/refreshtoken"
+GET_USER_DEVICES = "v1/iot-service/api/user/bind"
+
+# Tokens are refreshed when they expire within this many seconds,
+# or halfway through their lifetime for short lived tokens
+TOKEN_REFRESH_MARGIN_SECONDS = 10 * 60
+# How long a token without an exp claim is assumed to last
+DEFAULT_TOKEN_LIFETIME_SECONDS = 60 * 60
+REQUEST_TIMEOUT_SECONDS = 30
+
+
+class BambuAPIError(Exception):
+    pass
+
+
+def decode_token(token: str):
+    # Bambu access tokens are JWTs, the signature can't be checked
+    # without Bambu's key but the claims are all that's needed
+    return jwt.decode(token, options={"verify_signature": False, "verify_aud": False})
+
+
+class BambuClient:
+    '''
+    Client for the Bambu cloud API. Requests share one pooled session, and
+    the access token is only refreshed when it is about to expire (read
+    from the JWT's exp claim), with a full password login as a fallback
+    when the refresh token is rejected. The device list is cached for
+    BAMBU_DEVICES_TTL_SECONDS, since it rarely changes.
+    '''
+
+    def __init__(self, email: str, password: str, api_url: str, login_url: str, devices_ttl: float):
+        self.email = email
+        self.password = password
+        self.api_url = api_url.rstrip("/")
+        self.login_url = login_url
+        self.devices_ttl = devices_ttl
+
+        self.session: Union[aiohttp.ClientSession, None] = None
+        self.token: Union[str, None] = None
+        self.refresh_token: Union[str, None] = None
+        self.refresh_at = 0
+        # Concurrent requests with an expired token should only renew it once
+        self.token_lock = asyncio.Lock()
+
+        self.devices: Union[List[dict], None] = None
+        self.devices_fetched_at = 0
+        self.devices_lock = asyncio.Lock()
+
+    @property
+    def configured(self):
+        return self.password != "PASSWORD"
+
+    def get_session(self):
+        # Made on first use, so it belongs to the running event loop
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS))
+
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    # Tokens
+
+    def set_tokens(self, token: str, refresh_token: Union[str, None]):
+        if token is None:
+            raise BambuAPIError("Bambu login didn't return a token")
+
+        self.token = token
+        self.refresh_token = refresh_token
+
+        now = datetime.datetime.now().timestamp()
+        expires_at = decode_token(token).get("exp") or now + DEFAULT_TOKEN_LIFETIME_SECONDS
+
+        self.refresh_at = expires_at - min(TOKEN_REFRESH_MARGIN_SECONDS, (expires_at - now) / 2)
+
+    async def login(self):
+        session = self.get_session()
+
+        async with session.post(self.login_url, json={"account": self.email, "password": self.password}) as response:
+            if response.status >= 400:
+                raise BambuAPIError(f"Bambu login failed with status {response.status}")
+
+            # The tokens are sent as cookies
+            token = None
+            refresh_token = None
+
+            for cookie in response.headers.getall("Set-Cookie", []):
+                name, _, value = cookie.split(";")[0].partition("=")
+
+                if name.strip() == "token":
+                    token = value
+                elif name.strip() == "refreshToken":
+                    refresh_token = value
+
+        self.set_tokens(token, refresh_token)
+        logging.info("Logged in to Bambu")
+
+    async def refresh(self):
+        session = self.get_session()
+        headers = {"Authorization": f"Bearer {self.refresh_token}"}
+
+        async with session.post(f"{self.api_url}/{POST_REFRESH_PATH}", headers=headers, json={"refreshToken": self.refresh_token}) as response:
+            if response.status >= 400:
+                raise BambuAPIError(f"Bambu token refresh failed with status {response.status}")
+
+            json_content = await response.json()
+
+        self.set_tokens(json_content["accessToken"], json_content["refreshToken"])
+        logging.info("Refreshed Bambu token")
+
+    async def renew_token(self):
+        # Refresh the access token, falling back to a full login
+        if self.refresh_token is not None:
+            try:
+                await self.refresh()
+                return
+            except Exception as e:
+                logging.warning(f"Failed to refresh Bambu token, logging in again: {e}")
+
+        await self.login()
+
+    async def get_token(self):
+        async with self.token_lock:
+            now = datetime.datetime.now().timestamp()
+
+            if self.token is None or now > self.refresh_at:
+                await self.renew_token()
+
+            return self.token
+
+    def invalidate_token(self, token: str):
+        # The token was rejected before it expired, renew it on the next
+        # request. Passing the rejected token avoids discarding a newer one
+        if token == self.token:
+            self.refresh_at = 0
+
+    # API
+
+    async def request(self, method: str, path: str, json_body: Union[dict, None] = None):
+        session = self.get_session()
+
+        # Retry once with a new token if it was rejected
+        for attempt in range(2):
+            token = await self.get_token()
+            headers = {"Authorization": f"Bearer {token}"}
+
+            async with session.request(method, f"{self.api_url}/{path}", headers=headers, json=json_body) as response:
+                if response.status == 401 and attempt == 0:
+                    self.invalidate_token(token)
+                    continue
+
+                if response.status >= 400:
+                    raise BambuAPIError(f"Bambu API {method} {path} failed with status {response.status}")
+
+                return await response.json(content_type=None)
+
+    async def get_devices(self, max_age: Union[float, None] = None):
+        # Get the printers bound to the account, cached for devices_ttl
+        # seconds unless max_age asks for a fresher list
+        if max_age is None:
+            max_age = self.devices_ttl
+
+        async with self.devices_lock:
+            now = datetime.datetime.now().timestamp()
+
+            if self.devices is None or now - self.devices_fetched_at > max_age:
+                self.devices = (await self.request("GET", GET_USER_DEVICES))["devices"]
+                self.devices_fetched_at = now
+
+            return self.devices
+
+
+bambu_client = BambuClient(BAMBULABS_EMAIL, BAMBULABS_PASS, BAMBU_API_URL, BAMBU_LOGIN_URL, BAMBU_DEVICES_TTL_SECONDS)
@@ -1,14 +1,354 @@
+import asyncio
+import hashlib
 import io
+import logging
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Union
+
 import PIL
 import PIL.Image
 import PIL.ImageOps
 import base64
+import numpy as np
+from config import LOOM_CACHE_BYTES, LOOM_STAGE_CACHE_BYTES, LOOM_CACHE_DIR, LOOM_CACHE_DIR_BYTES, LOOM_WORKERS, LOOM_MAX_PENDING
+
+# Run-length correction works on chunks of rows of about this many pixels
+RUN_CHUNK_PIXELS = 1 << 22
+
+
+class RenderCache:
+    '''
+    A thread safe LRU cache bounded by the total size of its values.
+    With a spill_dir, values evicted from memory are written there (up to
+    max_spill_bytes, oldest deleted first) and read back on a miss, which
+    needs the values to be bytes.
+    '''
+
+    def __init__(self, max_bytes: int, sizeof: Callable = len, spill_dir: Union[str, None] = None, max_spill_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        # Size of each spilled file, oldest first
+        self.spilled: Union[OrderedDict, None] = None
+        self.spilled_size = 0
+
+    def spill_path(self, key: tuple):
+        return os.path.join(self.spill_dir, hashlib.sha256(repr(key).encode()).hexdigest())
+
+    def load_spilled(self):
+        # Pick up files spilled by previous processes, oldest first
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        files = sorted(
+            (entry for entry in os.scandir(self.spill_dir) if entry.is_file() and not entry.name.startswith(".")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+
+        self.spilled = OrderedDict((entry.name, entry.stat().st_size) for entry in files)
+        self.spilled_size = sum(self.spilled.values())
+
+    def get(self, key: tuple):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if self.spill_dir is None:
+            return None
+
+        path = self.spill_path(key)
+
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+
+        with self.lock:
+            name = os.path.basename(path)
+            if self.spilled is not None and name in self.spilled:
+                self.spilled.move_to_end(name)
+
+        self.put(key, value)
+
+        return value
+
+    def clear(self):
+        # Empty the in-memory cache, spilled values are kept
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def put(self, key: tuple, value):
+        evicted = []
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+
+            if self.sizeof(value) <= self.max_bytes:
+                self.entries[key] = value
+                self.size += self.sizeof(value)
+            else:
+                # Too large to keep in memory at all
+                evicted.append((key, value))
+
+            while self.size > self.max_bytes:
+                evicted_key, evicted_value = self.entries.popitem(last=False)
+                self.size -= self.sizeof(evicted_value)
+                evicted.append((evicted_key, evicted_value))
+
+        if self.spill_dir is not None:
+            for evicted_key, evicted_value in evicted:
+                self.spill(evicted_key, evicted_value)
+
+    def spill(self, key: tuple, value: bytes):
+        with self.lock:
+            if self.spilled is None:
+                self.load_spilled()
+
+        path = self.spill_path(key)
+        name = os.path.basename(path)
+
+        with self.lock:
+            if name in self.spilled or len(value) > self.max_spill_bytes:
+                return
+
+        # Write to a temporary file first, so a partial file is never read
+        temp_path = os.path.join(self.spill_dir, f".{uuid.uuid4().hex}")
+        with open(temp_path, "wb") as f:
+            f.write(value)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            self.spilled[name] = len(value)
+            self.spilled_size += len(value)
+
+            removed = []
+            while self.spilled_size > self.max_spill_bytes:
+                removed_name, removed_size = self.spilled.popitem(last=False)
+                self.spilled_size -= removed_size
+                removed.append(removed_name)
+
+        for removed_name in removed:
+            try:
+                os.remove(os.path.join(self.spill_dir, removed_name))
+            except FileNotFoundError:
+                pass
+
+
+def image_size(image):
+    # Approximate memory used by a 1-bit or grayscale image
+    return image.width * image.height
+
+
+# Finished renders as PNG bytes, by image hash and all render parameters
+render_cache = RenderCache(LOOM_CACHE_BYTES, spill_dir=LOOM_CACHE_DIR, max_spill_bytes=LOOM_CACHE_DIR_BYTES)
+# Intermediate images, so changing only some parameters skips the earlier
+# stages. Each LoomRenderPool worker has its own, with a share of the budget
+stage_cache = RenderCache(LOOM_STAGE_CACHE_BYTES, sizeof=lambda value: image_size(value[0]))
+
 
 def render_loom_file(loom_file: str, file_extension: str, output_format: str, loom_width: int, desired_height: int, invert: bool, tabby_width: int):
     # Decode loom file from base64
     img_data = base64.b64decode(str(loom_file))
+
+    # Render it as a png, then convert to b64
+    return base64.standard_b64encode(render_loom_image(img_data, loom_width, desired_height, invert, tabby_width))
+
+
+def render_loom_image(img_data: bytes, loom_width: int, desired_height: int, invert: bool, tabby_width: int, use_render_cache: bool = True):
+    # Render an image for the loom, returning the png bytes. Renders are
+    # cached by the hash of the image and the render parameters, the
+    # output is always a png so the requested format isn't part of it
+    image_hash = hashlib.sha256(img_data).hexdigest()
+    key = (image_hash, loom_width, desired_height, invert, tabby_width)
+
+    png = render_cache.get(key) if use_render_cache else None
+    if png is not None:
+        return png
+
+    loom_image, min_tabby_width = get_dithered_image(img_data, image_hash, loom_width, desired_height)
+
+    # Fill any blank space on the sides with tabby
+    tabby_width = max(min_tabby_width, tabby_width)
+
+    # Apply loom filter to ensure no more then 5 black pixels
+    # in a row or 5 white pixels in a column
+    loom_image = get_corrected_image(loom_image, image_hash, loom_width, desired_height, invert)
+
+    # Add tabby
+    if tabby_width > 0:
+        loom_image = add_tabby(loom_image, tabby_width)
+
+    # Save the loom image in memory as .png
+    img_byte_arr = io.BytesIO()
+    loom_image.save(img_byte_arr, format='png')
+    png = img_byte_arr.getvalue()
+
+    if use_render_cache:
+        render_cache.put(key, png)
+
+    return png
+
+
+def init_worker(stage_cache_bytes: int):
+    # Runs when a LoomRenderPool process starts
+    stage_cache.max_bytes = stage_cache_bytes
+
+
+def render_in_worker(img_data: bytes, loom_width: int, desired_height: int, invert: bool, tabby_width: int):
+    # Runs in a LoomRenderPool process. Finished renders are cached by the
+    # pool, so workers only keep their own intermediate stages
+    return render_loom_image(img_data, loom_width, desired_height, invert, tabby_width, use_render_cache=False)
+
+
+class LoomOverloadedError(Exception):
+    pass
+
+
+class LoomRenderPool:
+    '''
+    Renders loom images in a pool of processes, so rendering never blocks
+    the event loop and several renders can happen at once. At most
+    max_pending renders are queued or running, beyond that renders are
+    refused with LoomOverloadedError instead of piling up. Identical
+    renders that are already in progress are shared.
+
+    Each process keeps its own cache of intermediate stages, sized
+    stage_cache_bytes / workers so they fit the budget between them.
+    Renders of an image always go to the same process, chosen by the
+    image's hash, so rendering it again with other parameters finds its
+    stages. Different images can still end up waiting on the same process.
+    A process that dies is replaced, and its renders are retried once.
+    '''
+
+    def __init__(self, workers: int, max_pending: int, stage_cache_bytes: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.stage_cache_bytes = stage_cache_bytes
+        self.executors: List[ProcessPoolExecutor] = []
+        self.pending: Dict[tuple, asyncio.Future] = {}
+
+    def make_executor(self):
+        # Processes are spawned rather than forked, since forking a process
+        # with running threads (like the database client's) isn't safe.
+        # Each has its own executor, so renders can be sent to a given one
+        return ProcessPoolExecutor(
+            1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(self.stage_cache_bytes // self.workers,),
+        )
+
+    def start(self):
+        self.executors = [self.make_executor() for _ in range(self.workers)]
+
+    def stop(self):
+        for executor in self.executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        self.executors = []
+
+    def get_worker(self, image_hash: str):
+        # The process that renders an image, so its stages are cached in one place
+        return int(image_hash[:16], 16) % len(self.executors)
+
+    async def run_in_worker(self, worker: int, *args):
+        # Render in a worker process, replacing it and retrying
+        # once if it dies, which would break its executor for good
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(2):
+            executor = self.executors[worker]
+
+            try:
+                return await loop.run_in_executor(executor, render_in_worker, *args)
+            except BrokenProcessPool:
+                if len(self.executors) == 0:
+                    # The pool was stopped
+                    raise
+
+                # Renders that failed together only replace it once
+                if self.executors[worker] is executor:
+                    logging.warning(f"Loom render process {worker} died, restarting it")
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self.executors[worker] = self.make_executor()
+
+                if attempt == 1:
+                    raise
+
+    async def render(self, img_data: bytes, loom_width: int, desired_height: int, invert: bool, tabby_width: int):
+        # Render an image for the loom, returning the png bytes
+        image_hash = await asyncio.to_thread(lambda: hashlib.sha256(img_data).hexdigest())
+        key = (image_hash, loom_width, desired_height, invert, tabby_width)
+
+        png = await asyncio.to_thread(render_cache.get, key)
+        if png is not None:
+            return png
+
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+
+        if len(self.pending) >= self.max_pending:
+            raise LoomOverloadedError()
+
+        future = asyncio.ensure_future(
+            self.run_in_worker(self.get_worker(image_hash), img_data, loom_width, desired_height, invert, tabby_width)
+        )
+        self.pending[key] = future
+        future.add_done_callback(lambda future: self.finish(key, future))
+
+        # A client giving up doesn't stop the render, it's still cached
+        return await asyncio.shield(future)
+
+    def finish(self, key: tuple, future: asyncio.Future):
+        # Called once a render is done, even if no one is waiting for it
+        del self.pending[key]
+
+        if not future.cancelled() and future.exception() is None:
+            # Caching may spill to disk, so it happens in a thread
+            asyncio.get_running_loop().run_in_executor(None, render_cache.put, key, future.result())
+
+
+loom_render_pool = LoomRenderPool(LOOM_WORKERS, LOOM_MAX_PENDING, LOOM_STAGE_CACHE_BYTES)
+
+
+def get_dithered_image(img_data: bytes, image_hash: str, loom_width: int, desired_height: int):
+    # Decode, resize and dither the image. Returns the dithered image and
+    # the minimum tabby width, to fill the space if it's narrower than the loom
+    key = ("dithered", image_hash, loom_width, desired_height)
+
+    cached = stage_cache.get(key)
+    if cached is not None:
+        return cached
+
     loom_image = PIL.Image.open(io.BytesIO(img_data ))
+    loom_image = resize_for_loom(loom_image, loom_width, desired_height)
+    loom_image, min_tabby_width = center_on_loom(loom_image, loom_width)
+
+    # Dither the image
+    loom_image = loom_image.convert('1', dither=PIL.Image.FLOYDSTEINBERG)
+
+    stage_cache.put(key, (loom_image, min_tabby_width))
+
+    return loom_image, min_tabby_width
 
+
+def resize_for_loom(loom_image, loom_width: int, desired_height: int):
+    # Resize the image to the desired height, as long as it fits on the loom
     # Get the loom image width and height
     loom_image_width, loom_image_height = loom_image.size
 
@@ -28,7 +368,14 @@ def render_loom_file(loom_file: str, file_extension: str, output_format: str, lo
         # Resize the loom image
         loom_image = loom_image.resize((new_width, new_height), PIL.Image.ANTIALIAS)
 
+    return loom_image
+
+
+def center_on_loom(loom_image, loom_width: int):
+    # Returns the image centered on the loom width, along with the minimum
+    # tabby width to fill the space on the sides
     loom_image_width, loom_image_height = loom_image.size
+    min_tabby_width = 0
 
     # If it's smaller then the loom width, place it in the center of a blank image
     # and increase tabby width to fill the rest of the space
@@ -37,7 +384,7 @@ def render_loom_file(loom_file: str, file_extension: str, output_format: str, lo
         blank_space = loom_width - loom_image_width
 
         # Calculate the tabby width
-        tabby_width = max(blank_space // 2, tabby_width)
+        min_tabby_width = blank_space // 2
 
         # Create a new blank image
         new_image = PIL.Image.new('L', (loom_width, loom_image_height), 255)
@@ -48,85 +395,91 @@ def render_loom_file(loom_file: str, file_extension: str, output_format: str, lo
         # Set the loom image to the new image
         loom_image = new_image
 
+    return loom_image, min_tabby_width
 
-    # Dither the image
-    loom_image = loom_image.convert('1', dither=PIL.Image.FLOYDSTEINBERG)
+
+def get_corrected_image(loom_image, image_hash: str, loom_width: int, desired_height: int, invert: bool):
+    # Invert the dithered image if necessary and apply the loom filter
+    key = ("corrected", image_hash, loom_width, desired_height, invert)
+
+    cached = stage_cache.get(key)
+    if cached is not None:
+        return cached[0]
 
     # Invert the image if necessary
     if invert:
         loom_image = PIL.ImageOps.invert(loom_image)
 
-    # Apply loom filter to ensure no more then 5 black pixels
-    # in a row or 5 white pixels in a column
     loom_image = correct_image(loom_image)
-        
 
-    # Add tabby
-    if tabby_width > 0:
-        # Repeat pattern as follows (example for tabby width of 5):
-        # 1 0 1 0 1
-        # 0 1 0 1 0
-        # on both sides of the image
-
-        for row in range(0, loom_image.height):
-            # Alternate between white and black starting rows
-            base = row % 2 == 0
-            
-            for i in range(tabby_width):
-                # Alternate between white and black pixels, starting with the base
-                if base:
-                    pixel = i % 2 == 0
-                else:
-                    pixel = i % 2 == 1
+    stage_cache.put(key, (loom_image,))
 
-                loom_image.putpixel((i, row), 255 if pixel else 0)
-                loom_image.putpixel((loom_image.width - i - 1, row), 255 if pixel else 0)
+    return loom_image
 
-    # Save the loom image in memory as .tiff, then convert to b64
-    img_byte_arr = io.BytesIO()
-    loom_image.save(img_byte_arr, format='png')
-    img_byte_arr = img_byte_arr.getvalue()
-    loom_image = base64.standard_b64encode(img_byte_arr)
 
-    # Return the loom image
-    return loom_image
+def find_run_triggers(runs):
+    # For each row of runs, find the pixels where the loom filter kicks in:
+    # every 5th pixel after the first 5 of each run of True pixels.
+    # Rows are processed in chunks to bound the memory used
+    height, width = runs.shape
+    triggers = np.zeros_like(runs)
+    index = np.arange(width, dtype=np.int32)
+    chunk_rows = max(1, RUN_CHUNK_PIXELS // max(width, 1))
+
+    for start in range(0, height, chunk_rows):
+        chunk = runs[start:start + chunk_rows]
+
+        # Position of each pixel in its run, from the last False before it
+        run_start = np.maximum.accumulate(np.where(chunk, np.int32(-1), index), axis=1)
+        position = index - run_start - 1
+
+        triggers[start:start + chunk_rows] = chunk & (position >= 5) & (position % 5 == 0)
+
+    return triggers
 
 
 def correct_image(image):
-    # Open the dithered image and convert it to black and white (1-bit)
-    width, height = image.size
-
-    # Correct the rows
-    for y in range(height):
-        consecutive_white_pixels = 0
-        for x in range(width):
-            pixel = image.getpixel((x, y))
-            if pixel == 255:  # Black pixel
-                consecutive_white_pixels += 1
-                if consecutive_white_pixels > 5:
-                    if y % 2 == 0:
-                        image.putpixel((x, y), 0)  # Change to white pixel
-                    else:
-                        image.putpixel((x - 1, y), 0)  # Change the previous pixel to white
-                    consecutive_white_pixels = 1
-            else:
-                consecutive_white_pixels = 0
-
-    # Correct the columns
-    for x in range(width):
-        consecutive_black_pixels = 0
-        for y in range(height):
-            pixel = image.getpixel((x, y))
-            if pixel == 0:  # White pixel
-                consecutive_black_pixels += 1
-                if consecutive_black_pixels > 5:
-                    if x % 2 == 0:
-                        image.putpixel((x, y), 255)  # Change to black pixel
-                    else:
-                        image.putpixel((x, y - 1), 255)  # Change the previous pixel to black
-                    consecutive_black_pixels = 1
-            else:
-                consecutive_black_pixels = 0
+    # Apply the loom filter to a 1-bit image, so there are no more than
+    # 5 white (255) pixels in a row or 5 black (0) pixels in a column.
+    # Each pass only changes pixels it has already read, so every run can
+    # be corrected at once from the pixels before that pass
+    pixels = np.array(image.convert("1"))
+
+    # Correct the rows, breaking up runs of white pixels. Even rows
+    # change the 6th pixel of a run, odd rows the one before it
+    triggers = find_run_triggers(pixels)
+    pixels[0::2][triggers[0::2]] = False
+    pixels[1::2, :-1][triggers[1::2, 1:]] = False
+
+    # Correct the columns the same way, breaking up runs of black pixels
+    columns = pixels.T
+    triggers = find_run_triggers(~columns)
+    columns[0::2][triggers[0::2]] = True
+    columns[1::2, :-1][triggers[1::2, 1:]] = True
+
+    return PIL.Image.fromarray(pixels)
+
+
+def add_tabby(image, tabby_width: int):
+    # Add a tabby of width tabby_width on both sides of the image,
+    # alternating pixels and rows as follows (example for a width of 5):
+    # 1 0 1 0 1
+    # 0 1 0 1 0
+    pixels = np.array(image.convert("1"))
+    height, width = pixels.shape
+
+    if tabby_width > width:
+        raise ValueError(f"Tabby width {tabby_width} is wider than the loom image")
+
+    # Position of each column in the pattern, counted from its side.
+    # Where both sides' tabby overlap, the position further in wins
+    columns = np.arange(width)
+    from_left = np.where(columns < tabby_width, columns, -1)
+    from_right = np.where(width - 1 - columns < tabby_width, width - 1 - columns, -1)
+    position = np.maximum(from_left, from_right)
+    is_tabby = position >= 0
 
+    rows = np.arange(height)[:, np.newaxis]
+    pixels[:, is_tabby] = (position[is_tabby] + rows) % 2 == 0
 
-    return image
\ No newline at end of file
+    return PIL.Image.fromarray(pixels)
@@ -1,24 +1,17 @@
+import copy
 import datetime
 import json
+import random
 import uuid
-import aiohttp
-import jwt
 import logging
-from config import BAMBULABS_EMAIL, BAMBULABS_PASS
+from typing import Dict, List, Union
+from config import BAMBU_MQTT_HOST, BAMBU_MQTT_PORT, BAMBU_MQTT_USE_TLS
 from db_schema import MongoDB, PrinterLog
+from machines.bambu import BambuClient, bambu_client, decode_token
 
-import traceback
 import paho.mqtt.client as mqtt
 import asyncio
 
-BASE_API = "https://api.bambulab.com"
-MQTT_API = "us.mqtt.bambulab.com"
-MQTT_PORT = 8883
-
-POST_FULL_LOGIN_PATH = "https://bambulab.com/api/sign-in/form"
-POST_REFRESH_PATH = "v1/user-service/user/refreshtoken"
-GET_USER_DEVICES = "v1/iot-service/api/user/bind"
-
 PUSHING_PUSHALL_REQUEST = {
     "pushing": {
         "sequence_id": "0",
@@ -27,218 +20,357 @@ PUSHING_PUSHALL_REQUEST = {
         "push_target": 1
     }
 }
-current_token = None
-current_refresh_token = None
-current_logs = []
-
-async def get_bambu_tokens():
-    async with aiohttp.ClientSession() as session:
-        async with session.post(POST_FULL_LOGIN_PATH, json={"account": BAMBULABS_EMAIL, "password": BAMBULABS_PASS}) as response:
-            headers = response.headers
-            # Get all headers of "Set-Cookie"
-            cookies = headers.getall('Set-Cookie')
-
-            # Get the access token and refresh token
-            token = None
-            refresh_token = None
-
-            for cookie in cookies:
-                if "token=" in cookie:
-                    token = cookie.split(";")[0]
-                    token = token.split("=")[1]
-
-                elif "refreshToken=" in cookie:
-                    refresh_token = cookie.split(";")[0]
-                    refresh_token = refresh_token.split("=")[1]
-
-            return token, refresh_token
-        
-async def refresh_bambu_tokens(refresh_token):
-        json_content = await bambu_api(refresh_token, POST_REFRESH_PATH, method="POST", json_body={
-             "refreshToken": refresh_token
-        })
-
-        return json_content["accessToken"], json_content["refreshToken"]
-
-async def bambu_api(token, path, method = "GET", json_body = None):
-    async with aiohttp.ClientSession() as session:
-        headers = {"Authorization": f"Bearer {token}"}
-
-        async with session.request(method, f"{BASE_API}/{path}", headers=headers, json=json_body) as response:
-            if response.content_type == 'application/json':
-                return await response.json()
-
-            return await response.text()
-        
-
-# Function to handle incoming MQTT messages
-
-def on_message(client, userdata, msg):
-    global current_logs
-    payload = json.loads(msg.payload.decode())
-    device_id = msg.topic.split('/')[1]
-    logging.info(f"Received message from device {device_id}")
-  
-    log = {
-        "device_id": device_id,
-        "timestamp": datetime.datetime.now(),
-        "payload": payload
-    }
 
-    current_logs.append(log)
+# Seconds to wait before reconnecting to MQTT, doubled after every
+# failed connection up to the maximum
+RECONNECT_BACKOFF_SECONDS = 5
+MAX_RECONNECT_BACKOFF_SECONDS = 5 * 60
+# A connection that lasted this long was fine, so the backoff starts over
+STABLE_CONNECTION_SECONDS = 60
+# Printer state is written to printer_logs at most this often
+FLUSH_INTERVAL_SECONDS = 2
+# and at least this often, even if nothing meaningful changed
+HEARTBEAT_SECONDS = 5 * 60
+# Fields of a printer's print state that are worth a write when they change
+TRACKED_FIELDS = ["gcode_state", "subtask_name", "mc_percent", "mc_remaining_time", "print_error", "layer_num", "ams"]
+# Temperatures change constantly, so they're only written once they've moved this much
+TEMPERATURE_FIELDS = ["nozzle_temper", "bed_temper"]
+TEMPERATURE_CHANGE_DEGREES = 2
+# MQTT connection refused reason codes that mean the token is bad
+MQTT_AUTH_FAILURES = [4, 5, 134, 135]
+
+
+def merge_report(state: dict, report: dict):
+    # Apply a report delta to a printer's print state, nested objects are
+    # merged and everything else (including lists) is replaced
+    for key, value in report.items():
+        if isinstance(value, dict) and isinstance(state.get(key), dict):
+            merge_report(state[key], value)
+        else:
+            state[key] = value
+
+
+class PrinterState:
+    '''
+    The latest known state of one printer, built up from MQTT reports,
+    along with what was last written to printer_logs.
+    '''
+
+    def __init__(self, device_id: str, name: str, online: bool, last_gcode_state: Union[str, None]):
+        self.device_id = device_id
+        self.name = name
+        self.online = online
+        self.print: Union[dict, None] = None
+
+        self.written: Union[dict, None] = None
+        self.last_written = 0
+        # Used to add long term logs when the gcode state changes
+        self.last_gcode_state = last_gcode_state
+
+    def snapshot(self):
+        # The parts of the state worth writing when they change
+        data = self.print or {}
+        snapshot = {field: data.get(field) for field in TRACKED_FIELDS + TEMPERATURE_FIELDS}
+        snapshot["online"] = self.online
+        return snapshot
+
+    def has_meaningful_change(self):
+        if self.written is None:
+            return True
+
+        snapshot = self.snapshot()
+
+        for field, value in snapshot.items():
+            if field not in TEMPERATURE_FIELDS:
+                if value != self.written[field]:
+                    return True
+                continue
 
+            last_value = self.written[field]
+            if (value is None) != (last_value is None):
+                return True
+            if value is not None and abs(value - last_value) >= TEMPERATURE_CHANGE_DEGREES:
+                return True
+
+        return False
+
+
+class PrinterTelemetryService:
+    '''
+    Keeps one MQTT connection to the Bambu cloud open, reconnecting with
+    exponential backoff when it drops. Printers send a full report when
+    asked (pushall) and deltas after that, which are merged into an
+    in-memory state for each printer. State is written to printer_logs
+    when it changes meaningfully, at most every FLUSH_INTERVAL_SECONDS,
+    so printer status is close to real time without a write per message.
+    paho runs its own network thread, its callbacks are handed over to
+    the event loop.
+    '''
+
+    def __init__(self, client: BambuClient, mqtt_host: str, mqtt_port: int, mqtt_use_tls: bool):
+        self.bambu = client
+        self.mqtt_host = mqtt_host
+        self.mqtt_port = mqtt_port
+        self.mqtt_use_tls = mqtt_use_tls
+
+        self.printers: Dict[str, PrinterState] = {}
+
+        self.client: Union[mqtt.Client, None] = None
+        self.loop: Union[asyncio.AbstractEventLoop, None] = None
+        self.disconnected = asyncio.Event()
+        self.connected_at: Union[float, None] = None
+        # The token the current connection logged in with
+        self.client_token: Union[str, None] = None
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self):
+        if not self.bambu.configured:
+            return
 
-# Function to gather data for each device
-async def gather_device_data(client, device_id):
-    topic = f"device/{device_id}/request"
-    client.publish(topic, json.dumps(PUSHING_PUSHALL_REQUEST))
-    logging.info(f"Requested full data for device {device_id}")
+        self.loop = asyncio.get_running_loop()
+        self.tasks = [asyncio.create_task(self.run()), asyncio.create_task(self.run_writer())]
 
-async def bambu_update(on_refresh = False):
-    global current_token, current_refresh_token, current_logs
-    
-    if BAMBULABS_PASS == "PASSWORD":
-        return
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
 
-    # First try again once, but refresh the token
-    try:
-        if current_token is None and on_refresh is False:
-            current_token, current_refresh_token = await get_bambu_tokens()
-            logging.info("Got bambu tokens")
-        else:
-            current_token, current_refresh_token = await refresh_bambu_tokens(current_refresh_token)
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+        await self.disconnect()
+
+        # Write whatever changed since the last write
+        if len(self.printers) > 0:
+            await self.write_changes(MongoDB())
+
+    # Printers
+
+    async def refresh_devices(self):
+        # Update the list of printers, their names and whether they're online
+        if not self.bambu.configured:
+            return
+
+        devices = await self.bambu.get_devices()
+
+        db = MongoDB()
+        printer_collection = await db.get_collection("printer_logs")
+        last_printer_logs = {log["printer_name"]: log for log in await printer_collection.find({}).to_list(None)}
+
+        new_device_ids = []
+        for device in devices:
+            printer = self.printers.get(device["dev_id"])
+
+            if printer is None:
+                last_log = last_printer_logs.get(device["name"]) or {}
+                last_gcode_state = (last_log.get("printer_json") or {}).get("gcode_state")
+
+                printer = PrinterState(device["dev_id"], device["name"], device["online"], last_gcode_state)
+                self.printers[device["dev_id"]] = printer
+                new_device_ids.append(device["dev_id"])
+
+            printer.name = device["name"]
+            printer.online = device["online"]
+
+        # Ask every printer for a full report, which also resyncs any missed deltas
+        if self.client is not None and self.connected_at is not None:
+            for device_id in new_device_ids:
+                self.client.subscribe(f"device/{device_id}/report")
 
-        # Get user devices
-        devices = await bambu_api(current_token, GET_USER_DEVICES)
+            for device_id in self.printers:
+                self.request_pushall(device_id)
 
-        # Clear out the logs
-        current_logs = []
+    # MQTT connection
 
-        # Parse the JWT, and get the preferred username from the payload data
-        user_id = jwt.decode(current_token, options={"verify_signature": False, "verify_aud": False})
+    async def run(self):
+        failures = 0
 
-        user_id = user_id["preferred_username"]
+        while True:
+            try:
+                if len(self.printers) == 0:
+                    await self.refresh_devices()
 
-        # Connect to MQTT
-        client = mqtt.Client()
-        client.username_pw_set(f"u_{user_id}", current_token)
-        client.tls_set()  # Enable TLS
+                await self.connect()
+                await self.disconnected.wait()
+            except Exception as e:
+                logging.error(f"Bambu MQTT connection failed: {e}")
+            finally:
+                await self.disconnect()
 
-        client.on_message = on_message
+            now = self.loop.time()
+            if self.connected_at is not None and now - self.connected_at > STABLE_CONNECTION_SECONDS:
+                failures = 0
 
-        client.connect(MQTT_API, MQTT_PORT)
+            self.connected_at = None
+
+            failures += 1
+
+            delay = min(RECONNECT_BACKOFF_SECONDS * 2 ** (failures - 1), MAX_RECONNECT_BACKOFF_SECONDS)
+            delay *= random.uniform(0.5, 1)
+
+            logging.warning(f"Bambu MQTT disconnected, reconnecting in {delay:.0f}s")
+            await asyncio.sleep(delay)
+
+    async def connect(self):
+        self.disconnected.clear()
+        self.connected_at = None
+
+        # The MQTT username is the user id from the token
+        token = await self.bambu.get_token()
+        user_id = decode_token(token)["preferred_username"]
+
+        # paho reconnecting on its own would reuse the old token
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, reconnect_on_failure=False)
+        client.username_pw_set(f"u_{user_id}", token)
+        if self.mqtt_use_tls:
+            client.tls_set()
+
+        self.client_token = token
+
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.on_message = self.on_message
+
+        self.client = client
+
+        # Connecting blocks on DNS and the TLS handshake
+        await asyncio.to_thread(client.connect, self.mqtt_host, self.mqtt_port)
         client.loop_start()
 
-        # Loop through devices and gather data
-        for device in devices["devices"]:
-            device_id = device["dev_id"]
-            client.subscribe(f"device/{device_id}/report")  # Subscribe to report topic
-            await gather_device_data(client, device_id)  # Request data
+    async def disconnect(self):
+        client = self.client
+        self.client = None
 
-        # Keep the loop alive for a while to receive responses
-        await asyncio.sleep(10)
-        client.loop_stop()
+        if client is None:
+            return
 
         client.disconnect()
+        await asyncio.to_thread(client.loop_stop)
+
+    def request_pushall(self, device_id: str):
+        self.client.publish(f"device/{device_id}/request", json.dumps(PUSHING_PUSHALL_REQUEST))
+
+    # paho callbacks, called on its network thread
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        self.loop.call_soon_threadsafe(self.handle_connect, client, reason_code)
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self.loop.call_soon_threadsafe(self.disconnected.set)
+
+    def on_message(self, client, userdata, msg):
+        try:
+            payload = json.loads(msg.payload.decode())
+        except ValueError:
+            logging.warning(f"Received invalid MQTT message on {msg.topic}")
+            return
+
+        device_id = msg.topic.split('/')[1]
+        self.loop.call_soon_threadsafe(self.apply_report, device_id, payload)
+
+    # Handled on the event loop
 
-        # Now we have a list of logs
-        # For each device, use the most recent log that had a "print" key
-        # And save it to the database
+    def handle_connect(self, client, reason_code):
+        if client is not self.client:
+            return
+
+        if reason_code.is_failure:
+            logging.error(f"Bambu MQTT connection refused: {reason_code}")
+            if reason_code.value in MQTT_AUTH_FAILURES:
+                self.bambu.invalidate_token(self.client_token)
+
+            self.disconnected.set()
+            return
+
+        logging.info("Connected to Bambu MQTT")
+        self.connected_at = self.loop.time()
+
+        # Subscribe to each printer's reports and ask for its full state
+        for device_id in self.printers:
+            client.subscribe(f"device/{device_id}/report")
+            self.request_pushall(device_id)
+
+    def apply_report(self, device_id: str, payload: dict):
+        printer = self.printers.get(device_id)
+
+        if printer is None or "print" not in payload:
+            return
+
+        report = payload["print"]
+
+        if report.get("command") != "push_status":
+            return
+
+        # Remove upgrade state because it has the
+        # serial number of the printer
+        # Remove net because it has the IP address
+        report.pop("upgrade_state", None)
+        report.pop("net", None)
+
+        if printer.print is None or report.get("msg") == 0:
+            # A full report replaces the state
+            printer.print = report
+        else:
+            merge_report(printer.print, report)
+
+        # A printer that's reporting is online
+        printer.online = True
+
+    # Writing state
+
+    async def run_writer(self):
         db = MongoDB()
+
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL_SECONDS)
+
+            try:
+                await self.write_changes(db)
+            except Exception as e:
+                logging.error(f"Failed to write printer state: {e}")
+
+    async def write_changes(self, db: MongoDB):
+        now = datetime.datetime.now().timestamp()
+
+        for printer in list(self.printers.values()):
+            if printer.has_meaningful_change() or now - printer.last_written > HEARTBEAT_SECONDS:
+                await self.write_printer(db, printer)
+
+    async def write_printer(self, db: MongoDB, printer: PrinterState):
         printer_collection = await db.get_collection("printer_logs")
         long_term_logs_collection = await db.get_collection("printer_long_term_logs")
 
-        last_printer_logs_cursor = printer_collection.find({})
-        last_printer_logs_list = await last_printer_logs_cursor.to_list(length=None)
-        last_printer_logs = {log["printer_name"]:log for log in last_printer_logs_list}
-
-        for device in devices["devices"]:
-            device_id = device["dev_id"]
-            logs = [log for log in current_logs if log["device_id"] == device_id]
-            logs = sorted(logs, key=lambda x: x["timestamp"], reverse=True)
-
-            printer_log = {
-                "uuid": str(uuid.uuid4()),
-                "timestamp": datetime.datetime.now().timestamp(),
-                "printer_name": device["name"],
-                "printer_online": device["online"],
-                "printer_json": None
-            }
-
-            for log in logs:
-                if "print" in log["payload"] and log["payload"]["print"]["msg"] == 0:
-                    data = log["payload"]["print"]
-
-                    # Remove upgrade state because it has the 
-                    # serial number of the printer
-                    # Remove net because it has the IP address
-                    if "upgrade_state" in data:
-                        del data["upgrade_state"]
-
-                    if "net" in data:
-                        del data["net"]
-
-                    printer_log["printer_json"] = data
-                    break
-                
-            
-            printer_log_object = PrinterLog(**printer_log)
-
-            # We only want to store one log per printer, so we will perform an
-            # upsert=True operation querying by printer name
-            await printer_collection.update_one(
-                # Update the printer by this name
-                {"printer_name": printer_log_object.printer_name},
-                # Update with all printer_log data
-                {"$set": printer_log_object.model_dump()},
-                # upsert = True, which will modify the existing log instead of
-                # adding a new one to the collection
-                True
-            )
-
-            # -- LONG TERM PRINT LOGS ---
-
-            # Only add to long term logs if the following fields are valid:
-            # 1. This print log has a printer name
-            if not printer_log["printer_name"]:
-                continue
-            # 2. This print log has a printer json
-            if not printer_log["printer_json"]:
-                continue
-            # 3. This print log has a gcode state
-            if not printer_log["printer_json"]["gcode_state"]:
-                continue
-            # 4. The last stored print log exists for this printer name
-            if not last_printer_logs[printer_log["printer_name"]]:
-                continue
-            # 5. The last stored print log for this printer name has a printer json
-            if not last_printer_logs[printer_log["printer_name"]]["printer_json"]:
-                continue
-            # 6. The last stored print log for this printer name has a gcode state
-            if not last_printer_logs[printer_log["printer_name"]]["printer_json"]["gcode_state"]:
-                continue
-            # If all fields are valid, find the last and current gcode state
-            last_gcode_state = last_printer_logs[printer_log["printer_name"]]["printer_json"]["gcode_state"]
-            current_gcode_state = printer_log["printer_json"]["gcode_state"]
-
-            # If the gcode state has changed, add the printer log to the long-term logs
-            if (last_gcode_state != current_gcode_state):
-                await long_term_logs_collection.insert_one(printer_log_object.model_dump())
-
-    except Exception as e:
-        # print traceback
-        logging.error(traceback.format_exc())
-        if on_refresh:
-            logging.error("Failed to refresh bambu token: " + str(e))
-            return
-        
-        # Wrap this in a try except block to prevent the server from crashings
-        # in case the problem is with the API, not the token
-        try:
-            current_token, current_refresh_token = await get_bambu_tokens()
-        except Exception as e_1:
-            logging.error(traceback.format_exc())
-            logging.error("Failed to get bambu tokens: " + str(e_1))
+        printer_log_object = PrinterLog(
+            uuid=str(uuid.uuid4()),
+            timestamp=datetime.datetime.now().timestamp(),
+            printer_name=printer.name,
+            printer_online=printer.online,
+            printer_json=copy.deepcopy(printer.print),
+        )
+
+        # We only want to store one log per printer, so we will perform an
+        # upsert=True operation querying by printer name
+        await printer_collection.update_one(
+            {"printer_name": printer_log_object.printer_name},
+            {"$set": printer_log_object.model_dump()},
+            True
+        )
+
+        printer.written = printer.snapshot()
+        printer.last_written = printer_log_object.timestamp
+
+        # -- LONG TERM PRINT LOGS ---
+
+        # Add to long term logs when the printer has a name and its
+        # gcode state changed from a known state to a new one
+        gcode_state = (printer.print or {}).get("gcode_state")
+
+        if not printer.name or not gcode_state:
             return
-        
-        await bambu_update(on_refresh = True)
\ No newline at end of file
+
+        if printer.last_gcode_state and printer.last_gcode_state != gcode_state:
+            await long_term_logs_collection.insert_one(printer_log_object.model_dump())
+
+        printer.last_gcode_state = gcode_state
+
+
+printer_telemetry = PrinterTelemetryService(bambu_client, BAMBU_MQTT_HOST, BAMBU_MQTT_PORT, BAMBU_MQTT_USE_TLS)
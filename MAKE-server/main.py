@@ -1,6 +1,5 @@
 import datetime
 import os
-import uuid
 from fastapi import FastAPI
 from fastapi import Request
 from fastapi.staticfiles import StaticFiles
@@ -8,6 +7,7 @@ from fastapi.responses import RedirectResponse
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.exceptions import HTTPException
 from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from pymongo.errors import OperationFailure
 
 import asyncio
 import uvicorn
@@ -47,7 +47,15 @@ from users.users import cleanup_user_files, create_update_users_from_quizzes
 from users.workshops import send_workshop_reminders, update_workshops_live_status
 from inventory.checkouts import send_overdue_emails
 from inventory.inventory import update_inventory_from_checkouts
-from machines.printers import bambu_update
+from machines.printers import printer_telemetry
+from machines.bambu import bambu_client
+from misc.redirects import redirect_table, LOG_FLUSH_INTERVAL_SECONDS
+from misc.scheduler import scheduler
+from misc.outbox import outbox
+from misc.blob_store import blob_store
+from misc.photos import photo_processor
+from misc.downloads import DOWNLOAD_PATHS
+from machines.loom import loom_render_pool
 
 # SSL certificate paths, on a Debian system
 SSL_CERT_PRIVKEY = "/etc/letsencrypt/live/make.hmc.edu/privkey.pem"
@@ -83,7 +91,22 @@ app = FastAPI(
     },
 )
 
-app.add_middleware(GZipMiddleware)
+class DownloadAwareGZipMiddleware:
+    # GZip responses, except for file downloads. They are mostly
+    # compressed already, and their byte ranges refer to the stored file
+    def __init__(self, app):
+        self.app = app
+        self.gzip = GZipMiddleware(app)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and scope["path"].startswith(DOWNLOAD_PATHS):
+            await self.app(scope, receive, send)
+            return
+
+        await self.gzip(scope, receive, send)
+
+
+app.add_middleware(DownloadAwareGZipMiddleware)
 
 app.include_router(inventory_router)
 app.include_router(user_router)
@@ -119,42 +142,18 @@ class RedirectMiddleware:
         await self.app(scope, receive, send)
 
     async def redirect(self, request: Request):
-        # Get the path
-        path = request.url.path
+        # Look the path up in the in-memory redirect table,
+        # which skips API and static file paths outright
+        url = redirect_table.lookup(request.url.path)
 
-        if len(path) < 2:
+        if url is None:
             return None
 
-        # Remove the / from the beginning of the path
-        if path[0] == "/":
-            path = path[1:]
-
-        # Remove the / from the end of the path
-        if path[-1] == "/":
-            path = path[:-1]
-
-        # Get the database
-        db = MongoDB()
+        # Log the hit, it's written to the database in the background
+        redirect_table.log_hit(request.url.path, request.client.host)
 
-        # Get the redirects collection
-        collection = await db.get_collection("redirects")
-
-        redirect = await collection.find_one({"path": path})
-
-        if redirect is not None:
-            ip_log = {
-                "uuid": str(uuid.uuid4()),
-                "timestamp": datetime.datetime.now().timestamp(),
-                "ip": request.client.host,
-            }
-
-            # Add to the logs attribute of the redirect
-            await collection.update_one({"path": path}, {"$push": {"logs": ip_log}})
-
-            # Redirect to the redirect path
-            return RedirectResponse(url=redirect["redirect"])
-        else:
-            return None
+        # Redirect to the redirect path
+        return RedirectResponse(url=url)
 
 
 app.add_middleware(RedirectMiddleware)
@@ -177,9 +176,17 @@ async def validate_database_schema(db):
         if name not in collections:
             # Create the collection if it does not exist
             await db.create_collection(name)
+            collections.append(name)
             # Print log message
             logging.info(f"Created collection {name} in database {db.name}")
 
+    # Cache the collection names, so get_collection doesn't
+    # need to ask the server on every call
+    set_collection_names(collections)
+
+    # Make sure every collection has the indexes declared in db_schema
+    await validate_database_indexes(db)
+
     # Check that there's a single document in the status collection
     # with the name "status"
     status = await db["status"].find_one({"name": "status"})
@@ -206,57 +213,135 @@ async def validate_database_schema(db):
         logging.info(f"Created status document in database {db.name}")
 
 
-class BackgroundRunner:
-    def __init__(self):
-        return
+async def validate_database_indexes(db):
+    # Create any indexes declared in db_schema.indexes that are missing,
+    # and report indexes that differ from or aren't in the declaration.
+    # Creating an index that already exists is a no-op, so this is safe
+    # to run on every startup.
+    for name, index_models in indexes.items():
+        collection = db[name]
+
+        existing = await collection.index_information()
+        expected = {index.document["name"]: index for index in index_models}
+
+        missing = []
+        for index_name, index in expected.items():
+            if index_name not in existing:
+                missing.append(index)
+            elif existing[index_name].get("unique", False) != index.document.get("unique", False):
+                # Same keys but different options, this has to be fixed by hand
+                logging.warning(f"Index {index_name} on {name} does not match its declared options")
+
+        for index_name in existing:
+            if index_name != "_id_" and index_name not in expected:
+                logging.warning(f"Collection {name} has undeclared index {index_name}")
+
+        if len(missing) == 0:
+            continue
+
+        missing_names = ", ".join(index.document["name"] for index in missing)
+
+        try:
+            await collection.create_indexes(missing)
+            logging.info(f"Created indexes {missing_names} on {name} in database {db.name}")
+        except OperationFailure as e:
+            # Most likely a unique index over existing duplicates,
+            # don't stop the server from starting because of it
+            logging.error(f"Failed to create indexes {missing_names} on {name}: {e}")
+
+
+# Background jobs and how often they run, in seconds
+# Refresh the list of Bambu printers and resync their state, updates
+# arrive continuously over printer_telemetry's MQTT connection
+scheduler.add("bambu_update", printer_telemetry.refresh_devices, 5 * 60)
+# Update available inventory from checkouts. This also runs whenever a
+# checkout or inventory item changes, the interval is only a safety net
+scheduler.add("update_inventory_from_checkouts", update_inventory_from_checkouts, 10 * 60)
+# Send emails for checkouts that are overdue
+scheduler.add("send_overdue_emails", send_overdue_emails, 5 * 60)
+# Scrape quiz results
+scheduler.add("scrape_quiz_results", scrape_quiz_results, 5 * 60)
+# Create/update users from quizzes
+scheduler.add("create_update_users_from_quizzes", create_update_users_from_quizzes, 5 * 60)
+# Send email reminders for workshops
+scheduler.add("send_workshop_reminders", send_workshop_reminders, 60)
+# Check to see if workshops need to go live
+scheduler.add("update_workshops_live_status", update_workshops_live_status, 30)
+# Free up files in user storage
+scheduler.add("cleanup_user_files", cleanup_user_files, 60 * 60)
+# Delete old sent and failed emails from the outbox
+scheduler.add("purge_outbox", outbox.purge_old_messages, 60 * 60)
+# Write buffered redirect hits
+scheduler.add("flush_redirect_logs", redirect_table.write_logs, LOG_FLUSH_INTERVAL_SECONDS)
+
+
+def update_last_updated_time():
+    utilities.last_updated_time = datetime.datetime.now()
+
+
+async def migrate_files_and_resume_photos(db: MongoDB):
+    await blob_store.migrate_legacy_files(db)
+    await photo_processor.resume(db)
+
 
-    async def run_main(self):
-        # Wait 1 second before starting the background tasks
-        await asyncio.sleep(1)
+@app.on_event("startup")
+async def app_startup():
+    # Validate the database schema on the server's event loop, so the
+    # pooled database client is bound to the same loop as the routes
+    logging.info("Validating database schema...")
+    db = MongoDB()
+    await validate_database_schema(db.db)
+    logging.info("Database schema is valid!")
 
-        while True:
-            try:
-                # Get printers from Bambu MQTT server
-                await bambu_update()
+    # Load redirects for RedirectMiddleware
+    await redirect_table.load(db)
 
-                # Update available inventory from checkouts
-                await update_inventory_from_checkouts()
+    # Start sending queued emails
+    await outbox.start()
 
-                # Send emails for checkouts that are overdue
-                await send_overdue_emails()
+    # Start making renditions of uploaded workshop photos
+    photo_processor.start()
 
-                # Scrape quiz results
-                await scrape_quiz_results()
+    # Start the processes that render loom files
+    loom_render_pool.start()
 
-                # Create/update users from quizzes
-                await create_update_users_from_quizzes()
+    # Start receiving printer updates from Bambu MQTT
+    printer_telemetry.start()
 
-                # Send email reminders for workshops
-                await send_workshop_reminders()
+    # Move files stored by uuid into the blob store in the background,
+    # they are served from their old location until then. Then queue
+    # the photos that still need renditions
+    asyncio.create_task(migrate_files_and_resume_photos(db))
 
-                # Check to see if workshops need to go live
-                await update_workshops_live_status()
+    # Start the background jobs
+    scheduler.start(on_success=update_last_updated_time)
 
-                # Free up files in user storage
-                await cleanup_user_files()
+    asyncio.create_task(run_discord_bot(DISCORD_BOT_TOKEN))
 
-                utilities.last_updated_time = datetime.datetime.now()
 
-                await asyncio.sleep(1)
-            except Exception as e:
-                logging.error(f"An error occurred in the background runner: {e}")
+@app.on_event("shutdown")
+async def app_shutdown():
+    # Stop the background jobs
+    await scheduler.stop()
 
-                # Wait 1 minute before trying again
-                await asyncio.sleep(60)
+    # Write any redirect hits that are still buffered
+    await redirect_table.flush_logs(MongoDB())
 
+    # Stop the email workers, unsent emails stay queued in the outbox
+    await outbox.stop()
 
-runner = BackgroundRunner()
+    # Stop processing photos, unprocessed ones are queued again on startup
+    await photo_processor.stop()
 
+    # Stop rendering loom files
+    loom_render_pool.stop()
 
-@app.on_event("startup")
-async def app_startup():
-    asyncio.create_task(runner.run_main())
-    asyncio.create_task(run_discord_bot(DISCORD_BOT_TOKEN))
+    # Disconnect from Bambu MQTT, writing any unwritten printer state
+    await printer_telemetry.stop()
+    await bambu_client.close()
+
+    # Close the pooled database client
+    close_client()
 
 
 if __name__ == "__main__":
@@ -286,18 +371,6 @@ if __name__ == "__main__":
 
     logging.info("Starting MAKE server...")
 
-    logging.info("Connecting to database...")
-    # Connect to mongoDB database
-    db = MongoDB()
-
-    logging.info("Connected to database!")
-
-    logging.info("Validating database schema...")
-    # Validate the database schema using future
-    asyncio.run(validate_database_schema(db.db))
-
-    logging.info("Database schema is valid!")
-
     # Set timezone to Pacific time, following daylight savings
     os.environ["TZ"] = "US/Pacific"
 
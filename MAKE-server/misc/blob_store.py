@@ -0,0 +1,264 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+from typing import List, Union
+
+from pymongo import ReturnDocument
+from db_schema import MongoDB
+
+# Directory blobs are stored in, as blobs/<first 2 hash characters>/<hash>
+BLOB_DIR = "blobs"
+# Files are hashed in chunks of this size
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def hash_file(path: str):
+    # Get the sha256 of a file on disk. This blocks, so run it in a thread
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_BYTES)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class BlobStore:
+    '''
+    Content-addressed storage for user_files and server_files. Each distinct
+    file is stored once under its sha256, and the blobs collection counts how
+    many user_files and server_files documents refer to it. The data is
+    deleted when the last reference is released. Since a blob never changes,
+    its hash is also a strong ETag.
+    '''
+
+    def __init__(self):
+        # Adding and releasing references must not interleave, or a blob
+        # could be deleted just as a new upload of it is being added
+        self.lock = asyncio.Lock()
+
+    def path(self, blob_hash: str):
+        return os.path.join(BLOB_DIR, blob_hash[:2], blob_hash)
+
+    def file_path(self, file: dict, legacy_dir: str):
+        # Get the path to the data of a user_files or server_files document.
+        # Files that haven't been migrated yet are still stored by uuid
+        if file.get("hash") is not None:
+            return self.path(file["hash"])
+
+        return os.path.join(legacy_dir, file["uuid"])
+
+    def move_into_store(self, path: str, blob_hash: str):
+        # Move a file into the store, or drop it if the blob is already stored
+        blob_path = self.path(blob_hash)
+
+        if os.path.exists(blob_path):
+            os.remove(path)
+            return
+
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(path, blob_path)
+
+    async def add_file(self, db: MongoDB, path: str, blob_hash: Union[str, None] = None):
+        # Add a reference to the blob with the contents of the file at path,
+        # moving the file into the store. Returns the hash of the blob
+        if blob_hash is None:
+            blob_hash = await asyncio.to_thread(hash_file, path)
+
+        size = await asyncio.to_thread(os.path.getsize, path)
+
+        collection = await db.get_collection("blobs")
+
+        async with self.lock:
+            await asyncio.to_thread(self.move_into_store, path, blob_hash)
+
+            await collection.update_one(
+                {"hash": blob_hash},
+                {"$inc": {"refs": 1}, "$setOnInsert": {"size": size, "timestamp": datetime.datetime.now().timestamp()}},
+                upsert=True,
+            )
+
+        return blob_hash
+
+    async def add_bytes(self, db: MongoDB, data: bytes):
+        # Add a reference to the blob with the given contents
+        os.makedirs(BLOB_DIR, exist_ok=True)
+        temp_path = os.path.join(BLOB_DIR, f".add-{uuid.uuid4().hex}")
+
+        def write():
+            with open(temp_path, "wb") as f:
+                f.write(data)
+
+            return hashlib.sha256(data).hexdigest()
+
+        blob_hash = await asyncio.to_thread(write)
+
+        return await self.add_file(db, temp_path, blob_hash)
+
+    async def release(self, db: MongoDB, blob_hashes: List[str]):
+        # Release one reference to each blob, deleting blobs that are no
+        # longer referenced. Returns the number of bytes freed on disk
+        collection = await db.get_collection("blobs")
+        unreferenced = []
+
+        async with self.lock:
+            for blob_hash in blob_hashes:
+                blob = await collection.find_one_and_update(
+                    {"hash": blob_hash},
+                    {"$inc": {"refs": -1}},
+                    return_document=ReturnDocument.AFTER,
+                )
+
+                if blob is not None and blob["refs"] <= 0:
+                    await collection.delete_one({"hash": blob_hash, "refs": {"$lte": 0}})
+                    unreferenced.append(blob_hash)
+
+            return await asyncio.to_thread(self.delete_blobs, unreferenced)
+
+    def delete_blobs(self, blob_hashes: List[str]):
+        freed_bytes = 0
+
+        for blob_hash in blob_hashes:
+            try:
+                freed_bytes += os.path.getsize(self.path(blob_hash))
+                os.remove(self.path(blob_hash))
+            except FileNotFoundError:
+                pass
+
+        return freed_bytes
+
+    def find_blob_files(self, older_than: float):
+        # List the hashes of stored blobs, skipping recently written ones
+        if not os.path.exists(BLOB_DIR):
+            return []
+
+        blob_hashes = []
+
+        for directory in os.scandir(BLOB_DIR):
+            if not directory.is_dir():
+                # Leftover from an interrupted add_bytes
+                if directory.stat().st_mtime < older_than:
+                    os.remove(directory.path)
+                continue
+
+            for entry in os.scandir(directory.path):
+                if entry.stat().st_mtime < older_than:
+                    blob_hashes.append(entry.name)
+
+        return blob_hashes
+
+    async def sweep_orphans(self, db: MongoDB, older_than: float):
+        # Delete stored blobs without a blobs document, e.g. from a crash
+        # between storing a blob and counting its reference.
+        # Returns the number of blobs deleted and the bytes freed
+        collection = await db.get_collection("blobs")
+
+        async with self.lock:
+            blob_hashes = await asyncio.to_thread(self.find_blob_files, older_than)
+            known = set(await collection.distinct("hash", {"hash": {"$in": blob_hashes}}))
+            orphans = [blob_hash for blob_hash in blob_hashes if blob_hash not in known]
+
+            return len(orphans), await asyncio.to_thread(self.delete_blobs, orphans)
+
+    def link_into_store(self, path: str, blob_hash: str):
+        # Hardlink (or copy, across filesystems) a file into the store,
+        # leaving the original in place
+        blob_path = self.path(blob_hash)
+
+        if os.path.exists(blob_path):
+            return
+
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        temp_path = os.path.join(BLOB_DIR, f".add-{uuid.uuid4().hex}")
+
+        try:
+            os.link(path, temp_path)
+        except OSError:
+            shutil.copyfile(path, temp_path)
+
+        os.replace(temp_path, blob_path)
+
+    async def migrate_file(self, db: MongoDB, collection, file_uuid: str, path: str):
+        # Move one file stored by uuid into the store. Every step can be
+        # retried after a crash, and the file stays readable from its old
+        # location until its document has the hash
+        blob_hash = await asyncio.to_thread(hash_file, path)
+        size = await asyncio.to_thread(os.path.getsize, path)
+
+        blobs_collection = await db.get_collection("blobs")
+
+        async with self.lock:
+            await asyncio.to_thread(self.link_into_store, path, blob_hash)
+
+            await blobs_collection.update_one(
+                {"hash": blob_hash},
+                {"$setOnInsert": {"size": size, "refs": 0, "timestamp": datetime.datetime.now().timestamp()}},
+                upsert=True,
+            )
+
+            # The file's uuid is recorded with its reference, so a
+            # retry after a crash doesn't count it twice
+            await blobs_collection.update_one(
+                {"hash": blob_hash, "migrating": {"$ne": file_uuid}},
+                {"$inc": {"refs": 1}, "$push": {"migrating": file_uuid}},
+            )
+
+        result = await collection.update_one({"uuid": file_uuid, "hash": None}, {"$set": {"hash": blob_hash}})
+        await blobs_collection.update_one({"hash": blob_hash}, {"$pull": {"migrating": file_uuid}})
+
+        if result.matched_count == 0:
+            # The file was deleted while it was being migrated
+            await self.release(db, [blob_hash])
+
+    async def migrate_legacy_files(self, db: MongoDB):
+        # Move user_files and server_files stored by uuid from before the
+        # blob store into it. Safe to run on every startup
+        for collection_name, legacy_dir in (("user_files", "user_files"), ("server_files", "server_files")):
+            collection = await db.get_collection(collection_name)
+
+            legacy_uuids = await asyncio.to_thread(list_files, legacy_dir)
+            if len(legacy_uuids) == 0:
+                continue
+
+            files = await collection.find({"uuid": {"$in": legacy_uuids}}, {"uuid": 1, "hash": 1}).to_list(None)
+
+            migrated = 0
+            for file in files:
+                path = os.path.join(legacy_dir, file["uuid"])
+
+                if file.get("hash") is None:
+                    try:
+                        await self.migrate_file(db, collection, file["uuid"], path)
+                    except Exception as e:
+                        logging.error(f"Failed to migrate {path} to the blob store: {e}")
+                        continue
+
+                    migrated += 1
+
+                # The document refers to the blob now, so the old copy can go.
+                # This also removes copies left behind by an interrupted run
+                try:
+                    await asyncio.to_thread(os.remove, path)
+                except FileNotFoundError:
+                    pass
+
+            if migrated > 0:
+                logging.info(f"Migrated {migrated} {collection_name} to the blob store")
+
+
+def list_files(directory: str):
+    if not os.path.exists(directory):
+        return []
+
+    with os.scandir(directory) as entries:
+        return [entry.name for entry in entries if entry.is_file()]
+
+
+blob_store = BlobStore()
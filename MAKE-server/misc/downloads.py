@@ -0,0 +1,180 @@
+import mimetypes
+import os
+from email.utils import formatdate
+from typing import Tuple, Union
+from urllib.parse import quote
+
+import anyio
+from fastapi import HTTPException, Request
+from starlette.background import BackgroundTask
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+# Paths of routes that send files, they skip GZip since their byte
+# ranges and ETags refer to the stored data
+DOWNLOAD_PATHS = (
+    "/api/v2/users/download_file/",
+    "/api/v2/workshops/download_photo/",
+)
+# Files are sent in chunks of this size
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+# Content addressed data never changes, so it can be cached for a year
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Anything else can be cached, but has to be checked with the ETag first
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+class FileRangeResponse(Response):
+    '''
+    Sends bytes start to end (inclusive) of a file, streamed
+    in chunks with the reads happening in a thread.
+    '''
+
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: dict, media_type: str):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background: Union[BackgroundTask, None] = None
+        self.init_headers(headers)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+
+        remaining = self.end - self.start + 1
+
+        if scope["method"] == "HEAD" or remaining <= 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        async with await anyio.open_file(self.path, "rb") as f:
+            await f.seek(self.start)
+
+            while remaining > 0:
+                chunk = await f.read(min(DOWNLOAD_CHUNK_BYTES, remaining))
+
+                if not chunk:
+                    # The file was truncated while being sent
+                    break
+
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+
+        if remaining > 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def etag_matches(header: str, etag: str):
+    # If-None-Match uses weak comparison, so W/ prefixes are ignored
+    if header.strip() == "*":
+        return True
+
+    tags = [tag.strip() for tag in header.split(",")]
+    return etag.removeprefix("W/") in [tag.removeprefix("W/") for tag in tags]
+
+
+def parse_range(header: str, size: int) -> Union[Tuple[int, int], None]:
+    # Parse a single "bytes=start-end" range into inclusive offsets.
+    # Returns None for ranges that should be ignored, like multiple ranges
+    # or invalid ones, and raises a 416 for ranges starting past the file
+    unit, _, ranges = header.partition("=")
+
+    if unit.strip() != "bytes" or "," in ranges:
+        return None
+
+    start, _, end = ranges.strip().partition("-")
+
+    try:
+        if start == "":
+            # The last end bytes of the file
+            length = int(end)
+            if length <= 0:
+                raise ValueError()
+            start = max(0, size - length)
+            end = size - 1
+        else:
+            start = int(start)
+
+            if end == "":
+                end = size - 1
+            elif int(end) < start:
+                # An invalid range, like bytes=5-3, is ignored rather than refused
+                return None
+            else:
+                end = int(end)
+    except ValueError:
+        return None
+
+    if start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+
+    return start, min(end, size - 1)
+
+
+def content_disposition(filename: str, inline: bool):
+    disposition = "inline" if inline else "attachment"
+    quoted = quote(filename)
+
+    if quoted != filename:
+        return f"{disposition}; filename*=utf-8''{quoted}"
+
+    return f'{disposition}; filename="{filename}"'
+
+
+async def send_file(
+    request: Request,
+    path: str,
+    filename: str,
+    etag: Union[str, None] = None,
+    cache_control: str = REVALIDATE_CACHE_CONTROL,
+    inline: bool = False,
+):
+    '''
+    Respond with a file, supporting conditional GETs with If-None-Match
+    and resumable downloads with Range. etag should be the file's hash
+    when it is content addressed, otherwise a weak ETag is made from its
+    modification time and size.
+    '''
+    try:
+        stat = await anyio.to_thread.run_sync(os.stat, path)
+    except FileNotFoundError:
+        # The file does not exist
+        # Return error
+        raise HTTPException(status_code=404, detail="File does not exist")
+
+    size = stat.st_size
+    etag = f'"{etag}"' if etag is not None else f'W/"{int(stat.st_mtime):x}-{size:x}"'
+
+    headers = {
+        "ETag": etag,
+        "Cache-Control": cache_control,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        # The client already has this version
+        return Response(status_code=304, headers=headers)
+
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    headers["Content-Disposition"] = content_disposition(filename, inline)
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+
+    # If-Range needs a strong match, otherwise the whole file is sent
+    if range_header is not None and (if_range is None or (if_range == etag and not etag.startswith("W/"))):
+        byte_range = parse_range(range_header, size)
+
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return FileRangeResponse(path, 0, size - 1, 200, headers, media_type)
+
+    start, end = byte_range
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    return FileRangeResponse(path, start, end, 206, headers, media_type)
@@ -0,0 +1,281 @@
+import asyncio
+import datetime
+import logging
+import smtplib
+import ssl
+import uuid
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import List, Union
+
+from pymongo import ReturnDocument
+from config import GMAIL_EMAIL, GMAIL_PASS, SMTP_HOST, SMTP_PORT, SMTP_USE_SSL, EMAIL_WORKERS
+from db_schema import MongoDB, OutboxMessage
+
+# Give up on a message after this many failed attempts
+MAX_ATTEMPTS = 6
+# Seconds to wait before retrying, doubled after every failed attempt
+RETRY_BACKOFF_SECONDS = 30
+# How often idle workers check for messages that are due for a retry
+POLL_INTERVAL_SECONDS = 15
+# Close a worker's SMTP connection after it has been idle this long,
+# well before the server drops it on its own
+IDLE_DISCONNECT_SECONDS = 120
+# Seconds a worker waits after an unexpected error (e.g. the database
+# being unreachable), doubled after every consecutive error
+WORKER_ERROR_BACKOFF_SECONDS = 1
+MAX_WORKER_ERROR_BACKOFF_SECONDS = 60
+# Sent messages are kept this long for debugging, failed ones longer
+SENT_RETENTION_SECONDS = 7 * 24 * 60 * 60
+FAILED_RETENTION_SECONDS = 30 * 24 * 60 * 60
+
+
+class SMTPConnection:
+    '''
+    A single authenticated SMTP connection, opened on first use and
+    reused for every message a worker sends. smtplib is blocking, so
+    all of these methods are run in a thread by the worker.
+    '''
+
+    def __init__(self, host: str, port: int, use_ssl: bool):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.server: Union[smtplib.SMTP, None] = None
+
+    def connect(self):
+        context = ssl.create_default_context()
+
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.host, self.port, context=context, timeout=30)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=30)
+
+        try:
+            server.ehlo()
+
+            # Submission ports (587) only offer AUTH after STARTTLS
+            if not self.use_ssl and server.has_extn("starttls"):
+                server.starttls(context=context)
+                server.ehlo()
+
+            if server.has_extn("auth"):
+                server.login(GMAIL_EMAIL, GMAIL_PASS)
+            elif GMAIL_PASS not in ("", "PASSWORD"):
+                # Sending without logging in would be rejected or
+                # marked as spam, so fail with a clear reason instead
+                raise smtplib.SMTPNotSupportedError(f"{self.host}:{self.port} doesn't offer AUTH, but GMAIL_PASS is set")
+        except Exception:
+            server.close()
+            raise
+
+        self.server = server
+
+    def send(self, sender_email: str, recipients: List[str], message: str):
+        if self.server is None:
+            self.connect()
+
+        try:
+            self.server.sendmail(sender_email, recipients, message)
+        except smtplib.SMTPServerDisconnected:
+            # The server closed the connection since the last message,
+            # reconnect and try once more
+            self.connect()
+            self.server.sendmail(sender_email, recipients, message)
+
+    def close(self):
+        if self.server is None:
+            return
+
+        try:
+            self.server.quit()
+        except Exception:
+            pass
+
+        self.server = None
+
+
+def build_message(message: dict):
+    # Build the MIME message for an outbox document
+    sender_email = f" MAKE <{GMAIL_EMAIL}>"
+
+    mime = MIMEMultipart("alternative")
+    mime["Subject"] = message["subject"]
+    mime["From"] = sender_email
+    mime["To"] = message["to"]
+    mime["Cc"] = ", ".join(message["cc"])
+
+    mime.attach(MIMEText(message["html_body"], "html"))
+
+    return sender_email, [message["to"]] + message["cc"], mime.as_string()
+
+
+class Outbox:
+    '''
+    Emails are queued in the outbox collection, so they survive restarts,
+    and sent in the background by a small pool of workers. Each worker
+    keeps its own SMTP connection alive between messages and runs the
+    blocking smtplib calls in a thread, so sending never blocks requests.
+    Failed messages are retried with exponential backoff.
+    '''
+
+    def __init__(self, workers: int, smtp_host: str, smtp_port: int, smtp_use_ssl: bool):
+        self.workers = workers
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.smtp_use_ssl = smtp_use_ssl
+        self.tasks: List[asyncio.Task] = []
+        self.connections: List[SMTPConnection] = []
+        # Set whenever a message is queued, to wake idle workers
+        self.wakeup = asyncio.Event()
+
+    async def enqueue(self, to: str, cc: List[str], subject: str, html_body: str):
+        # Queue an email, it is sent by the workers in the background
+        now = datetime.datetime.now().timestamp()
+
+        message = OutboxMessage(
+            uuid=str(uuid.uuid4()),
+            to=to,
+            cc=cc,
+            subject=subject,
+            html_body=html_body,
+            next_attempt=now,
+            timestamp_created=now,
+        )
+
+        db = MongoDB()
+        collection = await db.get_collection("outbox")
+        await collection.insert_one(message.model_dump())
+
+        logging.info(f"Queued email to {to}: {subject}")
+
+        self.wakeup.set()
+
+        return message.uuid
+
+    async def start(self):
+        # Messages left "sending" by a previous process were interrupted
+        # mid-send, put them back in the queue
+        db = MongoDB()
+        collection = await db.get_collection("outbox")
+        await collection.update_many({"status": "sending"}, {"$set": {"status": "pending"}})
+
+        for i in range(self.workers):
+            connection = SMTPConnection(self.smtp_host, self.smtp_port, self.smtp_use_ssl)
+            self.connections.append(connection)
+            self.tasks.append(asyncio.create_task(self.run_worker(i, connection)))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+        for connection in self.connections:
+            await asyncio.to_thread(connection.close)
+
+        self.connections = []
+
+    async def claim_message(self, db: MongoDB):
+        # Atomically take the next due message, so no two workers send the same one
+        collection = await db.get_collection("outbox")
+
+        return await collection.find_one_and_update(
+            {"status": "pending", "next_attempt": {"$lte": datetime.datetime.now().timestamp()}},
+            {"$set": {"status": "sending"}, "$inc": {"attempts": 1}},
+            sort=[("next_attempt", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def send_message(self, db: MongoDB, connection: SMTPConnection, message: dict):
+        collection = await db.get_collection("outbox")
+
+        logging.info(f"Emailing user {message['to']}...")
+        logging.info(f"\tSubject: {message['subject']}")
+        logging.info(f"\tCC: {', '.join(message['cc'])}")
+
+        try:
+            await asyncio.to_thread(connection.send, *build_message(message))
+        except Exception as e:
+            # Drop the connection, it may be in a bad state
+            await asyncio.to_thread(connection.close)
+
+            if message["attempts"] >= MAX_ATTEMPTS:
+                logging.error(f"Giving up on email {message['uuid']} to {message['to']}: {e}")
+                status = "failed"
+            else:
+                logging.warning(f"Failed to send email {message['uuid']} to {message['to']}, will retry: {e}")
+                status = "pending"
+
+            delay = RETRY_BACKOFF_SECONDS * 2 ** (message["attempts"] - 1)
+
+            await collection.update_one({"uuid": message["uuid"]}, {"$set": {
+                "status": status,
+                "next_attempt": datetime.datetime.now().timestamp() + delay,
+                "last_error": str(e),
+            }})
+            return
+
+        await collection.update_one({"uuid": message["uuid"]}, {"$set": {
+            "status": "sent",
+            "timestamp_sent": datetime.datetime.now().timestamp(),
+            "last_error": None,
+        }})
+
+    async def run_worker(self, worker: int, connection: SMTPConnection):
+        db = MongoDB()
+        idle_since = None
+        errors = 0
+
+        while True:
+            # Clear before looking, so a message queued while we look isn't missed
+            self.wakeup.clear()
+
+            try:
+                message = await self.claim_message(db)
+
+                if message is not None:
+                    idle_since = None
+                    await self.send_message(db, connection, message)
+                    errors = 0
+                    continue
+
+                errors = 0
+
+                # Nothing to send, close the connection if it's been idle a while
+                now = datetime.datetime.now().timestamp()
+                if idle_since is None:
+                    idle_since = now
+                elif connection.server is not None and now - idle_since > IDLE_DISCONNECT_SECONDS:
+                    await asyncio.to_thread(connection.close)
+            except Exception as e:
+                # Keep the worker alive through database errors, a message
+                # it claimed is requeued the next time the outbox starts
+                errors += 1
+                delay = min(WORKER_ERROR_BACKOFF_SECONDS * 2 ** (errors - 1), MAX_WORKER_ERROR_BACKOFF_SECONDS)
+                logging.error(f"Outbox worker {worker} failed, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+
+            # Wait for a new message or for a retry to become due
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def purge_old_messages(self):
+        # Delete sent and failed messages once they're no longer useful
+        # for debugging, so the outbox doesn't grow forever
+        db = MongoDB()
+        collection = await db.get_collection("outbox")
+        now = datetime.datetime.now().timestamp()
+
+        sent = await collection.delete_many({"status": "sent", "timestamp_sent": {"$lt": now - SENT_RETENTION_SECONDS}})
+        failed = await collection.delete_many({"status": "failed", "timestamp_created": {"$lt": now - FAILED_RETENTION_SECONDS}})
+
+        if sent.deleted_count + failed.deleted_count > 0:
+            logging.info(f"Purged {sent.deleted_count} sent and {failed.deleted_count} failed emails from the outbox")
+
+
+outbox = Outbox(EMAIL_WORKERS, SMTP_HOST, SMTP_PORT, SMTP_USE_SSL)
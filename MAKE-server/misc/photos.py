@@ -0,0 +1,188 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Union
+
+from PIL import Image, ImageOps
+from config import PHOTO_WORKERS
+from db_schema import MongoDB
+from misc.blob_store import blob_store
+
+# Renditions made of every workshop photo, by name and maximum height.
+# Ordered largest first, as each is resized from the one before it
+RENDITIONS = {
+    "1080": 1080,
+    "480": 480,
+    "thumbnail": 320,
+}
+WEBP_QUALITY = 90
+# Directory photos from before the blob store are stored in, by uuid
+SERVER_FILES_DIR = "server_files"
+
+
+def render_photo(path: str) -> Dict[str, bytes]:
+    # Make the webp renditions of a photo. This is CPU heavy,
+    # so it is run in a separate process by PhotoProcessor
+    renditions = {}
+
+    with Image.open(path) as image:
+        # Phones store the orientation separately from the pixels
+        image = ImageOps.exif_transpose(image)
+
+        if image.mode not in ("RGB", "RGBA"):
+            has_alpha = image.mode in ("LA", "PA") or "transparency" in image.info
+            image = image.convert("RGBA" if has_alpha else "RGB")
+
+        for name, height in RENDITIONS.items():
+            # Keep the aspect ratio, and never scale up
+            if image.height > height:
+                width = max(1, round(image.width * height / image.height))
+                image = image.resize((width, height), Image.LANCZOS)
+
+            data = io.BytesIO()
+            image.save(data, "WEBP", quality=WEBP_QUALITY)
+            renditions[name] = data.getvalue()
+
+    return renditions
+
+
+class PhotoProcessor:
+    '''
+    Makes the renditions of uploaded workshop photos in the background, so
+    uploads return immediately. Resizing happens in a pool of processes,
+    which keeps it off the event loop and lets photos be processed in
+    parallel. The renditions are stored in the blob store and listed in
+    the photo's server_files document under renditions.
+
+    A worker process dying (say, out of memory on a huge image) breaks the
+    whole pool, failing every photo in it. The pool is replaced, and each
+    of those photos is retried in a process of its own, so one photo can't
+    take the others down with it.
+    '''
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.tasks: List[asyncio.Task] = []
+        self.executor: Union[ProcessPoolExecutor, None] = None
+
+    def make_executor(self, workers: int):
+        # Processes are spawned rather than forked, since forking a process
+        # with running threads (like the database client's) isn't safe
+        return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def start(self):
+        self.executor = self.make_executor(self.workers)
+
+        for _ in range(self.workers):
+            self.tasks.append(asyncio.create_task(self.run_worker()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+        # Unprocessed photos are picked up again by resume on the next startup
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def enqueue(self, photo_uuid: str):
+        self.queue.put_nowait(photo_uuid)
+
+    async def resume(self, db: MongoDB):
+        # Queue photos without renditions, including ones interrupted by a
+        # restart and ones uploaded before renditions existed
+        collection = await db.get_collection("server_files")
+        photos = await collection.find({"renditions": None, "rendition_error": None}, {"uuid": 1}).to_list(None)
+
+        for photo in photos:
+            self.enqueue(photo["uuid"])
+
+        if len(photos) > 0:
+            logging.info(f"Queued {len(photos)} photos for processing")
+
+    async def process(self, db: MongoDB, photo_uuid: str):
+        collection = await db.get_collection("server_files")
+        photo = await collection.find_one({"uuid": photo_uuid})
+
+        if photo is None:
+            # The photo was deleted before it was processed
+            return
+
+        logging.info(f"Processing photo {photo_uuid}...")
+        path = blob_store.file_path(photo, SERVER_FILES_DIR)
+
+        try:
+            renditions = await self.render(photo_uuid, path)
+        except BrokenProcessPool:
+            # The photo kills the worker process by itself. That may not mean it
+            # can't be read, so it isn't marked, and resume retries it on the next startup
+            logging.error(f"Worker process died processing photo {photo_uuid}, leaving it until the next startup")
+            return
+        except Exception as e:
+            # Keep serving the original, and don't retry a photo that can't be read
+            logging.error(f"Error processing photo {photo_uuid}: {e}")
+            await collection.update_one({"uuid": photo_uuid}, {"$set": {"rendition_error": str(e)}})
+            return
+
+        rendition_hashes = {}
+        for name, data in renditions.items():
+            rendition_hashes[name] = await blob_store.add_bytes(db, data)
+
+        result = await collection.update_one(
+            {"uuid": photo_uuid, "renditions": None},
+            {"$set": {"renditions": rendition_hashes}},
+        )
+
+        if result.matched_count == 0:
+            # The photo was deleted while it was being processed
+            await blob_store.release(db, list(rendition_hashes.values()))
+            return
+
+        logging.info(f"Processed photo {photo_uuid}")
+
+    async def render(self, photo_uuid: str, path: str):
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+
+        try:
+            return await loop.run_in_executor(executor, render_photo, path)
+        except BrokenProcessPool:
+            self.replace_executor(executor)
+
+        # Any photo in the pool could have killed the worker, so retry this
+        # one alone, where only it can
+        logging.warning(f"Retrying photo {photo_uuid} in its own process after a worker process died")
+        isolated = self.make_executor(1)
+
+        try:
+            return await loop.run_in_executor(isolated, render_photo, path)
+        finally:
+            isolated.shutdown(wait=False)
+
+    def replace_executor(self, executor: ProcessPoolExecutor):
+        # Every photo in a broken pool fails, only the first to fail replaces it
+        if self.executor is executor:
+            logging.warning("A photo worker process died, restarting the pool")
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self.make_executor(self.workers)
+
+    async def run_worker(self):
+        db = MongoDB()
+
+        while True:
+            photo_uuid = await self.queue.get()
+
+            try:
+                await self.process(db, photo_uuid)
+            except Exception as e:
+                logging.error(f"Failed to process photo {photo_uuid}: {e}")
+
+
+photo_processor = PhotoProcessor(PHOTO_WORKERS)
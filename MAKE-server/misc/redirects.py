@@ -0,0 +1,122 @@
+import datetime
+import logging
+import uuid
+from typing import Dict, List, Union
+
+from pymongo import UpdateOne
+from db_schema import MongoDB
+
+# Paths that are never redirects: the API, and the
+# directories served by the static files mount
+SKIPPED_PREFIXES = ("api/", "css/", "img/", "kiosks/", "md/", "scripts/")
+
+# Files served from the root of the static files mount
+SKIPPED_EXTENSIONS = (
+    ".html", ".js", ".css", ".png", ".webp", ".svg",
+    ".ico", ".xml", ".txt", ".webmanifest",
+)
+
+# How often buffered redirect hits are written to the database
+LOG_FLUSH_INTERVAL_SECONDS = 10
+
+
+class RedirectTable:
+    '''
+    In-memory copy of the redirects collection used by RedirectMiddleware,
+    so looking up a redirect doesn't cost a database query on every request.
+    The table is reloaded whenever a redirect is updated or deleted.
+    Hits are buffered and written to each redirect's logs in batches.
+    '''
+
+    def __init__(self):
+        # Path of the redirect -> url to redirect to
+        self.redirects: Dict[str, str] = {}
+        # Path of the redirect -> hits not yet written to the database
+        self.pending_logs: Dict[str, List[dict]] = {}
+
+    async def load(self, db: MongoDB):
+        # Replace the table with the redirects in the database
+        collection = await db.get_collection("redirects")
+
+        redirects = await collection.find({}, {"path": 1, "redirect": 1}).to_list(None)
+
+        self.redirects = {redirect["path"]: redirect["redirect"] for redirect in redirects}
+
+        # Drop buffered hits for redirects that no longer exist
+        for path in list(self.pending_logs):
+            if path not in self.redirects:
+                del self.pending_logs[path]
+
+        logging.info(f"Loaded {len(self.redirects)} redirects")
+
+    def normalize_path(self, path: str) -> Union[str, None]:
+        # Turn a request path into the form stored in the redirects collection,
+        # or None if the path can't be a redirect
+        if len(path) < 2:
+            return None
+
+        # Remove the / from the beginning of the path
+        if path[0] == "/":
+            path = path[1:]
+
+        if path.startswith(SKIPPED_PREFIXES) or path.endswith(SKIPPED_EXTENSIONS):
+            return None
+
+        # Remove the / from the end of the path
+        if path[-1] == "/":
+            path = path[:-1]
+
+        return path
+
+    def lookup(self, path: str) -> Union[str, None]:
+        # Get the url to redirect a request path to, or None
+        path = self.normalize_path(path)
+
+        if path is None:
+            return None
+
+        return self.redirects.get(path)
+
+    def log_hit(self, path: str, ip: str):
+        # Buffer a hit on a redirect, written later by flush_logs
+        path = self.normalize_path(path)
+
+        if path not in self.redirects:
+            return
+
+        self.pending_logs.setdefault(path, []).append({
+            "uuid": str(uuid.uuid4()),
+            "timestamp": datetime.datetime.now().timestamp(),
+            "ip": ip,
+        })
+
+    async def flush_logs(self, db: MongoDB):
+        # Write all buffered hits to the logs attribute of their redirects
+        if len(self.pending_logs) == 0:
+            return
+
+        pending_logs = self.pending_logs
+        self.pending_logs = {}
+
+        collection = await db.get_collection("redirects")
+
+        try:
+            await collection.bulk_write(
+                [
+                    UpdateOne({"path": path}, {"$push": {"logs": {"$each": logs}}})
+                    for path, logs in pending_logs.items()
+                ],
+                ordered=False,
+            )
+        except Exception as e:
+            logging.error(f"Failed to write redirect logs: {e}")
+
+            # Put the hits back so they're written on the next flush
+            for path, logs in pending_logs.items():
+                self.pending_logs[path] = logs + self.pending_logs.get(path, [])
+
+    async def write_logs(self):
+        # Scheduled job that flushes buffered hits
+        await self.flush_logs(MongoDB())
+
+redirect_table = RedirectTable()
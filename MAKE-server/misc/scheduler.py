@@ -0,0 +1,153 @@
+import asyncio
+import datetime
+import logging
+import random
+import traceback
+from typing import Awaitable, Callable, Dict, List, Union
+
+# Each wait between runs is randomly stretched or shrunk by up to this
+# fraction, so jobs with the same interval don't all fire together
+JITTER = 0.1
+# Jobs start within this many seconds of startup, spread out at random
+MAX_START_DELAY_SECONDS = 10
+# After a failure, wait at least this long before retrying,
+# doubling for every consecutive failure up to the maximum
+FAILURE_BACKOFF_SECONDS = 30
+MAX_FAILURE_BACKOFF_SECONDS = 60 * 60
+
+
+class Job:
+    '''
+    A coroutine function run periodically by the Scheduler, along with the
+    results of its last run. A job never overlaps with itself: if it is
+    triggered while running, it runs again once the current run finishes.
+    '''
+
+    def __init__(self, name: str, func: Callable[[], Awaitable], interval: float):
+        self.name = name
+        self.func = func
+        self.interval = interval
+
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.last_run: Union[float, None] = None
+        self.last_duration: Union[float, None] = None
+        self.last_success: Union[float, None] = None
+        self.last_error: Union[str, None] = None
+        self.next_run: Union[float, None] = None
+
+        # Set to run the job before its next scheduled time
+        self.triggered = asyncio.Event()
+        self.task: Union[asyncio.Task, None] = None
+
+    def next_delay(self):
+        # Seconds to wait before the next run
+        delay = self.interval
+
+        if self.failures > 0:
+            backoff = FAILURE_BACKOFF_SECONDS * 2 ** (self.failures - 1)
+            delay = max(delay, min(backoff, MAX_FAILURE_BACKOFF_SECONDS))
+
+        return delay * random.uniform(1 - JITTER, 1 + JITTER)
+
+    async def run_once(self):
+        self.running = True
+        self.last_run = datetime.datetime.now().timestamp()
+        start = asyncio.get_running_loop().time()
+
+        try:
+            await self.func()
+        except Exception as e:
+            # Failures are isolated to this job, others keep running
+            self.failures += 1
+            self.last_error = f"{type(e).__name__}: {e}"
+            logging.error(f"Job {self.name} failed ({self.failures} in a row): {e}")
+            logging.error(traceback.format_exc())
+        else:
+            self.failures = 0
+            self.last_error = None
+            self.last_success = datetime.datetime.now().timestamp()
+        finally:
+            self.runs += 1
+            self.last_duration = asyncio.get_running_loop().time() - start
+            self.running = False
+
+    async def run_forever(self, on_success: Callable[[], None]):
+        delay = random.uniform(0, min(self.interval, MAX_START_DELAY_SECONDS))
+
+        while True:
+            self.next_run = datetime.datetime.now().timestamp() + delay
+
+            # Wait until the next run, or until the job is triggered
+            try:
+                await asyncio.wait_for(self.triggered.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+            self.triggered.clear()
+            self.next_run = None
+
+            await self.run_once()
+
+            if self.failures == 0:
+                on_success()
+
+            delay = self.next_delay()
+
+    def status(self):
+        return {
+            "name": self.name,
+            "interval": self.interval,
+            "running": self.running,
+            "runs": self.runs,
+            "consecutive_failures": self.failures,
+            "last_run": self.last_run,
+            "last_duration": self.last_duration,
+            "last_success": self.last_success,
+            "last_error": self.last_error,
+            "next_run": self.next_run,
+        }
+
+
+class Scheduler:
+    '''
+    Runs background jobs concurrently, each on its own interval, so a slow
+    or failing job doesn't hold up the others.
+    '''
+
+    def __init__(self):
+        self.jobs: Dict[str, Job] = {}
+
+    def add(self, name: str, func: Callable[[], Awaitable], interval: float):
+        # Register a job to run every interval seconds once the scheduler starts
+        self.jobs[name] = Job(name, func, interval)
+
+    def start(self, on_success: Callable[[], None] = lambda: None):
+        # on_success is called after every successful run of any job
+        for job in self.jobs.values():
+            job.task = asyncio.create_task(job.run_forever(on_success))
+
+    async def stop(self):
+        tasks = [job.task for job in self.jobs.values() if job.task is not None]
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for job in self.jobs.values():
+            job.task = None
+
+    def trigger(self, name: str):
+        # Run a job as soon as possible instead of waiting for its interval
+        job = self.jobs.get(name)
+
+        if job is not None:
+            job.triggered.set()
+
+    def status(self) -> List[dict]:
+        return [job.status() for job in self.jobs.values()]
+
+
+scheduler = Scheduler()
@@ -6,10 +6,10 @@ import uuid
 from fastapi.responses import FileResponse
 
 from config import USER_STORAGE_LIMIT_BYTES
-from utilities import validate_api_key
+from utilities import require_scope
 from db_schema import *
 
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 
 cert_router = APIRouter(
     prefix="/api/v2/certifications",
@@ -18,12 +18,10 @@ cert_router = APIRouter(
 )
 
 @cert_router.get("/")
-async def get_all_certifications(request: Request):
+async def get_all_certifications(request: Request, db: MongoDB = Depends(get_db)):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Get all certifications...")
 
-    db = MongoDB()
-
     # Get the certification collection
     collection = await db.get_collection("certifications")
     certs = await collection.find().to_list(None)
@@ -32,24 +30,11 @@ async def get_all_certifications(request: Request):
 
     return certs
 
-@cert_router.post("/certification", status_code=201)
-async def add_certification(request: Request):
+@cert_router.post("/certification", status_code=201, dependencies=[Depends(require_scope("checkout"))])
+async def add_certification(request: Request, db: MongoDB = Depends(get_db)):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Add certification...")
 
-    # Get the API key
-    api_key = request.headers["api-key"]
-
-    db = MongoDB()
-
-    # Check if the API key is valid
-    is_valid = await validate_api_key(db, api_key, "checkout")
-
-    if not is_valid:
-        # The API key is not valid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key") 
-    
     # Get the certification collection
     certifications = await db.get_collection("certifications")
 
@@ -72,24 +57,11 @@ async def add_certification(request: Request):
         await certifications.insert_one(cert.model_dump())
 
 
-@cert_router.delete("/certification", status_code=204)
-async def delete_certification(request: Request):
+@cert_router.delete("/certification", status_code=204, dependencies=[Depends(require_scope("admin"))])
+async def delete_certification(request: Request, db: MongoDB = Depends(get_db)):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Delete certification...")
 
-    # Get the API key
-    api_key = request.headers["api-key"]
-
-    db = MongoDB()
-
-    # Check if the API key is valid
-    is_valid = await validate_api_key(db, api_key, "admin")
-
-    if not is_valid:
-        # The API key is not valid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key") 
-    
     # Get the certification collection
     certifications = await db.get_collection("certifications")
 
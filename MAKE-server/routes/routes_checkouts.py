@@ -1,9 +1,10 @@
 from datetime import datetime,timedelta
 import logging
-from utilities import validate_api_key
+from utilities import require_scope
+from misc.scheduler import scheduler
 from db_schema import *
 
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 
 checkouts_router = APIRouter(
     prefix="/api/v2/checkouts",
@@ -11,24 +12,12 @@ checkouts_router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-@checkouts_router.get("/get_checkouts")
-async def route_get_checkouts(request: Request):
+@checkouts_router.get("/get_checkouts", dependencies=[Depends(require_scope("checkouts"))])
+async def route_get_checkouts(request: Request, db: MongoDB = Depends(get_db)):
     # Get checkouts
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting checkouts...")
 
-    # Get the API key
-    api_key = request.headers["api-key"]
-    db = MongoDB()
-
-    is_valid = await validate_api_key(db, api_key, "checkouts")
-    
-    # Validate API key
-    if not is_valid:
-        # Invalid API key
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the checkouts collection
     collection = await db.get_collection("checkouts")
 
@@ -41,12 +30,11 @@ async def route_get_checkouts(request: Request):
     return checkouts
 
 @checkouts_router.get("/get_checkouts_for_user/{user_uuid}")
-async def route_get_checkouts_for_user(request: Request, user_uuid: str):
+async def route_get_checkouts_for_user(request: Request, user_uuid: str, db: MongoDB = Depends(get_db)):
     # Get checkouts
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting checkouts...")
 
-    db = MongoDB()
     collection = await db.get_collection("checkouts")
 
     # Get all checkouts by uuid
@@ -57,23 +45,12 @@ async def route_get_checkouts_for_user(request: Request, user_uuid: str):
     # Return the checkouts
     return checkouts
 
-@checkouts_router.get("/get_checkout/{checkout_uuid}")
-async def route_get_checkout_record(request: Request, checkout_uuid: str):
+@checkouts_router.get("/get_checkout/{checkout_uuid}", dependencies=[Depends(require_scope("checkouts"))])
+async def route_get_checkout_record(request: Request, checkout_uuid: str, db: MongoDB = Depends(get_db)):
     # Get a checkout
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting checkout...")
 
-    # Get the API key
-    api_key = request.headers["api-key"]
-    db = MongoDB()
-    is_valid = await validate_api_key(db, api_key, "checkouts")
-
-    # Validate API key
-    if not is_valid: 
-        # Invalid API key
-        # Return error
-        raise HTTPException(status_code=404, detail="Invalid API key")
-
     # Get the checkouts collection
     collection = await db.get_collection("checkouts")
 
@@ -90,23 +67,13 @@ async def route_get_checkout_record(request: Request, checkout_uuid: str):
     # Return the checkout
     return checkout
 
-@checkouts_router.post("/create_new_checkout", status_code=201)
-async def route_create_new_checkout(request: Request):
+@checkouts_router.post("/create_new_checkout", status_code=201, dependencies=[Depends(require_scope("checkouts"))])
+async def route_create_new_checkout(request: Request, db: MongoDB = Depends(get_db)):
     # Create a checkout
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Creating checkout...")
     checkout = Checkout(** await request.json())
 
-    # Get the API key
-    api_key = request.headers["api-key"]
-    db = MongoDB()
-
-    # Validate API key
-    if not await validate_api_key(db, api_key, "checkouts"):
-        # Invalid API key
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the checkouts collection
     collection = await db.get_collection("checkouts")
 
@@ -119,76 +86,55 @@ async def route_create_new_checkout(request: Request):
     # Insert the checkout
     await collection.insert_one(checkout.dict())
 
+    # Recompute available inventory now that the checkout has changed
+    scheduler.trigger("update_inventory_from_checkouts")
+
     # Return status code 201
     return
 
-@checkouts_router.post("/update_checkout/{checkout_uuid}")
-async def route_update_checkout(request: Request, checkout_uuid: str):
+@checkouts_router.post("/update_checkout/{checkout_uuid}", dependencies=[Depends(require_scope("checkouts"))])
+async def route_update_checkout(request: Request, checkout_uuid: str, db: MongoDB = Depends(get_db)):
     # Update a checkout
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Updating checkout...")
     checkout = Checkout(** await request.json())
 
-    # Get the API key
-    api_key = request.headers["api-key"]
-    db = MongoDB()
-
-    # Validate API key
-    if not await validate_api_key(db, api_key, "checkouts"):
-        # Invalid API key
-        # Return error
-        raise HTTPException(status_code=404, detail="Invalid API key")
-
     # Get the checkouts collection
     collection = await db.get_collection("checkouts")
 
     # Update the checkout
     await collection.update_one({"uuid": checkout_uuid}, {"$set": checkout.dict()})
 
+    # Recompute available inventory now that the checkout has changed
+    scheduler.trigger("update_inventory_from_checkouts")
+
     # Return the checkout
     return
 
-@checkouts_router.post("/check_in_checkout/{checkout_uuid}", status_code=201)
-async def route_check_in_checkout(request: Request, checkout_uuid: str):
+@checkouts_router.post("/check_in_checkout/{checkout_uuid}", status_code=201, dependencies=[Depends(require_scope("checkouts"))])
+async def route_check_in_checkout(request: Request, checkout_uuid: str, db: MongoDB = Depends(get_db)):
     # Check in a checkout
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Checking in checkout...")
 
-    # Get the API key
-    api_key = request.headers["api-key"]
-    db = MongoDB()
-
-    # Validate API key
-    if not await validate_api_key(db, api_key, "checkouts"):
-        # Invalid API key
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the checkouts collection
     collection = await db.get_collection("checkouts")
 
     # Check in the checkout
     await collection.update_one({"uuid": checkout_uuid}, {"$set": {"timestamp_in": datetime.now().timestamp()}})
 
+    # Recompute available inventory now that the checkout has changed
+    scheduler.trigger("update_inventory_from_checkouts")
+
     # Return success
     return
 
-@checkouts_router.post("/renew_checkout/{checkout_uuid}")
-async def route_renew_checkout(request: Request, checkout_uuid: str):
+@checkouts_router.post("/renew_checkout/{checkout_uuid}", dependencies=[Depends(require_scope("checkouts"))])
+async def route_renew_checkout(request: Request, checkout_uuid: str, db: MongoDB = Depends(get_db)):
     # Renew a checkout
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Renewing checkout...")
 
-    # Get the API key
-    api_key = request.headers["api-key"]
-    db = MongoDB()
-
-    # Validate API key
-    if not await validate_api_key(db, api_key, "checkouts"):
-        # Invalid API key
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the checkouts collection
     collection = await db.get_collection("checkouts")
 
@@ -215,27 +161,20 @@ async def route_renew_checkout(request: Request, checkout_uuid: str):
     # Return success
     return checkout
 
-@checkouts_router.post("/delete_checkout/{checkout_uuid}")
-async def route_delete_checkout(request: Request, checkout_uuid: str):
+@checkouts_router.post("/delete_checkout/{checkout_uuid}", dependencies=[Depends(require_scope("checkouts"))])
+async def route_delete_checkout(request: Request, checkout_uuid: str, db: MongoDB = Depends(get_db)):
     # Delete a checkout
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Deleting checkout...")
 
-    # Get the API key
-    api_key = request.headers["api-key"]
-    db = MongoDB()
-
-    # Validate API key
-    if not await validate_api_key(db, api_key, "checkouts"):
-        # Invalid API key
-        # Return error
-        raise HTTPException(status_code=404, detail="Invalid API key")
-
     # Get the checkouts collection
     collection = await db.get_collection("checkouts")
 
     # Delete the checkout
     await collection.delete_one({"uuid": checkout_uuid})
 
+    # Recompute available inventory now that the checkout has changed
+    scheduler.trigger("update_inventory_from_checkouts")
+
     # Return success
     return {"success": True}
@@ -1,11 +1,12 @@
 import datetime
 import logging
 import uuid
-from utilities import validate_api_key
+from utilities import validate_api_key, require_scope
 from inventory.inventory import email_user_restock_request_complete
+from misc.scheduler import scheduler
 from db_schema import *
 
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 
 inventory_router = APIRouter(
     prefix="/api/v2/inventory",
@@ -14,13 +15,12 @@ inventory_router = APIRouter(
 )
 
 @inventory_router.get("/get_inventory")
-async def route_get_inventory():
+async def route_get_inventory(db: MongoDB = Depends(get_db)):
     # Get the inventory
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting inventory...")
 
     # Get the inventory collection
-    db = MongoDB()
     collection = await db.get_collection("inventory")
 
     # Get all inventory items
@@ -33,13 +33,12 @@ async def route_get_inventory():
 
 
 @inventory_router.get("/get_inventory_item/{item_uuid}")
-async def route_get_inventory_item(item_uuid: str):
+async def route_get_inventory_item(item_uuid: str, db: MongoDB = Depends(get_db)):
     # Get an inventory item
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting inventory item...")
 
     # Get the inventory collection
-    db = MongoDB()
     collection = await db.get_collection("inventory")
 
     # Get the inventory item
@@ -55,23 +54,13 @@ async def route_get_inventory_item(item_uuid: str):
     return inventory_item
 
 
-@inventory_router.post("/create_inventory_item")
-async def route_create_inventory_item(request: Request):
+@inventory_router.post("/create_inventory_item", dependencies=[Depends(require_scope("inventory"))])
+async def route_create_inventory_item(request: Request, db: MongoDB = Depends(get_db)):
     # Create an inventory item
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Creating inventory item...")
     item = InventoryItem(**await request.json())
 
-    api_key = request.headers["api-key"]
-    db = MongoDB()
-
-    is_valid = await validate_api_key(db, api_key, "inventory")
-
-    if not is_valid:
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the inventory collection
     collection = await db.get_collection("inventory")
 
@@ -87,10 +76,13 @@ async def route_create_inventory_item(request: Request):
     # Create the inventory item
     await collection.insert_one(item.dict())
 
+    # Recompute quantity_available from the open checkouts
+    scheduler.trigger("update_inventory_from_checkouts")
+
     return
 
-@inventory_router.post("/update_inventory_item", status_code=200)
-async def route_update_inventory_item(request: Request):
+@inventory_router.post("/update_inventory_item", status_code=200, dependencies=[Depends(require_scope("inventory"))])
+async def route_update_inventory_item(request: Request, db: MongoDB = Depends(get_db)):
     # Update an inventory item
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Updating inventory item...")
@@ -105,16 +97,6 @@ async def route_update_inventory_item(request: Request):
          raise HTTPException(
              status_code=400, detail="Invalid request body: " + str(e))
 
-    api_key = request.headers["api-key"]
-    db = MongoDB()
-
-    is_valid = await validate_api_key(db, api_key, "inventory")
-
-    if not is_valid:
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the inventory collection
     collection = await db.get_collection("inventory")
 
@@ -152,24 +134,18 @@ async def route_update_inventory_item(request: Request):
             elif new_quantity != -1:
                 await complete_automated_restock_request(db, item.uuid)
 
+    # Recompute quantity_available from the open checkouts
+    scheduler.trigger("update_inventory_from_checkouts")
+
     return
 
 
-@inventory_router.delete("/delete_inventory_item/{item_uuid}")
-async def route_delete_inventory_item(item_uuid: str, request: Request):
+@inventory_router.delete("/delete_inventory_item/{item_uuid}", dependencies=[Depends(require_scope("inventory"))])
+async def route_delete_inventory_item(item_uuid: str, request: Request, db: MongoDB = Depends(get_db)):
     # Delete an inventory item
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Deleting inventory item...")
 
-    db = MongoDB()
-    api_key = request.headers["api-key"]
-    is_valid = await validate_api_key(db, api_key, "inventory")
-
-    if not is_valid:
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the inventory collection
     collection = await db.get_collection("inventory")
 
@@ -212,22 +188,13 @@ async def create_automated_restock_request(db: MongoDB, item: InventoryItem, qua
     await restock_collection.insert_one(restock.dict())
 
 
-@inventory_router.get("/get_restock_requests")
-async def route_get_restock_requests(request: Request):
+@inventory_router.get("/get_restock_requests", dependencies=[Depends(require_scope("inventory"))])
+async def route_get_restock_requests(request: Request, db: MongoDB = Depends(get_db)):
     # Get the restock requests
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting restock requests...")
 
     # Get the restock collection
-    db = MongoDB()
-    api_key = request.headers["api-key"]
-    is_valid = await validate_api_key(db, api_key, "inventory")
-
-    if not is_valid:
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     collection = await db.get_collection("restock_requests")
 
     # Get all restock requests
@@ -239,11 +206,10 @@ async def route_get_restock_requests(request: Request):
     return restock_requests
 
 @inventory_router.post("/add_restock_request", status_code=201)
-async def route_add_restock_notice(request: Request):
+async def route_add_restock_notice(request: Request, db: MongoDB = Depends(get_db)):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Adding restock notice...")
     # Get the restock collection
-    db = MongoDB()
     collection = await db.get_collection("restock_requests")
 
     authorized_request = False
@@ -330,11 +296,10 @@ async def complete_automated_restock_request(db: MongoDB, item_uuid: str) -> Non
 
 
 @inventory_router.post("/complete_restock_request", status_code=201)
-async def route_complete_restock_request(request: Request):
+async def route_complete_restock_request(request: Request, db: MongoDB = Depends(get_db)):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Completing restock notice...")
     
-    db = MongoDB()
     collection = await db.get_collection("restock_requests")
     
     if "api-key" in request.headers:
@@ -1,9 +1,9 @@
 import logging
-from utilities import validate_api_key
+
 from db_schema import *
 import datetime
 
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 
 machines_router = APIRouter(
     prefix="/api/v2/machines",
@@ -12,7 +12,7 @@ machines_router = APIRouter(
 )
 
 @machines_router.get("/add_filament_log/{kgs}")
-async def route_add_filament_log(request: Request, kgs: float):
+async def route_add_filament_log(request: Request, kgs: float, db: MongoDB = Depends(get_db)):
     # Add a filament log
     # This is a GET request to make it easier to
     # use with arduino
@@ -20,7 +20,6 @@ async def route_add_filament_log(request: Request, kgs: float):
     logging.info("Adding filament log...")
 
     # Get the filament logs collection
-    db = MongoDB()
     collection = await db.get_collection("filament_logs")
 
     to_insert = {
@@ -34,13 +33,12 @@ async def route_add_filament_log(request: Request, kgs: float):
     return
 
 @machines_router.get("/get_printers")
-async def route_get_printers(request: Request):
+async def route_get_printers(request: Request, db: MongoDB = Depends(get_db)):
     # Get the printers
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting printers...")
 
     # Get the printers collection
-    db = MongoDB()
     collection = await db.get_collection("printer_logs")
 
     # Get the most recent log for each printer
@@ -54,13 +52,12 @@ async def route_get_printers(request: Request):
 
 
 @machines_router.get("/status")
-async def route_get_status(request: Request):
+async def route_get_status(request: Request, db: MongoDB = Depends(get_db)):
     # Get the status of all the machines
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting machine status...")
 
     # Get the machines collection
-    db = MongoDB()
     collection = await db.get_collection("machines")
 
     # Get the status of all the machines
@@ -1,13 +1,17 @@
+import asyncio
+import base64
 import datetime
 import logging
 
 from config import QUIZ_IDS, VERSION, API_KEY_SCOPES, WEBMASTER_EMAIL, MAKERSPACE_MANAGEMENT_EMAIL
 import utilities
-from utilities import validate_api_key
+from utilities import require_scope, get_api_key_scopes, invalidate_api_keys
 from db_schema import *
-from machines.loom import render_loom_file
+from machines.loom import LoomOverloadedError, loom_render_pool
+from misc.redirects import redirect_table
+from misc.scheduler import scheduler
 
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 
 misc_router = APIRouter(
     prefix="/api/v2/misc",
@@ -17,13 +21,11 @@ misc_router = APIRouter(
 
 
 @misc_router.get("/status")
-async def route_get_status():
+async def route_get_status(db: MongoDB = Depends(get_db)):
     # Get the status
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting status...")
 
-    db = MongoDB()
-
     checkouts = await db.get_collection("checkouts")
     users = await db.get_collection("users")
     inventory = await db.get_collection("inventory")
@@ -45,24 +47,23 @@ async def route_get_status():
         "stewards_on_duty": status["stewards_on_duty"],
     }
 
-@misc_router.post("/update_status", status_code=201)
-async def route_update_status(request: Request):
+@misc_router.get("/jobs", dependencies=[Depends(require_scope("admin"))])
+async def route_get_jobs():
+    # Get the status of the background jobs
+    logging.getLogger().setLevel(logging.INFO)
+    logging.info("Getting background jobs...")
+
+    return scheduler.status()
+
+@misc_router.post("/update_status", status_code=201, dependencies=[Depends(require_scope("admin"))])
+async def route_update_status(request: Request, db: MongoDB = Depends(get_db)):
     # Update the status
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Updating status...")
 
-    db = MongoDB()
-
     # Get the request body
     body = await request.json()
 
-    # Validate the API key
-    api_key = request.headers["api-key"]
-    if not await validate_api_key(db, api_key, "admin"):
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
     # Get status from collection
     status_collection = await db.get_collection("status")
     status = await status_collection.find().to_list(None)
@@ -77,17 +78,17 @@ async def route_update_status(request: Request):
     # Replace the status, it doesn't have a uuid or key
     await status_collection.replace_one({}, status)
 
-@misc_router.post("/render_loom_file")
-async def route_render_loom_file(request: Request):
-    # Get the request body
-    body = await request.json()
-    
-    # Render a loom file
+async def render_loom(img_data: bytes, loom_width: int, desired_height: int, invert: bool, tabby_width: int):
+    # Render a loom file in the loom render pool
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Rendering loom file...")
 
     try :
-        result = render_loom_file(body["file"], body["extension"], body["output_format"], body["loom_width"], body["desired_height"], body["invert"], body["tabby_width"])
+        return await loom_render_pool.render(img_data, loom_width, desired_height, invert, tabby_width)
+    except LoomOverloadedError:
+        # Too many renders are already queued
+        # Return error
+        raise HTTPException(status_code=429, detail="Too many loom files are being rendered, try again shortly", headers={"Retry-After": "5"})
     except Exception as e:
         # The loom file could not be rendered
         # Return error
@@ -95,17 +96,53 @@ async def route_render_loom_file(request: Request):
         logging.error(f"An error occurred while rendering the loom file: {e}")
 
         raise HTTPException(status_code=500, detail="An error occurred while rendering the loom file")
-    
-    if result is None:
-        # The loom file could not be rendered
+
+
+@misc_router.post("/render_loom_image")
+async def route_render_loom_image(request: Request):
+    # Render a loom file uploaded as multipart form data, with the image as
+    # file and loom_width, desired_height, invert and tabby_width fields.
+    # Returns the rendered png
+    form = await request.form()
+
+    if "file" not in form or isinstance(form["file"], str):
+        # There is no image
         # Return error
-        raise HTTPException(status_code=400, detail="Loom file could not be rendered with the given parameters")
-    
+        raise HTTPException(status_code=400, detail="Expected an image file")
+
+    try:
+        loom_width = int(form["loom_width"])
+        desired_height = int(form.get("desired_height", 0))
+        invert = form.get("invert", "false").lower() == "true"
+        tabby_width = int(form.get("tabby_width", 0))
+    except (KeyError, ValueError):
+        # The parameters are invalid
+        # Return error
+        raise HTTPException(status_code=400, detail="Invalid loom parameters")
+
+    img_data = await form["file"].read()
+
+    png = await render_loom(img_data, loom_width, desired_height, invert, tabby_width)
+
     # Return the rendered loom file
-    return result
+    return Response(content=png, media_type="image/png")
+
+
+@misc_router.post("/render_loom_file")
+async def route_render_loom_file(request: Request):
+    # Render a loom file sent as base64 in JSON, returning the png as base64.
+    # /render_loom_image takes and returns the image directly
+    body = await request.json()
+
+    img_data = await asyncio.to_thread(base64.b64decode, str(body["file"]))
+
+    png = await render_loom(img_data, body["loom_width"], body["desired_height"], body["invert"], body["tabby_width"])
+
+    # Return the rendered loom file
+    return await asyncio.to_thread(base64.standard_b64encode, png)
 
 @misc_router.post("/get_api_key_scopes")
-async def route_get_api_key_scopes(request: Request):
+async def route_get_api_key_scopes(request: Request, db: MongoDB = Depends(get_db)):
     # Get the request body
     body = await request.json()
     
@@ -113,36 +150,24 @@ async def route_get_api_key_scopes(request: Request):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Checking API key scopes...")
 
-    db = MongoDB()
-
-    api_keys = await db.get_collection("api_keys")
-        
-    # Get the API key
-    api_key = await api_keys.find_one({"key": body["api_key"]})
+    # Get the API key's scopes
+    scopes = await get_api_key_scopes(db, body["api_key"])
 
-    if api_key is None:
+    if scopes is None:
         # The API key is invalid
         # Return error
         raise HTTPException(status_code=401, detail="Invalid API key")
     else:
         # The API key is valid
         # Return the API key's scopes
-        return {"scopes": api_key["scopes"]}
+        return {"scopes": scopes}
     
-@misc_router.get("/get_api_keys")
-async def route_get_api_keys(request: Request): 
+@misc_router.get("/get_api_keys", dependencies=[Depends(require_scope("admin"))])
+async def route_get_api_keys(request: Request, db: MongoDB = Depends(get_db)): 
     # Get the API keys
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting API keys...")
 
-    db = MongoDB()
-
-    # Verify that the current user has the proper scopes to access all API keys
-    if not await validate_api_key(db, request.headers["api-key"], "admin"):
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
     # Get the API keys
     api_keys = await db.get_collection("api_keys")
     all_api_keys = await api_keys.find().to_list(None)
@@ -151,24 +176,16 @@ async def route_get_api_keys(request: Request):
 
     return all_api_keys_formatted
 
-@misc_router.get("/get_all_api_key_scopes")
-async def route_get_all_api_key_scopes(request: Request):    
+@misc_router.get("/get_all_api_key_scopes", dependencies=[Depends(require_scope("admin"))])
+async def route_get_all_api_key_scopes(request: Request, db: MongoDB = Depends(get_db)):    
     # Get the API keys
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting API key scopes...")
 
-    db = MongoDB()
-
-    # Verify that the current user has the proper scopes to access all API key scopes
-    if not await validate_api_key(db, request.headers["api-key"], "admin"):
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
     return API_KEY_SCOPES
 
-@misc_router.post("/update_api_key")
-async def route_add_api_key(request: Request):
+@misc_router.post("/update_api_key", dependencies=[Depends(require_scope("admin"))])
+async def route_add_api_key(request: Request, db: MongoDB = Depends(get_db)):
     # Get the request body
     body = await request.json()
     
@@ -176,14 +193,6 @@ async def route_add_api_key(request: Request):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Adding API key...")
 
-    db = MongoDB()
-
-    # Verify that the current user has the proper scopes to add an API key
-    if not await validate_api_key(db, request.headers["api-key"], "admin"):
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
     # Add the API key
     api_keys = await db.get_collection("api_keys")
 
@@ -199,9 +208,12 @@ async def route_add_api_key(request: Request):
         # Update it
         await api_keys.update_one({"uuid": body["uuid"]}, {"$set": body})
 
+    # Drop cached keys so the change applies to the next request
+    invalidate_api_keys()
 
-@misc_router.delete("/delete_api_key")
-async def route_delete_api_key(request: Request):
+
+@misc_router.delete("/delete_api_key", dependencies=[Depends(require_scope("admin"))])
+async def route_delete_api_key(request: Request, db: MongoDB = Depends(get_db)):
     # Get the request body
     body = await request.json()
     
@@ -209,38 +221,23 @@ async def route_delete_api_key(request: Request):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Deleting API key...")
 
-    db = MongoDB()
-
-    # Verify that the current user has the proper scopes to delete an API key
-    if not await validate_api_key(db, request.headers["api-key"], "admin"):
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
     # Delete the API key
     api_keys = await db.get_collection("api_keys")
 
     # Delete it
     await api_keys.delete_one({"uuid": body["uuid"]})
+
+    # Drop cached keys so the deleted key stops working immediately
+    invalidate_api_keys()
     
 
-@misc_router.get("/get_redirects")
-async def route_get_redirects(request: Request):
+@misc_router.get("/get_redirects", dependencies=[Depends(require_scope("admin"))])
+async def route_get_redirects(request: Request, db: MongoDB = Depends(get_db)):
     # Get the request body
     # Get the redirects
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting redirects...")
 
-    db = MongoDB()
-    api_key = request.headers["api-key"]
-
-
-    # Validate the API key
-    if not await validate_api_key(db, api_key, "admin"):
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
     # Get the redirects
     redirects = await db.get_collection("redirects")
 
@@ -250,21 +247,12 @@ async def route_get_redirects(request: Request):
     
     return all_redirects
 
-@misc_router.post("/update_redirect", status_code=201)
-async def route_update_redirect(request: Request):
+@misc_router.post("/update_redirect", status_code=201, dependencies=[Depends(require_scope("admin"))])
+async def route_update_redirect(request: Request, db: MongoDB = Depends(get_db)):
     # Update a redirect
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Updating redirect...")
 
-    db = MongoDB()
-    api_key = request.headers["api-key"]
-
-    # Validate the API key
-    if not await validate_api_key(db, api_key, "admin"):
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
     redirect = None
 
     try:
@@ -274,6 +262,9 @@ async def route_update_redirect(request: Request):
         # Return error
         raise HTTPException(status_code=400, detail="Invalid redirect: " + str(e))
 
+    # Write buffered hits first so the logs kept below are up to date
+    await redirect_table.flush_logs(db)
+
     # Update the redirect
     redirects = await db.get_collection("redirects")
 
@@ -290,8 +281,11 @@ async def route_update_redirect(request: Request):
         redirect.logs = check["logs"]
         await redirects.update_one({"uuid": redirect.uuid}, {"$set": redirect.dict()})
 
-@misc_router.delete("/delete_redirect", status_code=204)
-async def route_delete_redirect(request: Request):
+    # Reload the redirects used by RedirectMiddleware
+    await redirect_table.load(db)
+
+@misc_router.delete("/delete_redirect", status_code=204, dependencies=[Depends(require_scope("admin"))])
+async def route_delete_redirect(request: Request, db: MongoDB = Depends(get_db)):
     # Get the request body
     body = await request.json()
     
@@ -299,21 +293,14 @@ async def route_delete_redirect(request: Request):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Deleting redirect...")
 
-    db = MongoDB()
-
-    api_key = request.headers["api-key"]
-
-    # Validate the API key
-    if not await validate_api_key(db, api_key, "admin"):
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
     # Delete the redirect
     redirects = await db.get_collection("redirects")
 
     # Delete it
-    await redirects.delete_one({"uuid": body["uuid"]})  
+    await redirects.delete_one({"uuid": body["uuid"]})
+
+    # Reload the redirects used by RedirectMiddleware
+    await redirect_table.load(db)
 
 
 @misc_router.get("/get_quiz_ids")
@@ -324,21 +311,12 @@ async def route_get_quiz_ids():
 
     return QUIZ_IDS
 
-@misc_router.get("/get_quiz_results")
-async def route_get_quiz_results(request: Request):
+@misc_router.get("/get_quiz_results", dependencies=[Depends(require_scope("admin"))])
+async def route_get_quiz_results(request: Request, db: MongoDB = Depends(get_db)):
     # Get the quizzes
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting all quiz results...")
 
-    db = MongoDB()
-    api_key = request.headers["api-key"]
-
-    # Validate the API key
-    if not await validate_api_key(db, api_key, "admin"):
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the collection
     collection = await db.get_collection("quizzes")
 
@@ -2,11 +2,11 @@ import datetime
 import logging
 import uuid
 import utilities
-from utilities import validate_api_key
+from utilities import require_scope
 from db_schema import *
 from machines.loom import render_loom_file
 
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 
 shifts_router = APIRouter(
     prefix="/api/v2/shifts",
@@ -15,11 +15,10 @@ shifts_router = APIRouter(
 )
 
 @shifts_router.get("/get_shift_schedule")
-async def route_get_shift_schedule(request: Request):
+async def route_get_shift_schedule(request: Request, db: MongoDB = Depends(get_db)):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting checkout...")
 
-    db = MongoDB()
     shifts = await db.get_collection("shifts")
     users = await db.get_collection("users")
 
@@ -60,19 +59,8 @@ async def route_get_shift_schedule(request: Request):
 
     return censored_shifts
 
-@shifts_router.get("/get_full_shift_schedule")
-async def route_get_full_shift_schedule(request: Request):
-    # Get the API key
-    api_key = request.headers["api-key"]
-    db = MongoDB()
-
-    is_valid = await validate_api_key(db, api_key, "admin")
-
-    if not is_valid:
-        # Invalid API key
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
+@shifts_router.get("/get_full_shift_schedule", dependencies=[Depends(require_scope("admin"))])
+async def route_get_full_shift_schedule(request: Request, db: MongoDB = Depends(get_db)):
     shifts = await db.get_collection("shifts")
 
     if shifts is None:
@@ -84,19 +72,8 @@ async def route_get_full_shift_schedule(request: Request):
 
     return shifts
 
-@shifts_router.post("/update_shift_schedule", status_code=201)
-async def route_update_shift_schedule(request: Request):
-    # Get the API key
-    api_key = request.headers["api-key"]
-    db = MongoDB()
-
-    is_valid = await validate_api_key(db, api_key, "admin")
-
-    if not is_valid:
-        # Invalid API key
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    
+@shifts_router.post("/update_shift_schedule", status_code=201, dependencies=[Depends(require_scope("admin"))])
+async def route_update_shift_schedule(request: Request, db: MongoDB = Depends(get_db)):
     shifts = await db.get_collection("shifts")
 
     new_shifts = await request.json()
@@ -111,20 +88,20 @@ async def route_update_shift_schedule(request: Request):
         raise HTTPException(status_code=400, detail="Invalid shift object")
 
     # Overwrite the shifts collection with the new shifts
-    if shifts is None:
-        # It's the first time we're adding shifts
-        shifts = await db.create_collection("shifts")
-    else:
+    if shifts is not None:
         # It's not the first time
         # Drop the shifts collection
-        await shifts.drop()
+        await db.drop_collection("shifts")
+
+    shifts = await db.create_collection("shifts")
+
+    if len(new_shifts) > 0:
         await shifts.insert_many(new_shifts)
 
     return
 
 @shifts_router.get("/get_shifts_for_steward/{steward_uuid}")
-async def route_get_shifts_for_steward(request: Request, steward_uuid: str):
-    db = MongoDB()
+async def route_get_shifts_for_steward(request: Request, steward_uuid: str, db: MongoDB = Depends(get_db)):
 
     shifts = await db.get_collection("shifts")
 
@@ -140,8 +117,7 @@ async def route_get_shifts_for_steward(request: Request, steward_uuid: str):
     return shifts
 
 @shifts_router.get("/get_shift_changes")
-async def route_get_shift_changes(request: Request):
-    db = MongoDB()
+async def route_get_shift_changes(request: Request, db: MongoDB = Depends(get_db)):
 
     shift_changes = await db.get_collection("shift_changes")
 
@@ -155,7 +131,7 @@ async def route_get_shift_changes(request: Request):
     return shift_changes
 
 @shifts_router.post("/drop_shift", status_code=201)
-async def route_drop_shift(request: Request):
+async def route_drop_shift(request: Request, db: MongoDB = Depends(get_db)):
     # This takes a user uuid and a shift uuid
     # It creates and saves a shift change object
     # This doesn't require a api key because it's a user action
@@ -174,8 +150,6 @@ async def route_drop_shift(request: Request):
     # Get the user uuid
     item = ShiftChange(**await request.json())
 
-    db = MongoDB()
-
     # Check the steward uuid exists and that they are a steward
     users = await db.get_collection("users")
     user = await users.find_one({"uuid": item.steward})
@@ -238,11 +212,9 @@ async def route_drop_shift(request: Request):
     return
 
 @shifts_router.post("/pickup_shift", status_code=201)
-async def route_pickup_shift(request: Request):
+async def route_pickup_shift(request: Request, db: MongoDB = Depends(get_db)):
     item = ShiftChange(**await request.json())
 
-    db = MongoDB()
-
     # Check the steward uuid exists and that they are a steward
     users = await db.get_collection("users")
     user = await users.find_one({"uuid": item.steward})
@@ -306,15 +278,13 @@ async def route_pickup_shift(request: Request):
     return
 
 @shifts_router.post("/cancel_shift_change", status_code=201)
-async def route_cancel_shift_change(request: Request):
+async def route_cancel_shift_change(request: Request, db: MongoDB = Depends(get_db)):
     # Only fields in body are uuid and steward
     # UUID is the shift change uuid
     # Steward is the steward uuid
 
     body = await request.json()
 
-    db = MongoDB()
-
     # Check the steward uuid exists and that they are a steward
     users = await db.get_collection("users")
 
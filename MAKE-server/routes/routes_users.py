@@ -1,15 +1,16 @@
+import asyncio
 import datetime
 import logging
-import os
 import uuid
 
-from fastapi.responses import FileResponse
-
 from config import USER_STORAGE_LIMIT_BYTES
-from utilities import validate_api_key
+from utilities import validate_api_key, require_scope
 from db_schema import *
+from users.files import USER_FILES_DIR, UserFileUpload, delete_user_file_blobs
+from misc.blob_store import blob_store
+from misc.downloads import send_file
 
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 
 user_router = APIRouter(
     prefix="/api/v2/users",
@@ -17,23 +18,12 @@ user_router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-@user_router.get("/get_users")
-async def route_get_users(request: Request):
+@user_router.get("/get_users", dependencies=[Depends(require_scope("users"))])
+async def route_get_users(request: Request, db: MongoDB = Depends(get_db)):
     # Get users
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting users...")
 
-    # Get the API key
-    api_key = request.headers["api-key"]
-    db = MongoDB()
-
-    is_valid = await validate_api_key(db, api_key, "users")
-    # Validate API key
-    if not is_valid:
-        # Invalid API key
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the users collection
     collection = await db.get_collection("users")
 
@@ -46,13 +36,12 @@ async def route_get_users(request: Request):
     return users
 
 @user_router.get("/get_user/{user_uuid}")
-async def route_get_user(request: Request, user_uuid: str):
+async def route_get_user(request: Request, user_uuid: str, db: MongoDB = Depends(get_db)):
     # Get a user
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting user...")
     logging.info(user_uuid)
 
-    db = MongoDB()
     # Get the users collection
     collection = await db.get_collection("users")
 
@@ -70,14 +59,13 @@ async def route_get_user(request: Request, user_uuid: str):
     return user
 
 @user_router.get("/get_user_by_cx_id/{cx_id}")
-async def route_get_user_by_cx_id(request: Request, cx_id: int):
+async def route_get_user_by_cx_id(request: Request, cx_id: int, db: MongoDB = Depends(get_db)):
     # Get a user
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting user by cx_id...")
     logging.info(cx_id)
 
     # Get the users collection
-    db = MongoDB()
     collection = await db.get_collection("users")
     user = await collection.find_one({"cx_id": cx_id})
     
@@ -104,7 +92,7 @@ async def route_get_user_by_cx_id(request: Request, cx_id: int):
     uuids = await collection.distinct("user", {"ip": ip, "timestamp": {"$gt": datetime.datetime.now().timestamp() - 300}})
 
     # Log the IP address
-    await collection.insert_one({"ip": ip, "timestamp": datetime.datetime.now().timestamp(), "user": user["uuid"]})   
+    await collection.insert_one({"ip": ip, "timestamp": datetime.datetime.now().timestamp(), "user": user["uuid"]})
 
     # If there's a valid API key, don't check the IP address
     if not is_valid:
@@ -112,31 +100,18 @@ async def route_get_user_by_cx_id(request: Request, cx_id: int):
             # The user has made too many requests
             # Return error
             raise HTTPException(status_code=429, detail="Too many requests")
-    
+
     user = User(**user)
     
     # Return the user
     return user
 
-@user_router.post("/update_user")
-async def route_update_user(request: Request):
+@user_router.post("/update_user", dependencies=[Depends(require_scope("users"))])
+async def route_update_user(request: Request, db: MongoDB = Depends(get_db)):
     # Update a user's role
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Updating user...")
 
-    # Get the API key
-    api_key = request.headers["api-key"]
-
-    db = MongoDB()
-
-    # Check if the API key is valid
-    is_valid = await validate_api_key(db, api_key, "users")
-
-    if not is_valid:
-        # The API key is not valid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key") 
-    
     # Get the users collection
     collection = await db.get_collection("users")
 
@@ -175,13 +150,11 @@ async def route_update_user(request: Request):
     return
     
 @user_router.post("/update_user_by_uuid", status_code=201)
-async def route_update_user_by_uuid(request: Request):
+async def route_update_user_by_uuid(request: Request, db: MongoDB = Depends(get_db)):
     # Update a user's role
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Updating user by uuid...")
 
-    db = MongoDB()
-
     # Get the users collection
     collection = await db.get_collection("users")
 
@@ -216,13 +189,11 @@ async def route_update_user_by_uuid(request: Request):
     return
 
 @user_router.post("/clear_all_availability", status_code=201)
-async def route_clear_all_availability(request: Request):
+async def route_clear_all_availability(request: Request, db: MongoDB = Depends(get_db)):
     # Update a user's role
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Clearing availability for all users...")
 
-    db = MongoDB()
-
     # Get the users collection
     collection = await db.get_collection("users")
 
@@ -248,13 +219,11 @@ async def route_clear_all_availability(request: Request):
     return
 
 @user_router.post("/get_file_list", status_code=201)
-async def route_get_file_list(request: Request):
+async def route_get_file_list(request: Request, db: MongoDB = Depends(get_db)):
     # Get a user's file list
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting user's file list...")
 
-    db = MongoDB()
-
     # Get the users collection
     collection = await db.get_collection("users")
 
@@ -290,92 +259,82 @@ async def route_get_file_list(request: Request):
     return user_files
 
 @user_router.post("/upload_file")
-async def route_upload_file_for_user(request: Request):
+async def route_upload_file_for_user(request: Request, db: MongoDB = Depends(get_db)):
     # Upload a file for a user
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Uploading file for user...")
 
-    db = MongoDB()
+    # Stream the file to disk, checking it against the user's storage limit
+    upload = UserFileUpload(request, db)
+    await upload.receive()
+
+    user = upload.user
+    user_uuid = user["uuid"]
+    file_size_bytes = upload.size
 
     # Get the users collection
     user_collection = await db.get_collection("users")
-
-    # Get the user UUID and role
-    form = await request.form()
-
-    user_uuid = form["user_uuid"]
-
-    # Check if the user already exists
-    user = await user_collection.find_one({"uuid": user_uuid})
-
-    if user is None:
-        # The user does not exist
-        # Return error
-        raise HTTPException(status_code=404, detail="User does not exist")
-    
     user_files_collection = await db.get_collection("user_files")
 
-    if "files" not in user:
-        user["files"] = []
-
-    if type(user["files"]) != list:
-        user["files"] = []
+    if type(user.get("files")) != list:
+        await user_collection.update_one({"uuid": user_uuid}, {"$set": {"files": []}})
 
-    file_data = form["file"].file.read()
+    # Add the file to the user's stored files, as long as another upload
+    # hasn't used up the space in the meantime
+    file_uuid = uuid.uuid4().hex
 
-    # Calculate file size
-    file_size_bytes = len(file_data)
-    stored_file_uuids = user["files"]
-    
-    if user_files_collection is not None:
-        stored_files = await user_files_collection.find({"uuid": {"$in": stored_file_uuids}}).to_list(None)
-    else :
-        stored_files = []
+    result = await user_collection.update_one(
+        {"uuid": user_uuid, "storage_bytes": {"$lte": USER_STORAGE_LIMIT_BYTES - file_size_bytes}},
+        {"$push": {"files": file_uuid}, "$inc": {"storage_bytes": file_size_bytes}},
+    )
 
-    total_bytes = file_size_bytes + sum([file["size"] for file in stored_files])
+    if result.matched_count == 0:
+        await asyncio.to_thread(upload.discard_received)
 
-    if total_bytes > USER_STORAGE_LIMIT_BYTES:
         # The user has exceeded their storage limit
         # Return error
         raise HTTPException(status_code=400, detail="User has exceeded their storage limit")
-    
-    # Add the file to the user's stored files
-    file_uuid = uuid.uuid4().hex
 
-    user["files"].append(file_uuid)
+    blob_hash = None
+
+    try:
+        # Store the actual data in the blob store, identical
+        # files are only stored once
+        blob_hash = await blob_store.add_file(db, upload.temp_path, upload.hash)
+
+        # Add the file to the user_files collection
+        await user_files_collection.insert_one({
+            "uuid": file_uuid,
+            "name": upload.filename,
+            "timestamp": datetime.datetime.now().timestamp(),
+            "size": file_size_bytes,
+            "user_uuid": user_uuid,
+            "hash": blob_hash,
+        })
+    except Exception:
+        # Give back the reserved space, the file wasn't stored
+        await user_collection.update_one(
+            {"uuid": user_uuid},
+            {"$pull": {"files": file_uuid}, "$inc": {"storage_bytes": -file_size_bytes}},
+        )
+
+        if blob_hash is not None:
+            await blob_store.release(db, [blob_hash])
+        else:
+            await asyncio.to_thread(upload.discard_received)
+
+        raise
 
-    # Update the user
-    await user_collection.replace_one({"uuid": user_uuid}, user)
-
-    # Add the file to the user_files collection
-    await user_files_collection.insert_one({
-        "uuid": file_uuid,
-        "name": form["file"].filename,
-        "timestamp": datetime.datetime.now().timestamp(),
-        "size": file_size_bytes,
-        "user_uuid": user_uuid
-    })
-
-    # Store actual data as a separate file under the uuid,
-    # in the "user_files" directory
-    if not os.path.exists("user_files"):
-        os.mkdir("user_files")
-        
-    with open(f"user_files/{file_uuid}", "wb") as f:
-        f.write(file_data)
-    
     # Return
     return
 
 
 @user_router.post("/delete_file")
-async def route_delete_file_for_user(request: Request):
+async def route_delete_file_for_user(request: Request, db: MongoDB = Depends(get_db)):
     # Delete a file for a user
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Deleting file for user...")
 
-    db = MongoDB()
-
     # Get the users collection
     user_collection = await db.get_collection("users")
 
@@ -402,31 +361,32 @@ async def route_delete_file_for_user(request: Request):
         # Return error
         raise HTTPException(status_code=404, detail="User does not exist")
     
-    # Delete the file from the user's stored files
-    user["files"].remove(file_uuid)
-
-    # Update the user
-    await user_collection.replace_one({"uuid": user_uuid}, user)
+    # Delete the file from the user's stored files, and free up its space
+    await user_collection.update_one({"uuid": user_uuid}, {"$pull": {"files": file_uuid}})
+    await user_collection.update_one(
+        {"uuid": user_uuid, "storage_bytes": {"$ne": None}},
+        {"$inc": {"storage_bytes": -file["size"]}},
+    )
 
     # Delete the file
     await user_files_collection.delete_one({"uuid": file_uuid})
 
-    # Delete the file from the user_files directory
-    if os.path.exists(f"user_files/{file_uuid}"):
-        os.remove(f"user_files/{file_uuid}")
+    # Release the file's data, files from before the blob store are stored by uuid
+    if file.get("hash") is not None:
+        await blob_store.release(db, [file["hash"]])
+    else:
+        await asyncio.to_thread(delete_user_file_blobs, [file_uuid])
 
     # Return
     return
 
 
 @user_router.get("/download_file/{file_uuid}")
-async def route_download_file(request: Request, file_uuid: str):
+async def route_download_file(request: Request, file_uuid: str, db: MongoDB = Depends(get_db)):
     # Download a file
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Downloading file...")
 
-    db = MongoDB()
-
     # Get the users collection
     user_files_collection = await db.get_collection("user_files")
 
@@ -438,12 +398,9 @@ async def route_download_file(request: Request, file_uuid: str):
         # Return error
         raise HTTPException(status_code=404, detail="File not found")
     
-    # Get the file data from the user_files directory
-    if os.path.exists(f"user_files/{file_uuid}"):
-        return FileResponse(f"user_files/{file_uuid}", media_type="application/octet-stream", filename=file["name"])    
-    
-    else :
-        # The file does not exist
-        # Return error
-        raise HTTPException(status_code=404, detail="File does not exist")
+    # Send the file data from the blob store, clients can resume
+    # downloads and revalidate cached copies with the hash as ETag
+    path = blob_store.file_path(file, USER_FILES_DIR)
+
+    return await send_file(request, path, file["name"], etag=file.get("hash"))
     
@@ -1,14 +1,17 @@
 from datetime import datetime,timedelta, timezone
+import asyncio
 import logging
 import os
 import uuid
 
-from fastapi.responses import FileResponse
-from utilities import email_user, format_email_template, validate_api_key
+from utilities import email_user, format_email_template, require_scope
+from misc.blob_store import blob_store
+from misc.downloads import IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, send_file
+from misc.photos import RENDITIONS, SERVER_FILES_DIR, photo_processor
 from db_schema import *
 import requests
 
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 
 workshops_router = APIRouter(
     prefix="/api/v2/workshops",
@@ -16,14 +19,39 @@ workshops_router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+
+async def delete_server_files(db: MongoDB, file_uuids: List[str]):
+    # Delete server_files documents and release their data in the blob store
+    server_files_collection = await db.get_collection("server_files")
+    files = await server_files_collection.find({"uuid": {"$in": file_uuids}}, {"uuid": 1, "hash": 1, "renditions": 1}).to_list(None)
+
+    await server_files_collection.delete_many({"uuid": {"$in": file_uuids}})
+
+    blob_hashes = [file["hash"] for file in files if file.get("hash") is not None]
+    for file in files:
+        if file.get("renditions") is not None:
+            blob_hashes += list(file["renditions"].values())
+
+    await blob_store.release(db, blob_hashes)
+
+    # Files from before the blob store are stored by uuid
+    legacy_uuids = [file["uuid"] for file in files if file.get("hash") is None]
+    await asyncio.to_thread(delete_legacy_server_files, legacy_uuids)
+
+
+def delete_legacy_server_files(file_uuids: List[str]):
+    for file_uuid in file_uuids:
+        try:
+            os.remove(os.path.join(SERVER_FILES_DIR, file_uuid))
+        except FileNotFoundError:
+            pass
+
 @workshops_router.get("/get_workshops_for_user/{user_uuid}")
-async def route_get_workshops(request: Request, user_uuid: str):
+async def route_get_workshops(request: Request, user_uuid: str, db: MongoDB = Depends(get_db)):
     # Get workshops
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting workshops...")
 
-    db = MongoDB()
-
     # Get the workshops collection
     collection = await db.get_collection("workshops")
 
@@ -63,23 +91,12 @@ async def route_get_workshops(request: Request, user_uuid: str):
     # Return the checkouts
     return workshops
 
-@workshops_router.get("/get_workshops")
-async def route_get_full_workshops(request: Request):
+@workshops_router.get("/get_workshops", dependencies=[Depends(require_scope("workshops"))])
+async def route_get_full_workshops(request: Request, db: MongoDB = Depends(get_db)):
     # Get workshops
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting workshops...")
 
-    db = MongoDB()
-
-    db = MongoDB()
-    api_key = request.headers["api-key"]
-    is_valid = await validate_api_key(db, api_key, "workshops")
-
-    if not is_valid:
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the checkouts collection
     collection = await db.get_collection("workshops")
 
@@ -90,22 +107,13 @@ async def route_get_full_workshops(request: Request):
 
     return workshops
 
-@workshops_router.post("/update_workshop", status_code=201)
-async def route_update_workshop(request: Request):
+@workshops_router.post("/update_workshop", status_code=201, dependencies=[Depends(require_scope("workshops"))])
+async def route_update_workshop(request: Request, db: MongoDB = Depends(get_db)):
     # Update or create a workshop
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Updating or creating workshop...")
     workshop = Workshop(**await request.json())
 
-    db = MongoDB()
-    api_key = request.headers["api-key"]
-    is_valid = await validate_api_key(db, api_key, "workshops")
-
-    if not is_valid:
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the workshops collection
     collection = await db.get_collection("workshops")
 
@@ -132,8 +140,8 @@ async def route_update_workshop(request: Request):
     # Return the workshop
     return workshop
 
-@workshops_router.post("/delete_workshop")
-async def route_delete_workshop(request: Request):
+@workshops_router.post("/delete_workshop", dependencies=[Depends(require_scope("workshops"))])
+async def route_delete_workshop(request: Request, db: MongoDB = Depends(get_db)):
     # Delete a workshop
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Deleting workshop...")
@@ -141,15 +149,6 @@ async def route_delete_workshop(request: Request):
     # Get the request body
     body = await request.json()
 
-    db = MongoDB()
-    api_key = request.headers["api-key"]
-    is_valid = await validate_api_key(db, api_key, "workshops")
-
-    if not is_valid:
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the workshops collection
     collection = await db.get_collection("workshops")
 
@@ -164,17 +163,19 @@ async def route_delete_workshop(request: Request):
     # Delete the workshop
     await collection.delete_one({"uuid": body["uuid"]})
 
+    # Delete the workshop's photos
+    if type(workshop.get("photos")) == list:
+        await delete_server_files(db, workshop["photos"])
+
     return
 
 
 @workshops_router.post("/rsvp", status_code=201)
-async def route_rsvp_to_workshop(request: Request):
+async def route_rsvp_to_workshop(request: Request, db: MongoDB = Depends(get_db)):
     logging.getLogger().setLevel(logging.INFO)
     # Get the request body
     body = await request.json()
 
-    db = MongoDB()
-
     # Get the workshops collection
     collection = await db.get_collection("workshops")
 
@@ -237,15 +238,13 @@ async def route_rsvp_to_workshop(request: Request):
     return 
 
 @workshops_router.post("/cancel_rsvp", status_code=201)
-async def route_cancel_rsvp_to_workshop(request: Request):
+async def route_cancel_rsvp_to_workshop(request: Request, db: MongoDB = Depends(get_db)):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("RSVPing to workshop...")
 
     # Get the request body
     body = await request.json()
 
-    db = MongoDB()
-
     # Get the workshops collection
     collection = await db.get_collection("workshops")
 
@@ -281,25 +280,14 @@ async def route_cancel_rsvp_to_workshop(request: Request):
     return
 
 
-@workshops_router.post("/sign_in", status_code=201)
-async def route_sign_in_to_workshop(request: Request):
+@workshops_router.post("/sign_in", status_code=201, dependencies=[Depends(require_scope("workshops"))])
+async def route_sign_in_to_workshop(request: Request, db: MongoDB = Depends(get_db)):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Signing into workshop...")
 
     # Get the request body
     body = await request.json()
 
-    db = MongoDB()
-
-    # Validate the API key
-    api_key = request.headers["api-key"]
-    is_valid = await validate_api_key(db, api_key, "workshops")
-
-    if not is_valid:
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the workshops collection
     collection = await db.get_collection("workshops")
 
@@ -332,23 +320,14 @@ async def route_sign_in_to_workshop(request: Request):
     return
 
 
-@workshops_router.post("/send_custom_workshop_email", status_code=201)
-async def route_send_custom_workshop_email(request: Request):
+@workshops_router.post("/send_custom_workshop_email", status_code=201, dependencies=[Depends(require_scope("workshops"))])
+async def route_send_custom_workshop_email(request: Request, db: MongoDB = Depends(get_db)):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Deleting workshop...")
 
     # Get the request body
     body = await request.json()
 
-    db = MongoDB()
-    api_key = request.headers["api-key"]
-    is_valid = await validate_api_key(db, api_key, "workshops")
-
-    if not is_valid:
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the workshops collection
     collection = await db.get_collection("workshops")
 
@@ -428,23 +407,14 @@ async def route_subscribe(request: Request):
 
     return
 
-@workshops_router.post("/add_photo", status_code=201)
-async def route_add_photo_to_workshop(request: Request):
+@workshops_router.post("/add_photo", status_code=201, dependencies=[Depends(require_scope("workshops"))])
+async def route_add_photo_to_workshop(request: Request, db: MongoDB = Depends(get_db)):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Adding photo to workshop...")
 
     # Get the user UUID and role
     form = await request.form()
 
-    db = MongoDB()
-    api_key = request.headers["api-key"]
-    is_valid = await validate_api_key(db, api_key, "workshops")
-
-    if not is_valid:
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the workshops collection
     collection = await db.get_collection("workshops")
 
@@ -465,59 +435,54 @@ async def route_add_photo_to_workshop(request: Request):
     if type(workshop["photos"]) != list:
         workshop["photos"] = []
 
-    file_data = form["file"].file.read()
+    file_data = await form["file"].read()
     file_size_bytes = len(file_data)
 
     file_uuid = uuid.uuid4().hex
 
-    workshop["photos"].append(file_uuid)
+    # Store the original in the blob store, identical photos are only stored once
+    blob_hash = await blob_store.add_bytes(db, file_data)
 
-    # Update the workshop
-    await collection.replace_one({"uuid": form["workshop_uuid"]}, workshop)
-
-    # Add the file to the server_files collection
-    await server_files_collection.insert_one({
-        "uuid": file_uuid,
-        "name": form["file"].filename,
-        "timestamp": datetime.now().timestamp(),
-        "size": file_size_bytes
-    })
+    try:
+        # Add the file to the server_files collection, the smaller
+        # renditions are added once they have been made
+        await server_files_collection.insert_one({
+            "uuid": file_uuid,
+            "name": form["file"].filename,
+            "timestamp": datetime.now().timestamp(),
+            "size": file_size_bytes,
+            "hash": blob_hash,
+            "renditions": None,
+            "rendition_error": None,
+        })
 
-    # Save the file to the server
-    if not os.path.exists("server_files"):
-        os.makedirs("server_files")
+        workshop["photos"].append(file_uuid)
 
-    with open(f"server_files/{file_uuid}", "wb") as f:
-        f.write(file_data)
+        # Update the workshop
+        await collection.replace_one({"uuid": form["workshop_uuid"]}, workshop)
+    except Exception:
+        # The photo wasn't added, so drop its document and give back its reference
+        await server_files_collection.delete_one({"uuid": file_uuid})
+        await blob_store.release(db, [blob_hash])
 
-    # Attempt to optimize the image to webp format with ffmpeg
-    # Keep ratio, reduce to 480p, and set quality to 95
-    # Get status code
-    logging.info(f"Optimizing {file_uuid}...")
-    status_code = os.system(f"ffmpeg -i server_files/{file_uuid} -vf scale=-1:480 -q:v 95 server_files/{file_uuid}.webp")
-    
-    if status_code == 0:
-        logging.info(f"Optimized {file_uuid} successfully")
-        # The optimization was successful
-        # Remove the original file
-        os.remove(f"server_files/{file_uuid}")
-
-        # Rename the webp file to the original file
-        os.rename(f"server_files/{file_uuid}.webp", f"server_files/{file_uuid}")
-    else:
-        # The optimization was not successful
-        # Log the error
-        logging.error(f"Error optimizing {file_uuid}")
+        raise
+
+    # Make the webp renditions in the background
+    photo_processor.enqueue(file_uuid)
 
     return
 
 
 @workshops_router.get("/download_photo/{photo_uuid}")
-async def route_get_photo(photo_uuid: str):
+async def route_get_photo(request: Request, photo_uuid: str, size: str = "480", db: MongoDB = Depends(get_db)):
+    # size is one of the renditions (thumbnail, 480 or 1080) or original
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Getting photo...")
 
-    db = MongoDB()
+    if size != "original" and size not in RENDITIONS:
+        # The size does not exist
+        # Return error
+        raise HTTPException(status_code=400, detail="Invalid photo size")
 
     # Get the server_files collection
     collection = await db.get_collection("server_files")
@@ -530,33 +495,35 @@ async def route_get_photo(photo_uuid: str):
         # Return error
         raise HTTPException(status_code=404, detail="Photo not found")
 
-    # Get the file data from the user_files directory
-    if os.path.exists(f"server_files/{photo_uuid}"):
-        return FileResponse(f"server_files/{photo_uuid}", media_type="application/octet-stream", filename=file["name"])    
-    
-    else :
-        # The file does not exist
-        # Return error
-        raise HTTPException(status_code=404, detail="Photo does not exist")
+    # Serve the original until the renditions have been made
+    name = file["name"]
+    served_requested_size = size == "original" or file.get("renditions") is not None
+
+    if size != "original" and file.get("renditions") is not None:
+        file = {"uuid": file["uuid"], "hash": file["renditions"][size]}
+        name = os.path.splitext(name)[0] + ".webp"
+
+    # Blobs never change, so once the requested size is being served it can
+    # be cached for good. Until then, clients have to check back
+    if served_requested_size and file.get("hash") is not None:
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    else:
+        cache_control = REVALIDATE_CACHE_CONTROL
 
+    # Send the file data from the blob store
+    path = blob_store.file_path(file, "server_files")
 
-@workshops_router.post("/delete_photo", status_code=201)
-async def route_delete_photo_from_workshop(request: Request):
+    return await send_file(request, path, name, etag=file.get("hash"), cache_control=cache_control, inline=True)
+
+
+@workshops_router.post("/delete_photo", status_code=201, dependencies=[Depends(require_scope("workshops"))])
+async def route_delete_photo_from_workshop(request: Request, db: MongoDB = Depends(get_db)):
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Deleting photo from workshop...")
 
     # Get the request body
     body = await request.json()
 
-    db = MongoDB()
-    api_key = request.headers["api-key"]
-    is_valid = await validate_api_key(db, api_key, "workshops")
-
-    if not is_valid:
-        # The API key is invalid
-        # Return error
-        raise HTTPException(status_code=401, detail="Invalid API key")
-
     # Get the workshops collection
     collection = await db.get_collection("workshops")
 
@@ -574,4 +541,7 @@ async def route_delete_photo_from_workshop(request: Request):
     # Update the workshop
     await collection.replace_one({"uuid": body["workshop_uuid"]}, workshop)
 
+    # Delete the photo's data
+    await delete_server_files(db, [body["photo_uuid"]])
+
     return
\ No newline at end of file
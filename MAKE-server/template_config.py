@@ -5,6 +5,12 @@ DB_NAME = "make"
 DB_USER = ""
 DB_PASSWORD = ""
 
+# Database connection pool, shared by all requests and background jobs
+DB_MAX_POOL_SIZE = 50
+DB_MIN_POOL_SIZE = 5
+# Close connections that have been idle for this long
+DB_MAX_IDLE_TIME_MS = 60 * 1000
+
 # Size of user storage in bytes
 # Default is 2GB
 USER_STORAGE_LIMIT_BYTES = 2 * 1024 * 1024 * 1024
@@ -12,6 +18,24 @@ USER_STORAGE_LIMIT_BYTES = 2 * 1024 * 1024 * 1024
 # Default is 1 week
 USER_STORAGE_LIMIT_SECONDS = 60 * 60 * 24 * 7 
 
+# Number of processes resizing workshop photos in the background
+PHOTO_WORKERS = 2
+
+# Memory used to cache finished loom renders
+LOOM_CACHE_BYTES = 64 * 1024 * 1024
+# Memory used to cache intermediate loom images, so changing
+# only invert or tabby_width skips resizing and dithering.
+# Split evenly between the LOOM_WORKERS processes
+LOOM_STAGE_CACHE_BYTES = 256 * 1024 * 1024
+# Directory loom renders evicted from memory are kept in,
+# None to only cache in memory
+LOOM_CACHE_DIR = None
+LOOM_CACHE_DIR_BYTES = 1024 * 1024 * 1024
+# Number of processes rendering loom images, and the most renders
+# that can be queued or running before new ones are turned away
+LOOM_WORKERS = 2
+LOOM_MAX_PENDING = 8
+
 # This should be August 1st of each year
 QUIZ_RESET_DAY = 213
 
@@ -21,6 +45,15 @@ DISCORD_BOT_TOKEN = ""
 # BambuLabs Login info
 BAMBULABS_EMAIL = "makerspace-management-l@g.hmc.edu"
 BAMBULABS_PASS = "PASSWORD"
+# Bambu cloud servers, point these at benchmarks/bambu_mock.py to run offline
+BAMBU_API_URL = "https://api.bambulab.com"
+BAMBU_LOGIN_URL = "https://bambulab.com/api/sign-in/form"
+BAMBU_MQTT_HOST = "us.mqtt.bambulab.com"
+BAMBU_MQTT_PORT = 8883
+# Set to False to connect without TLS, e.g. to a local test server
+BAMBU_MQTT_USE_TLS = True
+# Seconds the list of printers is cached for
+BAMBU_DEVICES_TTL_SECONDS = 60
 
 # Misc Emails
 MAKERSPACE_MANAGEMENT_EMAIL = "makerspace-management-l@g.hmc.edu"
@@ -31,6 +64,16 @@ WEBMASTER_EMAIL = "wkirkland@g.hmc.edu"
 GMAIL_EMAIL = "EMAIL"
 GMAIL_PASS = "PASSWORD"
 
+# Outgoing mail server used by the email outbox
+SMTP_HOST = "smtp.gmail.com"
+SMTP_PORT = 465
+# Set to False to connect without implicit TLS, either to a submission
+# port like 587 (STARTTLS is used when offered) or to a local test server.
+# Servers that don't offer AUTH are only allowed when GMAIL_PASS is ""
+SMTP_USE_SSL = True
+# Number of outbox workers, each keeps its own SMTP connection open
+EMAIL_WORKERS = 2
+
 # Quiz ID dictionary
 QUIZ_IDS = {
     "General": "66546920",
@@ -44,6 +87,9 @@ QUIZ_IDS = {
     "Laser": "677552423",
     "3D": "577888883",
 }
+# Published CSV of a quiz's responses, {gid} is replaced with its QUIZ_IDS value.
+# Point this at benchmarks/quiz_sheets.py to scrape fixture sheets offline
+QUIZ_SHEET_URL = "https://docs.google.com/spreadsheets/d/e/2PACX-1vRyOdR5ZzocTVLi02rPVQPVwoGyuPrGmULHznFB66pDnqsWrCWVTi5JM5KCbBn8oMVLa-vwIS3RvK6z/pub?gid={gid}&single=true&output=csv"
 
 # Student Storage Structure
 STUDENT_STORAGE_STRUCTURE = {
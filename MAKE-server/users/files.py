@@ -0,0 +1,275 @@
+import asyncio
+import hashlib
+import os
+import uuid
+from typing import Dict, List, Union
+
+from fastapi import HTTPException, Request
+from multipart.multipart import MultipartParser, parse_options_header
+from config import USER_STORAGE_LIMIT_BYTES
+from db_schema import MongoDB
+
+# Directory the data of user files is stored in, named by file uuid
+USER_FILES_DIR = "user_files"
+# Uploads are written to disk in chunks of about this size
+UPLOAD_WRITE_BYTES = 1024 * 1024
+# Form fields other than the file are small, reject anything larger
+MAX_FIELD_BYTES = 64 * 1024
+
+
+async def get_user_storage_bytes(db: MongoDB, user: dict):
+    # Get the number of bytes a user has stored. The total is kept on the
+    # user as storage_bytes, users from before it existed get it here
+    if user.get("storage_bytes") is not None:
+        return user["storage_bytes"]
+
+    user_files_collection = await db.get_collection("user_files")
+    total = await user_files_collection.aggregate([
+        {"$match": {"user_uuid": user["uuid"]}},
+        {"$group": {"_id": None, "size": {"$sum": "$size"}}},
+    ]).to_list(None)
+
+    storage_bytes = total[0]["size"] if len(total) > 0 else 0
+
+    user_collection = await db.get_collection("users")
+    await user_collection.update_one(
+        {"uuid": user["uuid"], "storage_bytes": None},
+        {"$set": {"storage_bytes": storage_bytes}},
+    )
+
+    user["storage_bytes"] = storage_bytes
+
+    return storage_bytes
+
+
+def delete_user_file_blobs(file_uuids: List[str]):
+    # Delete the data of user files from before the blob store, returns the
+    # number of bytes freed. This blocks, so it is run in a thread
+    freed_bytes = 0
+
+    for file_uuid in file_uuids:
+        path = os.path.join(USER_FILES_DIR, file_uuid)
+
+        try:
+            freed_bytes += os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    return freed_bytes
+
+
+def find_orphan_user_file_blobs(known_uuids: set, older_than: float):
+    # Find stored data with no user_files document. Recent files are
+    # skipped, they may belong to an upload that is still being saved
+    if not os.path.exists(USER_FILES_DIR):
+        return []
+
+    orphans = []
+
+    with os.scandir(USER_FILES_DIR) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name in known_uuids:
+                continue
+
+            if entry.stat().st_mtime < older_than:
+                orphans.append(entry.name)
+
+    return orphans
+
+
+class UserFileUpload:
+    '''
+    Receives a multipart upload with user_uuid and file fields, streaming
+    the file to a temporary file in USER_FILES_DIR instead of holding it in
+    memory. The upload is stopped as soon as it goes over the user's
+    storage limit, which needs user_uuid to be sent before the file.
+    The file is hashed as it's written, ready for the blob store.
+    Disk writes happen in a thread, so the event loop isn't blocked.
+    '''
+
+    def __init__(self, request: Request, db: MongoDB):
+        self.request = request
+        self.db = db
+
+        self.fields: Dict[str, str] = {}
+        self.user: Union[dict, None] = None
+        self.available_bytes = USER_STORAGE_LIMIT_BYTES
+        self.filename: Union[str, None] = None
+        self.size = 0
+        self.temp_path: Union[str, None] = None
+        self.digest = hashlib.sha256()
+        self.hash: Union[str, None] = None
+
+        # Parser callbacks are synchronous, so they queue events
+        # that are then handled asynchronously
+        self.events: List[tuple] = []
+        self.header_field = b""
+        self.header_value = b""
+        self.headers: Dict[bytes, bytes] = {}
+        self.part_name: Union[str, None] = None
+        self.part_is_file = False
+        self.field_data = bytearray()
+        self.file_data = bytearray()
+
+    # Parser callbacks
+
+    def on_part_begin(self):
+        self.headers = {}
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field = b""
+        self.header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.headers.get(b"content-disposition", b""))
+        self.part_name = options.get(b"name", b"").decode("latin-1")
+        self.part_is_file = b"filename" in options
+
+        if self.part_is_file:
+            self.events.append(("file_begin", options[b"filename"].decode("utf-8", "replace")))
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self.part_is_file:
+            self.file_data += data[start:end]
+            return
+
+        self.field_data += data[start:end]
+
+        if len(self.field_data) > MAX_FIELD_BYTES:
+            raise HTTPException(status_code=400, detail=f"Form field {self.part_name} is too large")
+
+    def on_part_end(self):
+        if self.part_is_file:
+            self.events.append(("file_end", None))
+        else:
+            self.fields[self.part_name] = self.field_data.decode("utf-8")
+            self.field_data = bytearray()
+            self.events.append(("field", self.part_name))
+
+    # Event handling
+
+    async def load_user(self):
+        user_collection = await self.db.get_collection("users")
+        self.user = await user_collection.find_one({"uuid": self.fields["user_uuid"]})
+
+        if self.user is None:
+            # The user does not exist
+            # Return error
+            raise HTTPException(status_code=404, detail="User does not exist")
+
+        self.available_bytes = USER_STORAGE_LIMIT_BYTES - await get_user_storage_bytes(self.db, self.user)
+
+        # Some of the file may have arrived before user_uuid
+        if self.size > self.available_bytes:
+            raise HTTPException(status_code=400, detail="User has exceeded their storage limit")
+
+    async def write_data(self, file, final: bool):
+        # Write the buffered file data once enough has built up
+        if len(self.file_data) == 0 or (not final and len(self.file_data) < UPLOAD_WRITE_BYTES):
+            return
+
+        self.size += len(self.file_data)
+
+        # Until the user is known, available_bytes is the storage limit
+        # of an empty account, so the upload is never unbounded
+        if self.size > self.available_bytes:
+            # The user has exceeded their storage limit
+            # Return error
+            raise HTTPException(status_code=400, detail="User has exceeded their storage limit")
+
+        data = bytes(self.file_data)
+        self.file_data = bytearray()
+
+        await asyncio.to_thread(self.write_and_hash, file, data)
+
+    def write_and_hash(self, file, data: bytes):
+        file.write(data)
+        self.digest.update(data)
+
+    async def receive(self):
+        # Read the whole upload, returns once the file is safely on disk
+        _, params = parse_options_header(self.request.headers.get("content-type", ""))
+        boundary = params.get(b"boundary")
+
+        if boundary is None:
+            raise HTTPException(status_code=400, detail="Expected a multipart upload")
+
+        parser = MultipartParser(boundary, {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        })
+
+        if not os.path.exists(USER_FILES_DIR):
+            os.mkdir(USER_FILES_DIR)
+
+        self.temp_path = os.path.join(USER_FILES_DIR, f".upload-{uuid.uuid4().hex}")
+        file = await asyncio.to_thread(open, self.temp_path, "wb")
+
+        try:
+            async for chunk in self.request.stream():
+                parser.write(chunk)
+                await self.handle_events(file)
+
+                if self.filename is not None:
+                    await self.write_data(file, final=False)
+
+            parser.finalize()
+            await self.handle_events(file)
+
+            if self.filename is None or "user_uuid" not in self.fields:
+                raise HTTPException(status_code=400, detail="Expected user_uuid and file fields")
+
+            if self.user is None:
+                # user_uuid came after the file, so the user's own limit can only be checked now
+                await self.load_user()
+
+            # Make sure the data is on disk before it's moved into the blob store
+            await asyncio.to_thread(self.sync_and_close, file)
+            self.hash = self.digest.hexdigest()
+        except:
+            await asyncio.to_thread(self.discard, file)
+            raise
+
+    async def handle_events(self, file):
+        events = self.events
+        self.events = []
+
+        for event, value in events:
+            if event == "field" and value == "user_uuid" and self.user is None:
+                await self.load_user()
+            elif event == "file_begin":
+                if self.filename is not None:
+                    raise HTTPException(status_code=400, detail="Only one file can be uploaded at a time")
+
+                self.filename = value
+            elif event == "file_end":
+                await self.write_data(file, final=True)
+
+    def sync_and_close(self, file):
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+
+    def discard(self, file):
+        file.close()
+        self.discard_received()
+
+    def discard_received(self):
+        # Delete the received file, when it won't be kept after all
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
@@ -1,15 +1,17 @@
+import asyncio
 import csv
 from datetime import datetime
+import hashlib
+import io
+import itertools
 import logging
-from typing import List
+import tempfile
+from typing import Iterable, List
 import aiohttp
+from pymongo import ReplaceOne, UpdateOne
 from db_schema import MongoDB, QuizResponse
 from config import *
 
-#BASE_QUIZ_URL: str = "https://docs.google.com/spreadsheets/d/e/2PACX-1vRyOdR5ZzocTVLi02rPVQPVwoGyuPrGmULHznFB66pDnqsWrCWVTi5JM5KCbBn8oMVLa-vwIS3RvK6z/pub?gid="
-BASE_QUIZ_URL: str = "https://docs.google.com/spreadsheets/d/e/2PACX-1vRyOdR5ZzocTVLi02rPVQPVwoGyuPrGmULHznFB66pDnqsWrCWVTi5JM5KCbBn8oMVLa-vwIS3RvK6z/pub?gid="
-POST_QUIZ_URL: str = "&single=true&output=csv"
-
 UNDERGRAD_SCHOOL_EMAIL_DOMAINS = {
     '1': "mymail.pomona.edu",
     '2': "scrippscollege.edu",
@@ -22,47 +24,61 @@ GRAD_SCHOOL_EMAIL_DOMAINS = {
     '2': "cgu.edu",
 }
 
+# Give up on fetching a quiz sheet after this long
+QUIZ_FETCH_TIMEOUT_SECONDS = 60
+# Quiz CSVs larger than this are spooled to disk while parsing
+QUIZ_CSV_SPOOL_BYTES = 4 * 1024 * 1024
+# Quiz responses are parsed and merged into the database this many at a time
+QUIZ_BATCH_SIZE = 1000
+
+# quiz_id -> the ETag, Last-Modified and content hash of the last scraped CSV
+quiz_sheet_state = {}
+
 async def scrape_quiz_results():
     # Set logging level
     logging.getLogger().setLevel(logging.INFO)
 
     # Initialize variables
     total_responses = 0
-    total_new_responses = 0
-
-    # Go through QUIZ_IDS and scrape the quiz results for each quiz
-    for _, quiz_id in QUIZ_IDS.items():
-        # Get the quiz results
-        quiz_results = await get_quiz_results(quiz_id)
-        # Update the database
-        new_responses = await update_quiz_results(quiz_id, quiz_results)
-
-        # Update total response counts
-        total_responses += len(quiz_results)
-        total_new_responses += new_responses
+    total_unchanged = 0
+    total_counts = {"inserted": 0, "updated": 0, "removed": 0}
+
+    quizzes_valid_after = get_quizzes_valid_after()
+
+    # Fetch all quizzes at once over one session
+    timeout = aiohttp.ClientTimeout(total=QUIZ_FETCH_TIMEOUT_SECONDS)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        results = await asyncio.gather(*[
+            scrape_quiz(session, quiz_id, quizzes_valid_after) for quiz_id in QUIZ_IDS.values()
+        ], return_exceptions=True)
+
+    for quiz_id, result in zip(QUIZ_IDS.values(), results):
+        if isinstance(result, Exception):
+            # One quiz failing shouldn't stop the others from updating
+            logging.error(f"Failed to scrape quiz {quiz_id}: {result!r}")
+        elif result is None:
+            total_unchanged += 1
+        else:
+            # Update total response counts
+            responses, counts = result
+            total_responses += responses
+            for name in total_counts:
+                total_counts[name] += counts[name]
 
     # Print log message
-    logging.info(f"Scraped {total_new_responses} new quiz results for {len(QUIZ_IDS)} quizzes for a total of {total_responses} responses.")
+    logging.info(
+        f"Scraped {len(QUIZ_IDS) - total_unchanged} changed quizzes with a total of {total_responses} responses "
+        f"({total_counts['inserted']} inserted, {total_counts['updated']} updated, {total_counts['removed']} removed, "
+        f"{total_unchanged} quizzes unchanged)."
+    )
 
     # Attempt to fix broken cx ids by cross-referencing email addresses
     await fix_broken_cx_ids()
 
 
-async def get_quiz_results(quiz_id):
-    # Get the quiz results from the Google Sheets API
-    # Returns a list of dictionaries, where each dictionary is a quiz result
-    # and the keys are the column names.
-    # The column names are the first row of the spreadsheet.
-    # The first column is the timestamp.
-
-    # Get the quiz results from the Google Sheets API
-    quiz_responses = []
-
-    quiz_url = BASE_QUIZ_URL + quiz_id + POST_QUIZ_URL
-
+def get_quizzes_valid_after():
     # Make timestamp that quizzes are valid after.
     # This resets every year on QUIZ_RESET_DAY
-    quizzes_valid_after = 0
 
     # Get the current date
     current_date = datetime.now()
@@ -75,56 +91,121 @@ async def get_quiz_results(quiz_id):
 
     if day_of_year < QUIZ_RESET_DAY:
         # The quiz date is valid if the quiz timestamp is in the previous year
-        quizzes_valid_after = datetime(current_year - 1, 8, 1).timestamp()
+        return datetime(current_year - 1, 8, 1).timestamp()
     else:
         # The quiz date is valid if the quiz timestamp is in the current year
-        quizzes_valid_after = datetime(current_year, 8, 1).timestamp()
-
-    total_valid = 0
-    total_invalid = 0
-
-    async with aiohttp.ClientSession() as session:
-        async with session.get(quiz_url) as response:
-            # Decode the response as a string
-            response_text = await response.text()
-            # Parse the CSV string into a list of dictionaries
-            quiz_results = list(csv.reader(
-                response_text.splitlines(), delimiter=','))
-
-            # Drop header row
-            quiz_results.pop(0)
-
-            # Set up the quiz response dictionary
-
-            # Convert the timestamp strings into datetime objects
-            for quiz_result in quiz_results:
-
-                cx_id = process_cx_id(quiz_result[3])
-                email = process_email(quiz_result[4], cx_id)
-
-                quiz_response = QuizResponse(
-                    gid=quiz_id,
-                    timestamp=datetime.strptime(
-                        quiz_result[0], "%m/%d/%Y %H:%M:%S").timestamp(),
-                    score=quiz_result[1],
-                    name=quiz_result[2],
-                    cx_id=cx_id,
-                    email=email,
-                    passed=determine_if_passed(quiz_result[1])
-                )
-
-                # Check if the quiz date is valid
-                if quiz_response.timestamp < quizzes_valid_after:
-                    total_invalid += 1
-                    quiz_response.passed = False
-                else:
-                    total_valid += 1
-
-                # Add the quiz response to the list of quiz responses
-                quiz_responses.append(quiz_response)
+        return datetime(current_year, 8, 1).timestamp()
 
-    # Return the quiz results
-    return quiz_responses
+
+async def scrape_quiz(session: aiohttp.ClientSession, quiz_id: str, quizzes_valid_after: float):
+    # Scrape a single quiz, returns None if it hasn't changed since the
+    # last scrape, otherwise the number of responses and the update counts
+    fetched = await fetch_quiz_csv(session, quiz_id, quizzes_valid_after)
+
+    if fetched is None:
+        return None
+
+    csv_file, sheet_state = fetched
+
+    with csv_file:
+        # Parse the quiz results while updating the database with them
+        quiz_results = get_quiz_results(quiz_id, csv_file, quizzes_valid_after)
+        responses, counts = await update_quiz_results(quiz_id, quiz_results)
+
+    # Only remember the sheet once it's in the database, so a failed
+    # update is retried on the next scrape
+    quiz_sheet_state[quiz_id] = sheet_state
+
+    return responses, counts
+
+
+async def fetch_quiz_csv(session: aiohttp.ClientSession, quiz_id: str, quizzes_valid_after: float):
+    # Download a quiz's CSV into a temporary file, which only goes to disk
+    # if the CSV is large. Returns None if the sheet hasn't changed,
+    # otherwise the file and the state to remember for the next fetch
+    quiz_url = QUIZ_SHEET_URL.format(gid=quiz_id)
+    last_state = quiz_sheet_state.get(quiz_id, {})
+
+    # Let the server tell us if nothing changed, if it supports it
+    headers = {}
+    if last_state.get("etag") is not None:
+        headers["If-None-Match"] = last_state["etag"]
+    if last_state.get("last_modified") is not None:
+        headers["If-Modified-Since"] = last_state["last_modified"]
+
+    # The passed fields depend on quizzes_valid_after as well as
+    # the CSV, so both go into the hash
+    digest = hashlib.sha256(str(quizzes_valid_after).encode())
+    csv_file = tempfile.SpooledTemporaryFile(max_size=QUIZ_CSV_SPOOL_BYTES)
+    # The file is closed unless it's returned
+    keep_file = False
+
+    try:
+        async with session.get(quiz_url, headers=headers) as response:
+            if response.status == 304:
+                return None
+
+            response.raise_for_status()
+
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                digest.update(chunk)
+                csv_file.write(chunk)
+
+            sheet_state = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "hash": digest.hexdigest(),
+            }
+
+        if sheet_state["hash"] == last_state.get("hash"):
+            # Same CSV as last time, there's nothing to update
+            quiz_sheet_state[quiz_id] = sheet_state
+            return None
+
+        csv_file.seek(0)
+        keep_file = True
+
+        return csv_file, sheet_state
+    finally:
+        if not keep_file:
+            csv_file.close()
+
+
+def get_quiz_results(quiz_id, csv_file, quizzes_valid_after):
+    # Parse the quiz results from a downloaded CSV
+    # Yields a QuizResponse for each row, so the whole quiz
+    # is never held in memory at once.
+    # The column names are the first row of the spreadsheet.
+    # The first column is the timestamp.
+
+    # Parse the CSV one row at a time
+    quiz_results = csv.reader(io.TextIOWrapper(csv_file, encoding="utf-8", newline=""), delimiter=',')
+
+    # Drop header row
+    next(quiz_results, None)
+
+    # Convert the timestamp strings into datetime objects
+    for quiz_result in quiz_results:
+
+        cx_id = process_cx_id(quiz_result[3])
+        email = process_email(quiz_result[4], cx_id)
+
+        quiz_response = QuizResponse(
+            gid=quiz_id,
+            timestamp=datetime.strptime(
+                quiz_result[0], "%m/%d/%Y %H:%M:%S").timestamp(),
+            score=quiz_result[1],
+            name=quiz_result[2],
+            cx_id=cx_id,
+            email=email,
+            passed=determine_if_passed(quiz_result[1])
+        )
+
+        # Check if the quiz date is valid
+        if quiz_response.timestamp < quizzes_valid_after:
+            quiz_response.passed = False
+
+        yield quiz_response
 
 
 def process_cx_id(cx_id):
@@ -278,25 +359,109 @@ def determine_if_passed(score):
         return False
 
 
-async def update_quiz_results(quiz_id: str, quiz_results: List[QuizResponse]):
-    # Update the quiz results in the database
-    # Returns the number of quiz results that were inserted into the database
+def quiz_result_key(quiz_result: dict):
+    # A response is identified by its quiz, submission time and email
+    return (quiz_result["gid"], quiz_result["timestamp"], quiz_result["email"])
+
+
+def batched(iterable: Iterable, size: int):
+    # Split an iterable into lists of up to size items
+    iterator = iter(iterable)
+
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+async def update_quiz_results(quiz_id: str, quiz_results: Iterable[QuizResponse]):
+    # Merge the scraped results of a quiz into the database a batch at a
+    # time, only writing responses that are new or changed and removing
+    # ones gone from the sheet. Returns the number of responses, and the
+    # number of quiz results inserted, updated and removed
     db = MongoDB()
 
     # Get the collection
     collection = await db.get_collection("quizzes")
 
-    # Delete all quiz results for the quiz
-    await collection.delete_many({"gid": quiz_id})
+    # Written responses are stamped with the time, so users can be
+    # updated from just the changed ones
+    timestamp_updated = datetime.now().timestamp()
+
+    responses = 0
+    counts = {"inserted": 0, "updated": 0, "removed": 0}
+    # Stored responses that are still in the sheet
+    kept = set()
+
+    for batch in batched(quiz_results, QUIZ_BATCH_SIZE):
+        responses += len(batch)
+        await merge_quiz_results(collection, quiz_id, batch, timestamp_updated, kept, counts)
+
+    # Remove responses gone from the sheet, and duplicates of ones that were
+    # kept. Everything written above has this scrape's timestamp_updated
+    removed_ids = [
+        stored["_id"]
+        async for stored in collection.find({"gid": quiz_id, "timestamp_updated": {"$ne": timestamp_updated}}, {"_id": 1})
+        if stored["_id"] not in kept
+    ]
+
+    for batch in batched(removed_ids, QUIZ_BATCH_SIZE):
+        await collection.delete_many({"_id": {"$in": batch}})
+
+    counts["removed"] = len(removed_ids)
+
+    return responses, counts
 
-    # Convert all quiz results to a list of dictionaries
-    quiz_results = [quiz_result.dict() for quiz_result in quiz_results]
 
-    # Insert all quiz results into the database
-    await collection.insert_many(quiz_results)
+async def merge_quiz_results(collection, quiz_id: str, quiz_results: List[QuizResponse], timestamp_updated: float, kept: set, counts: dict):
+    # Key the scraped results by identity
+    scraped = {}
+    for quiz_result in quiz_results:
+        quiz_result = quiz_result.model_dump()
+        quiz_result["timestamp_updated"] = timestamp_updated
+        scraped[quiz_result_key(quiz_result)] = quiz_result
 
-    # Return length of quiz results
-    return len(quiz_results)
+    # Compare against what's already stored for these responses. Oldest
+    # first, so the same document is kept for a response in every batch
+    timestamps = list({quiz_result["timestamp"] for quiz_result in scraped.values()})
+    existing = await collection.find({"gid": quiz_id, "timestamp": {"$in": timestamps}}).sort("_id", 1).to_list(None)
+
+    operations = []
+    matched = set()
+
+    for stored in existing:
+        key = quiz_result_key(stored)
+
+        if key not in scraped or key in matched:
+            # Another response with the same timestamp, or a duplicate
+            # of one already kept, which is removed at the end
+            continue
+
+        matched.add(key)
+        kept.add(stored["_id"])
+        quiz_result = scraped[key]
+
+        # Keep cx_ids corrected by fix_broken_cx_ids, as long as
+        # the cx_id in the sheet is still the one that was corrected
+        if stored.get("original_cx_id") is not None and stored["original_cx_id"] == quiz_result["cx_id"]:
+            quiz_result = {**quiz_result, "cx_id": stored["cx_id"], "original_cx_id": stored["original_cx_id"]}
+
+        if any(stored.get(field) != value for field, value in quiz_result.items() if field != "timestamp_updated"):
+            operations.append(ReplaceOne({"_id": stored["_id"]}, quiz_result))
+            counts["updated"] += 1
+
+    for key, quiz_result in scraped.items():
+        if key not in matched:
+            operations.append(ReplaceOne(
+                {"gid": quiz_result["gid"], "timestamp": quiz_result["timestamp"], "email": quiz_result["email"]},
+                quiz_result,
+                upsert=True,
+            ))
+            counts["inserted"] += 1
+
+    if len(operations) > 0:
+        await collection.bulk_write(operations, ordered=True)
 
 
 async def fix_broken_cx_ids():
@@ -315,45 +480,80 @@ async def fix_broken_cx_ids():
 
     # Get all quiz results with cx_ids that are not 8 digits
     # and with emails that don't end in cgu.edu or kgi.edu
-    # using $lt and $gt to get all quiz results with cx_ids that are not 8 digits
-    broken_quiz_results = await collection.find(
-        {"$or": [{"cx_id": {"$lt": 10000000}}, {"cx_id": {"$gt": 100000000}}], "email": {"$not": {"$regex": ".*cgu.edu|kgi.edu"}}}).to_list(None)
-
-    logging.info(f"Found {len(broken_quiz_results)} broken cx_ids")
-
-    for quiz_result in broken_quiz_results:
-        # Get the user's email address
-        email = quiz_result["email"]
-
-        # Get the user's cx_id
-        other_quiz_results = await collection.find({"email": email}).to_list(None)
-
-        fixed = False
-
-        # Iterate to find most recent quiz result that has a cx_id that is 8 digits
-        for other_quiz_result in other_quiz_results:
-            cx_id = other_quiz_result["cx_id"]
-
-            if len(str(cx_id)) == 8:
-                # The user's cx_id is 8 digits
-                # Update the user's cx_id
-                await collection.update_one({"_id": quiz_result["_id"]}, {"$set": {"cx_id": cx_id}})
-
-                fixed = True
-
-                break
-
-        if not fixed and str(cx_id)[-1] == "1" and len(str(cx_id)) == 9:
-            # The user's cx_id is still broken
-            # and the user has a cx_id that ends in 1
-            # This means they are stupid and put in their card
-            # number without a dash.
-            # We can fix this by removing the last digit
-            logging.info(
-                f"Fixing cx_id for {email} from {quiz_result['cx_id']} to {str(cx_id)[:-1]}")
-
-            # Update the user's cx_id
-            await collection.update_one({"_id": quiz_result["_id"]}, {"$set": {"cx_id": int(str(cx_id)[:-1])}})
+    # using $lt and $gt to get all quiz results with cx_ids that are not 8 digits,
+    # grouped by email along with the most recent 8 digit cx_id used with that email
+    broken_emails = await collection.aggregate([
+        {"$match": {
+            "$or": [{"cx_id": {"$lt": 10000000}}, {"cx_id": {"$gt": 100000000}}],
+            "email": {"$not": {"$regex": ".*cgu.edu|kgi.edu"}},
+        }},
+        {"$group": {"_id": "$email", "broken": {"$push": {"_id": "$_id", "cx_id": "$cx_id"}}}},
+        # Uses the email index, so only the quiz results of these emails are read
+        {"$lookup": {"from": "quizzes", "localField": "_id", "foreignField": "email", "as": "others"}},
+        {"$project": {
+            "broken": 1,
+            "best": {"$reduce": {
+                "input": {"$filter": {"input": "$others", "cond": {"$and": [
+                    {"$gte": ["$$this.cx_id", 10000000]},
+                    {"$lt": ["$$this.cx_id", 100000000]},
+                ]}}},
+                "initialValue": None,
+                "in": {"$cond": [
+                    {"$or": [{"$eq": ["$$value", None]}, {"$gt": ["$$this.timestamp", "$$value.timestamp"]}]},
+                    {"cx_id": "$$this.cx_id", "timestamp": "$$this.timestamp"},
+                    "$$value",
+                ]},
+            }},
+        }},
+    ]).to_list(None)
+
+    logging.info(f"Found {sum(len(email['broken']) for email in broken_emails)} broken cx_ids")
+
+    timestamp_updated = datetime.now().timestamp()
+    updates = []
+    fixes = []
+
+    for email in broken_emails:
+        for quiz_result in email["broken"]:
+            cx_id = quiz_result["cx_id"]
+
+            if email["best"] is not None:
+                # The user has used an 8 digit cx_id with this email, use that
+                fixed_cx_id = email["best"]["cx_id"]
+                method = "email"
+            elif str(cx_id)[-1] == "1" and len(str(cx_id)) == 9:
+                # The user's cx_id is still broken
+                # and the user has a cx_id that ends in 1
+                # This means they are stupid and put in their card
+                # number without a dash.
+                # We can fix this by removing the last digit
+                fixed_cx_id = int(str(cx_id)[:-1])
+                method = "card_number"
+            else:
+                continue
+
+            logging.info(f"Fixing cx_id for {email['_id']} from {cx_id} to {fixed_cx_id}")
+
+            # Keep the original so rescraping the quiz doesn't undo the fix,
+            # and mark the result as updated so the user gets updated too
+            updates.append(UpdateOne({"_id": quiz_result["_id"]}, {"$set": {
+                "cx_id": fixed_cx_id,
+                "original_cx_id": cx_id,
+                "timestamp_updated": timestamp_updated,
+            }}))
+            fixes.append({"email": email["_id"], "from": cx_id, "to": fixed_cx_id, "method": method})
+
+    if len(updates) == 0:
+        return
+
+    # Update all the cx_ids at once
+    await collection.bulk_write(updates, ordered=False)
+
+    # Keep a record of what was fixed
+    fixes_collection = await db.get_collection("cx_id_fixes")
+    await fixes_collection.insert_one({"timestamp": timestamp_updated, "fixes": fixes})
+
+    logging.info(f"Fixed {len(fixes)} cx_ids")
 
 def extra_validation_access(cx_id):
     '''
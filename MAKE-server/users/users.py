@@ -1,11 +1,24 @@
+import asyncio
 from datetime import datetime
+from typing import List
 import uuid
 import logging
 from utilities import levenshtein_ratio_and_distance
 from pymongo import UpdateOne
 from db_schema import MongoDB, User
+from users.quizzes import get_quizzes_valid_after
+from users.files import delete_user_file_blobs, find_orphan_user_file_blobs
+from misc.blob_store import blob_store
 from config import *
 
+# Name of the document in quiz_updates that stores how far
+# create_update_users_from_quizzes has got through the quiz results
+QUIZ_UPDATES_STATE = "users_from_quizzes"
+# Quiz results written up to this long before the watermark are looked at again
+WATERMARK_OVERLAP_SECONDS = 5 * 60
+# Stored data without a user_files document is only deleted once it's this old
+ORPHAN_GRACE_SECONDS = 60 * 60
+
 
 async def create_update_users_from_quizzes():
     # Create or update users from quizzes
@@ -19,30 +32,70 @@ async def create_update_users_from_quizzes():
     # Get the collection
     collection = await db.get_collection("quizzes")
 
-    # Get all quiz results
-    quiz_results = await collection.find().to_list(None)
+    # Only quiz results written since the last run need to be looked at
+    quiz_updates_collection = await db.get_collection("quiz_updates")
+    state = await quiz_updates_collection.find_one({"name": QUIZ_UPDATES_STATE}) or {}
+    watermark = state.get("watermark")
+
+    started = datetime.now().timestamp()
+    quizzes_valid_after = get_quizzes_valid_after()
+    prune = state.get("quizzes_valid_after") != quizzes_valid_after
+
+    if watermark is None:
+        # First run, go through everything
+        quiz_results = await collection.find().to_list(None)
+    else:
+        # Overlap a little with the last run, in case a scrape that started
+        # earlier finished writing after it
+        quiz_results = await collection.find(
+            {"timestamp_updated": {"$gt": watermark - WATERMARK_OVERLAP_SECONDS}}
+        ).to_list(None)
+
+    if len(quiz_results) == 0 and not prune:
+        logging.info("No new quiz results")
+        return
 
     # Get the users collection
     users_collection = await db.get_collection("users")
 
-    # Now we have our data. Let's iterate through all quiz results
+    # Look users up in memory instead of querying for every quiz result.
+    # Like find_one, the first user with an email or cx_id wins
+    users = await users_collection.find(
+        {}, {"uuid": 1, "email": 1, "cx_id": 1, "passed_quizzes": 1}
+    ).to_list(None)
+
+    users_by_email = {}
+    users_by_cx_id = {}
+    for user in users:
+        users_by_email.setdefault(user["email"], user)
+        users_by_cx_id.setdefault(user["cx_id"], user)
+
+    # Quiz counts for Case 3.2 below, which needs them rarely
+    quiz_counts = {}
+
+    async def count_quizzes(field, value):
+        if (field, value) not in quiz_counts:
+            quiz_counts[(field, value)] = await collection.count_documents({field: value})
+
+        return quiz_counts[(field, value)]
+
+    # Now we have our data. Let's iterate through the quiz results
     # and create/update users as necessary
 
-    # Keep track of the number of users that were created/updated
-    num_users_created = 0
-    num_total_updates = 0
+    # Users to insert, and uuids of existing users with new passed quizzes
+    new_users = []
+    updated_uuids = set()
+
+    new_watermark = watermark
 
-    users_updates = {}
-    
     for quiz_result in quiz_results:
-        email_search = await users_collection.find_one(
-            {"email": quiz_result["email"]}
-        )
-        cx_id_search = await users_collection.find_one(
-            {"cx_id": quiz_result["cx_id"]}
-        )
+        if quiz_result.get("timestamp_updated") is not None:
+            new_watermark = max(new_watermark or 0, quiz_result["timestamp_updated"])
+
+        email_search = users_by_email.get(quiz_result["email"])
+        cx_id_search = users_by_cx_id.get(quiz_result["cx_id"])
 
-        user_uuid = None
+        user = None
         quizzes_to_set = {}
 
         # Check if the user passed the quiz
@@ -53,29 +106,25 @@ async def create_update_users_from_quizzes():
             # The user does not exist in the database
             # Create the user
 
-            user = User(
+            new_user = User(
                 uuid=uuid.uuid4().hex,
                 email=quiz_result["email"],
                 cx_id=quiz_result["cx_id"],
                 name=quiz_result["name"],
                 role="user",
                 passed_quizzes=quizzes_to_set,
-            )
+            ).dict()
 
-            # Insert the user into the database
-            await users_collection.insert_one(user.dict())
-
-            # Increment the number of users created
-            num_users_created += 1
+            # Insert the user into the database at the end, but find it
+            # from here on so later quiz results update it
+            new_users.append(new_user)
+            users_by_email.setdefault(new_user["email"], new_user)
+            users_by_cx_id.setdefault(new_user["cx_id"], new_user)
 
         elif email_search is not None and cx_id_search is None:
             # Case 1: The user exists in the database, but the cx_id is incorrect
             # We can almost always trust the email, so we just update quizzes from the quiz result
-
-            # Add to dictionary of quizzes
-            quizzes_to_set.update(email_search["passed_quizzes"])
-
-            user_uuid = email_search["uuid"]
+            user = email_search
 
         elif email_search is None and cx_id_search is not None:
             # Case 2: we found the user by cx_id, but the email is incorrect
@@ -101,9 +150,7 @@ async def create_update_users_from_quizzes():
 
             # If the ratio is greater than 90, we can assume that the emails are the same person
             if ratio > .9:
-                quizzes_to_set.update(cx_id_search["passed_quizzes"])
-
-                user_uuid = cx_id_search["uuid"]
+                user = cx_id_search
 
         elif email_search is not None and cx_id_search is not None:
             # Case 3: both email and cx_id have returned results
@@ -111,156 +158,196 @@ async def create_update_users_from_quizzes():
             if email_search["uuid"] == cx_id_search["uuid"]:
                 # Case 3.1: most common case, the email and cx_id are the same person
                 # just update the quizzes
-                quizzes_to_set.update(cx_id_search["passed_quizzes"])
-
-                user_uuid = cx_id_search["uuid"]
+                user = cx_id_search
 
             else:
                 # Case 3.2: the email and cx_id are different people....
-                # This is annoying, but we can search all quizzes by
-                # the cx_id and by email and see if there are any
-                # overlap
-
-                # Get all quizzes by email
-                email_quizzes = await collection.find(
-                    {"email": email_search["email"]}).to_list(None)
-                
-                # Get all quizzes by cx_id
-                cx_id_quizzes = await collection.find(
-                    {"cx_id": cx_id_search["cx_id"]}).to_list(None)
-                
-                
+                # This is annoying, but we can count all quizzes by
+                # the cx_id and by email and see which has more
+
                 # Whichever one has more quizzes, we will use that
                 # to update the user
-                if len(email_quizzes) > len(cx_id_quizzes):
+                if await count_quizzes("email", email_search["email"]) > await count_quizzes("cx_id", cx_id_search["cx_id"]):
                     # Update the user with the email
-                    quizzes_to_set.update(email_search["passed_quizzes"])
-
-                    user_uuid = email_search["uuid"]
+                    user = email_search
                 else:
                     # Update the user with the cx_id
-                    quizzes_to_set.update(cx_id_search["passed_quizzes"])
+                    user = cx_id_search
+
+        # If we found a user, add any quizzes they don't have yet
+        if user is not None:
+            for timestamp, gid in quizzes_to_set.items():
+                if user["passed_quizzes"].get(timestamp) != gid:
+                    user["passed_quizzes"][timestamp] = gid
+
+                    # New users are inserted with all their quizzes at the end
+                    if "_id" in user:
+                        updated_uuids.add(user["uuid"])
+
+    if prune:
+        # The quiz year has rolled over, so go through all users and mark
+        # outdated quizzes as invalid, removing them from passed_quizzes
+        total_old_quizzes = 0
+        for user in users:
+            passed_quizzes = {}
+
+            # Iterate through all quizzes
+            for timestamp, gid in user["passed_quizzes"].items():
+                # Check if the quiz is valid
+                if float(timestamp) >= quizzes_valid_after:
+                    # The quiz is valid
+                    # Add it to the passed quizzes
+                    passed_quizzes[timestamp] = gid
+                else:
+                    # The quiz is invalid
+                    # Increment the number of old quizzes
+                    total_old_quizzes += 1
 
-                    user_uuid = cx_id_search["uuid"]
-                
-                
+            if passed_quizzes != user["passed_quizzes"]:
+                # Update the user's passed quizzes
+                user["passed_quizzes"] = passed_quizzes
+                updated_uuids.add(user["uuid"])
 
+        logging.info(f"Removed {total_old_quizzes} outdated quizzes")
 
-        # If the uuid is not None, we need to update the user
-        # with the new set of quizzes
-        if user_uuid is not None:
-            if user_uuid not in users_updates:
-                users_updates[user_uuid] = quizzes_to_set
-            else:
-                users_updates[user_uuid].update(quizzes_to_set)
+    # Run all the writes at once
+    if len(new_users) > 0:
+        await users_collection.insert_many(new_users)
+
+    if len(updated_uuids) > 0:
+        users_by_uuid = {user["uuid"]: user for user in users}
+
+        await users_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"uuid": user_uuid},
+                    {"$set": {"passed_quizzes": users_by_uuid[user_uuid]["passed_quizzes"]}},
+                )
+                for user_uuid in updated_uuids
+            ],
+            ordered=False,
+        )
 
-            # Increment the number of users updated
-            num_total_updates += 1
+    # Results from before timestamp_updated existed are all covered by this run
+    if new_watermark is None:
+        new_watermark = started
 
-    # Now, go through all users and mark outdated quizzes as invalid
-    # removing it from the user's passed_quizzes field
-    
-    # Make timestamp that quizzes are valid after.
-    # This resets every year on QUIZ_RESET_DAY
-    quizzes_valid_after = 0
+    # Remember where we got to, only once everything is written
+    await quiz_updates_collection.update_one(
+        {"name": QUIZ_UPDATES_STATE},
+        {"$set": {"watermark": new_watermark, "quizzes_valid_after": quizzes_valid_after}},
+        upsert=True,
+    )
 
-    # Get the current date
-    current_date = datetime.now()
+    logging.info(f"Processed {len(quiz_results)} quiz results, created {len(new_users)} users and updated {len(updated_uuids)} users")
 
-    # Get the current year
-    current_year = current_date.year
 
-    # Get day of year
-    day_of_year = current_date.timetuple().tm_yday
+async def delete_user_files(db: MongoDB, files: List[dict]):
+    # Delete user_files documents, remove them from their owners and delete
+    # their data from disk. Returns the number of bytes freed on disk
+    if len(files) == 0:
+        return 0
 
-    if day_of_year < QUIZ_RESET_DAY:
-        # The quiz date is valid if the quiz timestamp is in the previous year
-        quizzes_valid_after = datetime(current_year - 1, 8, 1).timestamp()
-    else:
-        # The quiz date is valid if the quiz timestamp is in the current year
-        quizzes_valid_after = datetime(current_year, 8, 1).timestamp()
+    user_collection = await db.get_collection("users")
+    file_collection = await db.get_collection("user_files")
 
-    total_old_quizzes = 0
-    users = await users_collection.find().to_list(None)
-    for user in users:
-        # Get the user's passed quizzes
-        passed_quizzes = user["passed_quizzes"]
+    file_uuids = [file["uuid"] for file in files]
 
-        # Get the user's uuid
-        user_uuid = user["uuid"]
+    # Delete the files
+    await file_collection.delete_many({"uuid": {"$in": file_uuids}})
 
-        passed_quizzes = {}
+    # Update the users' files and storage_bytes fields
+    files_by_user = {}
+    for file in files:
+        files_by_user.setdefault(file["user_uuid"], []).append(file)
 
-        # Iterate through all quizzes
-        for timestamp, gid in user["passed_quizzes"].items():
-            # Check if the quiz is valid
-            if float(timestamp) >= quizzes_valid_after:
-                # The quiz is valid
-                # Add it to the passed quizzes
-                passed_quizzes[timestamp] = gid
-            else:
-                # The quiz is invalid
-                # Increment the number of old quizzes
-                total_old_quizzes += 1
-
-        # Remove duplicate passed quizzes, keeping the most recent one
-        passed_quizzes = {
-            timestamp: gid
-            for timestamp, gid in sorted(
-                passed_quizzes.items(), key=lambda item: item[0], reverse=True
-            )
-        }
-
-        if passed_quizzes != user["passed_quizzes"]:
-            # Update the user's passed quizzes
-            users_updates[user_uuid] = passed_quizzes
-                
-    # Run all the updates at once
-    if users_updates:
-        users_updates = [
-            {"uuid": user_uuid, "quizzes": quizzes} for user_uuid, quizzes in users_updates.items()
-        ]
+    updates = []
+    for user_uuid, user_files in files_by_user.items():
+        updates.append(UpdateOne(
+            {"uuid": user_uuid},
+            {"$pull": {"files": {"$in": [file["uuid"] for file in user_files]}}},
+        ))
+        # Users without storage_bytes get it computed on their next upload
+        updates.append(UpdateOne(
+            {"uuid": user_uuid, "storage_bytes": {"$ne": None}},
+            {"$inc": {"storage_bytes": -sum(file["size"] for file in user_files)}},
+        ))
 
-        await users_collection.bulk_write(
-            [
-                UpdateOne(
-                    {"uuid": user["uuid"]},
-                    {"$set": {"passed_quizzes": user["quizzes"]}},
-                )
-                for user in users_updates
-            ]
-        )
+    await user_collection.bulk_write(updates, ordered=False)
+
+    # Release the data in the blob store, files from before
+    # it are stored by uuid and deleted directly
+    blob_hashes = [file["hash"] for file in files if file.get("hash") is not None]
+    legacy_uuids = [file["uuid"] for file in files if file.get("hash") is None]
+
+    freed_bytes = await blob_store.release(db, blob_hashes)
+    freed_bytes += await asyncio.to_thread(delete_user_file_blobs, legacy_uuids)
+
+    return freed_bytes
 
 
 async def cleanup_user_files():
     '''
-    This method goes through all the users and deletes their files
-    that are older then USER_FILE_TIME_LIMIT 
-    Additionally, it checks if the user has exceeded their storage limit,
-    and if so, deletes the oldest file until it's under the limit
+    This method deletes user files that are older then USER_STORAGE_LIMIT_SECONDS.
+    Additionally, it checks if any user has exceeded their storage limit,
+    and if so, deletes their oldest files until they're under the limit.
+    Finally, it deletes stored data that no longer has a user_files document.
     '''
     logging.getLogger().setLevel(logging.INFO)
     logging.info("Cleaning up user files...")
 
     db = MongoDB()
 
-    # Get the users collection
-    user_collection = await db.get_collection("users")
     file_collection = await db.get_collection("user_files")
-
-    freed_bytes = 0
-
-    # Iterate through all files that are older than the time limit
-    old_files = await file_collection.find({"timestamp": {"$lt": datetime.now().timestamp() - USER_STORAGE_LIMIT_SECONDS}}).to_list(None)
-
-    for file in old_files:
-        # Delete the file
-        await file_collection.delete_one({"uuid": file["uuid"]})
-
-        # Update the user's files field
-        await user_collection.update_one({"uuid": file["user_uuid"]}, {"$pull": {"files": file["uuid"]}})
-
-        # Add the size of the file to the freed_bytes variable
-        freed_bytes += file["size"]
-
-    logging.info(f"Freed {freed_bytes} bytes of storage")
+    projection = {"uuid": 1, "user_uuid": 1, "size": 1, "timestamp": 1, "hash": 1}
+
+    # Get all files that are older than the time limit
+    old_files = await file_collection.find(
+        {"timestamp": {"$lt": datetime.now().timestamp() - USER_STORAGE_LIMIT_SECONDS}}, projection
+    ).to_list(None)
+
+    expired_bytes = await delete_user_files(db, old_files)
+
+    # Find the users over their storage limit
+    over_limit = await file_collection.aggregate([
+        {"$group": {"_id": "$user_uuid", "size": {"$sum": "$size"}}},
+        {"$match": {"size": {"$gt": USER_STORAGE_LIMIT_BYTES}}},
+    ]).to_list(None)
+
+    # Evict their oldest files until they're under the limit
+    evicted_files = []
+    for user in over_limit:
+        size = user["size"]
+        user_files = await file_collection.find({"user_uuid": user["_id"]}, projection).sort("timestamp", 1).to_list(None)
+
+        for file in user_files:
+            if size <= USER_STORAGE_LIMIT_BYTES:
+                break
+
+            evicted_files.append(file)
+            size -= file["size"]
+
+    evicted_bytes = await delete_user_files(db, evicted_files)
+
+    # Delete data left behind without a document, e.g. by a failed upload
+    known_uuids = set(await file_collection.distinct("uuid"))
+    orphans = await asyncio.to_thread(
+        find_orphan_user_file_blobs, known_uuids, datetime.now().timestamp() - ORPHAN_GRACE_SECONDS
+    )
+    orphan_bytes = await asyncio.to_thread(delete_user_file_blobs, orphans)
+
+    # Delete blobs left behind without a blobs document
+    orphan_blobs, orphan_blob_bytes = await blob_store.sweep_orphans(
+        db, datetime.now().timestamp() - ORPHAN_GRACE_SECONDS
+    )
+
+    freed_bytes = expired_bytes + evicted_bytes + orphan_bytes + orphan_blob_bytes
+
+    logging.info(
+        f"Freed {freed_bytes} bytes of storage: {len(old_files)} expired files ({expired_bytes} bytes), "
+        f"{len(evicted_files)} files over storage limits ({evicted_bytes} bytes), "
+        f"{len(orphans)} orphaned files ({orphan_bytes} bytes), "
+        f"{orphan_blobs} orphaned blobs ({orphan_blob_bytes} bytes)"
+    )
+
+    return freed_bytes
@@ -1,70 +1,200 @@
 import logging
 import os
+import string
+import sys
 from db_schema import *
 from config import *
 
-import smtplib, ssl
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import datetime
+import time
 import urllib.parse
+from collections import OrderedDict
+
+from fastapi import Depends, HTTPException, Request
+from misc.outbox import outbox
 
 last_updated_time = datetime.datetime.now()
 
-async def validate_api_key(db, api_key_str, scope):
+# How long a cached API key lookup is trusted before going back to the database
+API_KEY_CACHE_TTL_SECONDS = 60
+# Maximum number of API keys kept in the cache
+API_KEY_CACHE_SIZE = 256
+
+class APIKeyCache:
+    # TTL + LRU cache mapping an API key to its scopes. Unknown keys are
+    # cached as None so repeated requests with a bad key don't hit the database.
+    # generation changes on every clear, so lookups that started before
+    # it can tell their scopes may be stale
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.generation = 0
+
+    def get(self, api_key_str: str):
+        # Returns (hit, scopes)
+        entry = self.entries.get(api_key_str)
+
+        if entry is None:
+            return False, None
+
+        expires, scopes = entry
+        if expires < time.monotonic():
+            del self.entries[api_key_str]
+            return False, None
+
+        # Mark as most recently used
+        self.entries.move_to_end(api_key_str)
+        return True, scopes
+
+    def set(self, api_key_str: str, scopes, generation: int):
+        # generation is the one read before looking up the scopes
+        if generation != self.generation:
+            # The keys changed during the lookup, so don't cache what it found
+            return
+
+        self.entries[api_key_str] = (time.monotonic() + self.ttl, scopes)
+        self.entries.move_to_end(api_key_str)
+
+        # Evict the least recently used keys
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.generation += 1
+
+api_key_cache = APIKeyCache(API_KEY_CACHE_TTL_SECONDS, API_KEY_CACHE_SIZE)
+
+def invalidate_api_keys():
+    # Must be called whenever the api_keys collection changes
+    api_key_cache.clear()
+
+async def get_api_key_scopes(db, api_key_str):
+    # Get the scopes of an API key, or None if the key does not exist
+    hit, scopes = api_key_cache.get(api_key_str)
+
+    if hit:
+        return scopes
+
+    generation = api_key_cache.generation
+
     # Get the API keys collection
     collection = await db.get_collection("api_keys")
 
     # Get the API key
     api_key = await collection.find_one({"key": api_key_str})
 
-    if api_key is None:
+    scopes = None if api_key is None else list(api_key["scopes"])
+    api_key_cache.set(api_key_str, scopes, generation)
+
+    return scopes
+
+async def validate_api_key(db, api_key_str, scope):
+    scopes = await get_api_key_scopes(db, api_key_str)
+
+    if scopes is None:
         logging.warning("API key not found")
         return False
     
     # Always allow admin scope, otherwise check if the scope is in the API key's scope
-    if scope not in api_key["scopes"] and "admin" not in api_key["scopes"]:
+    if scope not in scopes and "admin" not in scopes:
         logging.warning("Invalid API key scope")
         return False
     
     return True
 
+def require_scope(scope: str):
+    # FastAPI dependency that rejects requests without an
+    # api-key header valid for the given scope
+    async def check_api_key(request: Request, db: MongoDB = Depends(get_db)):
+        api_key = request.headers.get("api-key")
+
+        if api_key is None or not await validate_api_key(db, api_key, scope):
+            # The API key is invalid
+            # Return error
+            raise HTTPException(status_code=401, detail="Invalid API key")
+
+    return check_api_key
+
+# Directory the email templates are loaded from
+EMAIL_TEMPLATE_DIR = "email_templates"
+
+class EmailTemplate:
+    # An email template parsed once into its literal text and replacement
+    # fields, so rendering is just joining strings
+    formatter = string.Formatter()
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+
+        with open(path, "r") as f:
+            self.text = f.read()
+
+        self.parts = list(self.formatter.parse(self.text))
+
+        # Positional fields like {} or {0} can't be filled from key values,
+        # leave those templates to str.format so they fail the same way
+        self.positional = any(
+            field_name is not None and (field_name == "" or field_name[0].isdigit())
+            for _, field_name, _, _ in self.parts
+        )
+
+    def render(self, key_values: dict):
+        # Same result as template.format(**key_values)
+        if self.positional:
+            return self.text.format(**key_values)
+
+        rendered = []
+
+        for literal, field_name, format_spec, conversion in self.parts:
+            rendered.append(literal)
+
+            if field_name is None:
+                continue
+
+            value, _ = self.formatter.get_field(field_name, (), key_values)
+            value = self.formatter.convert_field(value, conversion)
+
+            # Format specs may themselves contain replacement fields
+            if "{" in format_spec:
+                format_spec = format_spec.format(**key_values)
+
+            rendered.append(format(value, format_spec))
+
+        return "".join(rendered)
+
+email_templates: Dict[str, EmailTemplate] = {}
+
+def get_email_template(template_name: str):
+    # Get a parsed template, loading it on first use. Outside of production,
+    # templates are reloaded when the file changes so edits show up immediately
+    path = f"{EMAIL_TEMPLATE_DIR}/{template_name}.html"
+    template = email_templates.get(template_name)
+
+    if template is None or ("--prod" not in sys.argv and os.path.getmtime(path) != template.mtime):
+        template = EmailTemplate(path)
+        email_templates[template_name] = template
+
+    return template
+
 def format_email_template(template_name: str, key_values: dict):
     # Format an email template
-    # Get the template
-    template = open(f"email_templates/{template_name}.html", "r").read()
+    return str(get_email_template(template_name).render(key_values))
 
-    # Format the template
-    formatted_template = template.format(**key_values)
+def format_email_templates(template_name: str, key_values_list: List[dict]):
+    # Format an email template once for each dict of key values,
+    # looking the template up only once for the whole batch
+    template = get_email_template(template_name)
+
+    return [str(template.render(key_values)) for key_values in key_values_list]
 
-    return str(formatted_template)
 async def email_user(user_email: str, cc_email: List[str], subject: str, html_body: str):
     # Email a user
-    sender_email = f" MAKE <{GMAIL_EMAIL}>"
-    receiver_email = user_email
-
-    message = MIMEMultipart("alternative")
-    message["Subject"] = subject
-    message["From"] = sender_email
-    message["To"] = receiver_email
-    message["Cc"] = ", ".join(cc_email)
-
-    logging.info(f"Emailing user {user_email} as {sender_email}...")
-    logging.info(f"\tSubject: {subject}")
-    logging.info(f"\tCC: {', '.join(cc_email)}")
-    logging.info(f"\tBody: {html_body}")
-
-    # Create
-    message.attach(MIMEText(html_body, "html"))
-
-    # Create a secure SSL context
-    context = ssl.create_default_context()
-
-    with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
-        server.login(GMAIL_EMAIL, GMAIL_PASS)
-        server.sendmail(
-            sender_email, [receiver_email] + cc_email, message.as_string()
-        )
+    # The email is queued in the outbox and sent in the background,
+    # so this returns as soon as the message is stored
+    await outbox.enqueue(user_email, cc_email, subject, html_body)
 
 def url_encode(to_encode: str):
     return urllib.parse.quote(to_encode)
@@ -49,21 +49,22 @@ function renderPreview() {
     document.getElementById("display").classList.add("loading");
 
     // Send image file to server to generate preview with options
-    // Encode image as base64 string
+    // The rendered png is sent back as is
     let request = new XMLHttpRequest();
-    request.open("POST", API + "/misc/render_loom_file    ", true);
-    request.setRequestHeader("Content-Type", "application/json");
+    request.open("POST", API + "/misc/render_loom_image", true);
+    request.responseType = "blob";
 
     request.onload = function () {
         if (request.status >= 200 && request.status < 400) {
             // Success!
-            let data = JSON.parse(request.responseText);
-
-            console.log(data);
-
             const img_el = document.getElementById("preview");
 
-            state.render = `data:image/png;base64,${data}`;
+            // Free the previous render
+            if (state.render !== null) {
+                URL.revokeObjectURL(state.render);
+            }
+
+            state.render = URL.createObjectURL(request.response);
 
             img_el.style.backgroundImage = `url(${state.render})`;
 
@@ -71,7 +72,9 @@ function renderPreview() {
             document.getElementById("display").classList.add("preview");
         } else {
             // We reached our target server, but it returned an error
-            uploadError(request);
+            request.response.text().then((text) => {
+                uploadError({responseText: text});
+            });
             console.log("Error");
         }
     }
@@ -82,26 +85,15 @@ function renderPreview() {
         console.log("Error");
     }
 
-    // Decode image file as base64 string
-    let reader = new FileReader();
-    reader.readAsDataURL(state.file);
-    reader.onload = function () {
-        let file_data_base64 = reader.result.split(',')[1];
-
-
-        let data = {
-            file: file_data_base64,
-            extension: state.file.name.split('.').pop(),
-            output_format: "png",
-            desired_height: Number(document.getElementById("desired-height").value),
-            loom_width: Number(document.getElementById("loom-width").value),
-            invert: document.getElementById("invert").checked,
-            tabby_width: Number(document.getElementById("tabby-width").value),
-        }
+    let data = new FormData();
+    data.append("file", state.file);
+    data.append("desired_height", Number(document.getElementById("desired-height").value));
+    data.append("loom_width", Number(document.getElementById("loom-width").value));
+    data.append("invert", document.getElementById("invert").checked);
+    data.append("tabby_width", Number(document.getElementById("tabby-width").value));
 
-        request.send(JSON.stringify(data));
-        console.log("Sent");
-    };
+    request.send(data);
+    console.log("Sent");
 }
 
 function uploadError(request) {
@@ -2762,7 +2762,7 @@ function generateWorkshopPhotoDiv(file, uploaded = false, workshop = null) {
 
     const photo = document.createElement("img");
     if (uploaded) {
-        photo.src = `${API}/workshops/download_photo/${file}`;
+        photo.src = `${API}/workshops/download_photo/${file}?size=thumbnail`;
     } else {
         photo.src = URL.createObjectURL(file);
     }
@@ -246,9 +246,12 @@ function openFile() {
 
 async function uploadFiles(event) {
     // open file dialog then upload
-    let formData = new FormData();
     const files = event.target.files;
     for (const file of files) {
+        // One request per file. user_uuid goes before the file so the
+        // server can check the storage limit while the file is uploading
+        let formData = new FormData();
+
         if (file === undefined) {
             return;
         }
@@ -261,9 +264,9 @@ async function uploadFiles(event) {
 
         document.getElementById("quick-transfer-upload-button").setAttribute("disabled", "disabled");
 
-        formData.append("file", file);
-        formData.append("name", file.name);
         formData.append("user_uuid", state.user_object.uuid);
+        formData.append("name", file.name);
+        formData.append("file", file);
 
         await fetch(`${API}/users/upload_file`, {
             method: "POST",
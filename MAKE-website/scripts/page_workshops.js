@@ -65,7 +65,7 @@ function generateWorkshopDiv(workshop, is_past=false) {
 
     if (workshop.photos !== undefined && workshop.photos !== null && workshop.photos.length > 0) {
         // Create two alternating containers for the fading slideshow of photos
-        // API path is API/workshops/download_photo/{photo_uuid}
+        // API path is API/workshops/download_photo/{photo_uuid}?size=thumbnail
         let photo_index = 0;
         let photos = workshop.photos;
         let total_photos = photos.length;
@@ -76,7 +76,7 @@ function generateWorkshopDiv(workshop, is_past=false) {
             photo_container.classList.add("fade");
 
             let img = document.createElement("img");
-            img.src = `${API}/workshops/download_photo/${photos[i]}`;
+            img.src = `${API}/workshops/download_photo/${photos[i]}?size=thumbnail`;
             img.style.width = "100%";
             img.style.height = "auto";
             img.alt = `${workshop.title} photo ${i + 1} of ${total_photos}`;